@@ -0,0 +1,118 @@
+import json
+import logging
+from queue import Queue, Empty, Full
+from urllib.request import Request, urlopen
+
+from worker import PeriodicWorker
+
+logger = logging.getLogger(__name__)
+
+
+class BotanSink(object):
+    """ Sends events to botan.io, one request per event as its API requires """
+
+    def __init__(self, botan):
+        self.botan = botan
+
+    def __call__(self, events):
+        """ Returns the events that could not be delivered """
+        return [(message, name) for (message, name) in events
+                if not self.botan.track(message=message, event_name=name)]
+
+
+class HttpSink(object):
+    """ POSTs each batch of events as a JSON array to url """
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, events):
+        data = json.dumps([{'uid': message.chat_id,
+                            'name': name,
+                            'message': message.to_dict()}
+                           for (message, name) in events])
+        request = Request(self.url, data=data.encode(),
+                          headers={'Content-Type': 'application/json'})
+        try:
+            urlopen(request, timeout=self.timeout).close()
+        except OSError as e:
+            logger.warning("Analytics upload failed: %s", e)
+            return events
+        return []
+
+
+class EventQueue(PeriodicWorker):
+    """
+    Bounded queue of analytics events, delivered in batches by a single
+    background thread every flush_interval seconds.
+
+    Recording an event never blocks: when the queue is full the event is
+    dropped and counted. Failed deliveries are retried with exponential
+    backoff before being given up on.
+    """
+
+    def __init__(self, sink, max_size=10000, batch_size=100, flush_interval=5,
+                 max_retries=3, backoff=1.0):
+        super(EventQueue, self).__init__(flush_interval, 'analytics-flusher')
+        self.sink = sink
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = Queue(max_size)
+
+    def track(self, message, event_name):
+        try:
+            self._queue.put_nowait((message, event_name))
+        except Full:
+            self.dropped += 1
+
+    def _next_batch(self):
+        """ At most batch_size of the queued events """
+        batch = []
+
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+
+        return batch
+
+    def _deliver(self, batch):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                # Returns at once when stopping, so shutdown is not held up
+                self.stopping.wait(self.backoff * 2 ** (attempt - 1))
+
+            try:
+                failed = self.sink(batch)
+            except Exception:
+                logger.exception("Analytics sink raised")
+                failed = batch
+
+            self.sent += len(batch) - len(failed)
+            batch = failed
+            if not batch:
+                return
+
+        self.failed += len(batch)
+        logger.warning("Gave up on %d analytics events", len(batch))
+
+    def run_once(self):
+        """ Deliver the events queued so far; ones recorded meanwhile wait for the next run """
+        remaining = self._queue.qsize()
+
+        while remaining > 0:
+            batch = self._next_batch()
+            if not batch:
+                return
+            self._deliver(batch)
+            remaining -= len(batch)
+
+    def stats(self):
+        return {'queued': self._queue.qsize(), 'sent': self.sent,
+                'dropped': self.dropped, 'failed': self.failed}
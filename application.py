@@ -0,0 +1,184 @@
+import logging
+import os
+import threading
+
+from telegram.ext import Updater
+from telegram.utils.request import Request
+from telegram.utils.botan import Botan
+from pony.orm import select
+
+import credentials
+import metrics
+import schema
+from admin import Admin
+from analytics import EventQueue, BotanSink, HttpSink
+from config import DB_NAME, API_URL, WORKERS, SUPER_ADMINS, STATE_FILE, STATE_TTL, \
+    STATE_SNAPSHOT_INTERVAL, METRICS_LISTEN, METRICS_PORT, PROFILING, OUTBOX_RATE, \
+    OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_SENDERS, READ_SNAPSHOT, ANALYTICS_URL
+from conversation_state import ConversationState
+from database import db, write_session
+from export import DatabaseExport
+from identity import identities
+from outbox import Outbox, OutboxBot
+from prefix_index import typeahead
+from read_snapshot import snapshot
+from start_bot import start_bot
+from votes import votes
+
+logger = logging.getLogger(__name__)
+
+
+def bot_path(name):
+    """
+    name relative to the bot's directory, as Pony and sqlite3 would otherwise
+    disagree about the database; empty names stay empty
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name) if name else name
+
+
+def parse_admin_seed(text):
+    """ [(id, first_name), ...] from 'id:first_name,id:first_name' """
+    admins = []
+
+    for item in text.split(','):
+        admin_id, _, first_name = item.strip().partition(':')
+        if admin_id:
+            admins.append((int(admin_id), first_name.strip() or admin_id))
+
+    return admins
+
+
+class Application(object):
+    """
+    The bot's runtime objects, each created on first use instead of when
+    bot.py is imported. Importing the handlers therefore neither connects to
+    the database nor starts threads, and a process only builds what it uses.
+
+    install_handlers(app) is called once the Updater exists, to register
+    the handlers on its dispatcher.
+    """
+
+    def __init__(self, install_handlers=None, db_name=DB_NAME, super_admins=SUPER_ADMINS):
+        self.install_handlers = install_handlers
+        self.db_name = bot_path(db_name)
+        self.super_admins = super_admins
+        self._lock = threading.RLock()
+        self._updater = None
+        self._outbox = None
+        self._database_ready = False
+        self._database_export = None
+        self._analytics = None
+        self._conversation_state = None
+
+    @property
+    def updater(self):
+        with self._lock:
+            if self._updater is None:
+                # Connections for the workers, the dispatcher, polling and the outbox senders
+                request = Request(con_pool_size=WORKERS + OUTBOX_SENDERS + 4)
+                bot = OutboxBot(credentials.TOKEN, API_URL, request=request, outbox=self.outbox)
+                self._updater = Updater(bot=bot, workers=WORKERS)
+                if self.install_handlers:
+                    self.install_handlers(self)
+            return self._updater
+
+    @property
+    def outbox(self):
+        """ Queue the bot's messages go through; its senders start with it """
+        with self._lock:
+            if self._outbox is None:
+                self._outbox = Outbox(OUTBOX_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST,
+                                      OUTBOX_SENDERS)
+                self._outbox.start()
+            return self._outbox
+
+    @property
+    def dispatcher(self):
+        return self.updater.dispatcher
+
+    @property
+    def database_export(self):
+        with self._lock:
+            if self._database_export is None:
+                self._database_export = DatabaseExport(self.db_name)
+            return self._database_export
+
+    @property
+    def analytics(self):
+        """ The analytics queue, or None if no endpoint or botan.io token is configured """
+        with self._lock:
+            if self._analytics is None:
+                if ANALYTICS_URL:
+                    self._analytics = EventQueue(HttpSink(ANALYTICS_URL))
+                elif credentials.BOTAN_TOKEN:
+                    self._analytics = EventQueue(BotanSink(Botan(credentials.BOTAN_TOKEN)))
+            return self._analytics
+
+    @property
+    def conversation_state(self):
+        with self._lock:
+            if self._conversation_state is None:
+                self._conversation_state = ConversationState(
+                    bot_path(STATE_FILE), ttl=STATE_TTL, snapshot_interval=STATE_SNAPSHOT_INTERVAL)
+            return self._conversation_state
+
+    def setup_database(self):
+        """ Map the entities, bring the schema up to date and seed the super admins """
+        with self._lock:
+            if self._database_ready:
+                return
+
+            db.bind('sqlite', self.db_name, create_db=True)
+            # Tables of older databases lack columns until the migrations ran
+            db.generate_mapping(create_tables=True, check_tables=False)
+            schema.migrate(self.db_name)
+            db.check_tables()
+            self.seed_admins()
+
+            self._database_ready = True
+
+    @write_session
+    def seed_admins(self):
+        admins = parse_admin_seed(self.super_admins)
+        ids = [admin_id for admin_id, _ in admins]
+        existing = set(select(a.id for a in Admin if a.id in ids))
+
+        for admin_id, first_name in admins:
+            if admin_id not in existing:
+                Admin(id=admin_id, first_name=first_name, super_admin=True)
+                logger.info("Created super admin %d", admin_id)
+
+    def run(self):
+        """ Start everything, serve updates until stopped, then shut down """
+        self.setup_database()
+        updater = self.updater
+
+        # Until these are ready, inline queries fall back to searches and searches to SQLite
+        threading.Thread(target=typeahead.load, name='prefix-index', daemon=True).start()
+        if READ_SNAPSHOT:
+            threading.Thread(target=snapshot.load, name='read-snapshot', daemon=True).start()
+        self.conversation_state.load()
+        self.conversation_state.start()
+        identities.start()
+        votes.start()
+        if self.analytics:
+            self.analytics.start()
+
+        metrics_server = None
+        if METRICS_PORT:
+            metrics_server = metrics.serve(METRICS_LISTEN, METRICS_PORT, profiling=PROFILING)
+
+        start_bot(updater)
+        updater.idle()
+
+        if metrics_server:
+            metrics_server.shutdown()
+
+        votes.stop()
+        self.outbox.stop()
+        self.conversation_state.stop()
+        identities.stop()
+        if self.analytics:
+            self.analytics.stop()
+        if self._database_export is not None:
+            self._database_export.stop()
@@ -1,8 +1,57 @@
 import datetime
+import re
+import threading
 from html import escape as escape_html
 
 from pony.orm import *
 from database import db
+from identity import identities
+from lru import ExpiringLRU
+from reporter import display_name
+from votes import votes
+
+_non_digits = re.compile(r'\D')
+_phone_like = re.compile(r'^\+?[\d\s\-().\/]+$')
+
+# Shortest digit sequence that is looked up as a phone number
+MIN_PHONE_DIGITS = 6
+
+# Number of voters listed by name on a report card
+SHOWN_VOTERS = 3
+
+# Rendered report cards, keyed by (id, version, voter names generation, pending votes)
+RENDER_CACHE_SIZE = 4096
+_rendered = ExpiringLRU(RENDER_CACHE_SIZE)
+_rendered_lock = threading.Lock()
+
+
+def is_phone_shaped(text):
+    """ Whether text only has the characters of a phone number, however few digits """
+    return bool(_phone_like.match(text))
+
+
+def is_phone_like(text):
+    """ Whether text looks like a phone number or numeric ID """
+    return is_phone_shaped(text) and len(_non_digits.sub('', text)) >= MIN_PHONE_DIGITS
+
+
+def phone_nr_key(phone_nr):
+    """
+    Lookup key for a phone number: its digits without leading zeros (trunk
+    or international prefix), reversed. Reversing turns "same number with or
+    without country code" into a prefix match, which the index can answer.
+    """
+    return _non_digits.sub('', phone_nr or '').lstrip('0')[::-1]
+
+
+def account_nr_key(account_nr):
+    """ Lookup key for a Telegram ID: lower case, no @ and no whitespace """
+    return ''.join((account_nr or '').split()).lstrip('@').lower()
+
+
+def name_key(name):
+    """ Lookup key for a name: lower case, words separated by single spaces """
+    return ' '.join((name or '').split()).lower()
 
 
 class Believer(db.Entity):
@@ -11,17 +60,72 @@ class Believer(db.Entity):
     bank_name = Optional(str)
     remark = Optional(str)
     attached_file = Optional(str)
+    phone_nr_key = Optional(str)
+    account_nr_key = Optional(str)
+    name_key = Optional(str)
     reported_by = Set("Reporter")
+    voter_count = Required(int, default=0)
     added_by = Required("Admin")
     created = Required(datetime.datetime, default=datetime.datetime.now)
+    version = Required(int, default=0)
 
-    def __str__(self):
-        reported_count = len(self.reported_by)
-        reported_list = ', '.join(
-            [str(reporter) for reporter in self.reported_by][:3]) + (
-                ' and %d others' % (reported_count - 3)
-                if reported_count > 3
-                else '')
+    def set_phone_nr(self, phone_nr):
+        self.phone_nr = phone_nr
+        self.phone_nr_key = phone_nr_key(phone_nr)
+
+    def set_account_nr(self, account_nr):
+        self.account_nr = account_nr
+        self.account_nr_key = account_nr_key(account_nr)
+
+    def set_bank_name(self, bank_name):
+        self.bank_name = bank_name
+        self.name_key = name_key(bank_name)
+
+    def search_values(self):
+        """ Values of the fields that /search looks into """
+        return self.phone_nr, self.account_nr, self.bank_name, self.remark
+
+    def add_voter(self, reporter):
+        self.reported_by.add(reporter)
+        self.voter_count += 1
+
+    def remove_voter(self, reporter):
+        self.reported_by.remove(reporter)
+        self.voter_count -= 1
+
+    def has_voter(self, reporter_id):
+        """ Whether the reporter with that id voted for this report, including unwritten votes """
+        vote = votes.vote(self.id, reporter_id)
+        return self.has_stored_voter(reporter_id) if vote is None else vote
+
+    def has_stored_voter(self, reporter_id):
+        """ Whether the database has the reporter's vote, without loading all voters """
+        believer_id = self.id
+        return bool(db.select("1 FROM Believer_Reporter "
+                              "WHERE believer = $believer_id AND reporter = $reporter_id"))
+
+    def touch(self):
+        """ Mark the report as changed, so its cached card is rendered again """
+        self.version += 1
+
+    def current_voter_count(self):
+        return self.voter_count + votes.delta(self.id)
+
+    def _render(self, pending=()):
+        believer = self
+        voter_count = self.current_voter_count()
+
+        # Votes not written yet are the newest, so they are listed first
+        names = [display_name(*profile) for _, voted, profile in pending if voted]
+        pending_ids = {reporter_id for reporter_id, _, _ in pending}
+        stored = select(r for b in Believer if b == believer
+                        for r in b.reported_by)[:SHOWN_VOTERS + len(pending_ids)]
+        names += [str(reporter) for reporter in stored if reporter.id not in pending_ids]
+
+        reported_list = ', '.join(names[:SHOWN_VOTERS]) + (
+            ' and %d others' % (voter_count - SHOWN_VOTERS)
+            if voter_count > SHOWN_VOTERS
+            else '')
 
         params = {
             'id': self.id,
@@ -30,19 +134,32 @@ class Believer(db.Entity):
             'bank_name': self.bank_name,
             'remark': self.remark,
             'reported_by': reported_list,
-            'added_by': self.added_by
         }
 
-        s = ("<b>Verified Member: C#{id}</b>\n"
-             "<b>Cellular:</b> {phone_nr}\n"
-             "Telegram ID: {account_nr}\n"
-             "Name: {bank_name}\n"
-             "DNA: {remark}\n"
-             "Voted by: {reported_by}\n").format(
-                **{k: escape_html(str(v)) for (k, v) in params.items()}
-            )
+        return ("<b>Verified Member: C#{id}</b>\n"
+                "<b>Cellular:</b> {phone_nr}\n"
+                "Telegram ID: {account_nr}\n"
+                "Name: {bank_name}\n"
+                "DNA: {remark}\n"
+                "Voted by: {reported_by}\n").format(
+                   **{k: escape_html(str(v)) for (k, v) in params.items()}
+               )
+
+    def __str__(self):
+        # Votes not written yet change the count and the voters, and renamed
+        # voters their names, but neither changes the version
+        pending = votes.pending_voters(self.id)
+        key = (self.id, self.version, identities.generation, pending)
+
+        with _rendered_lock:
+            s = _rendered.get(key)
+            if s is not None:
+                return s
+
+        s = self._render(pending)
 
-        print(s)
+        with _rendered_lock:
+            _rendered.put(key, s)
 
         return s
 
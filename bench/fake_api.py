@@ -0,0 +1,199 @@
+"""
+Local stand-in for the Telegram Bot API, for benchmarks.
+
+Point an Updater at FakeBotAPI.base_url instead of https://api.telegram.org/bot.
+getUpdates serves updates queued with push(); every other method is recorded
+and answered with a plausible result.
+"""
+import itertools
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# Methods whose result is a Message
+_MESSAGE_METHODS = {'sendMessage', 'sendDocument', 'sendPhoto', 'editMessageText',
+                    'editMessageReplyMarkup', 'forwardMessage'}
+
+
+def user(user_id, first_name='User'):
+    return {'id': user_id, 'first_name': '%s %d' % (first_name, user_id)}
+
+
+def message(message_id, user_id, text, forward_from=None):
+    msg = {'message_id': message_id, 'date': int(time.time()),
+           'from': user(user_id), 'chat': {'id': user_id, 'type': 'private'},
+           'text': text}
+    if text.startswith('/'):
+        msg['entities'] = [{'type': 'bot_command', 'offset': 0,
+                            'length': len(text.split()[0])}]
+    if forward_from is not None:
+        msg['forward_from'] = user(forward_from, 'Reporter')
+        msg['forward_date'] = msg['date']
+    return msg
+
+
+def callback_query(query_id, user_id, message_id, data):
+    # The id carries the user so the fake API can attribute the answer to a chat
+    return {'id': '%d:%d' % (user_id, query_id), 'from': user(user_id), 'data': data,
+            'chat_instance': str(user_id),
+            'message': {'message_id': message_id, 'date': int(time.time()),
+                        'from': user(0, 'Bot'), 'chat': {'id': user_id, 'type': 'private'},
+                        'text': '...'}}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Small responses on kept-alive connections would otherwise wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        api = self.server.api
+        method = self.path.rsplit('/', 1)[-1]
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        try:
+            params = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError:
+            # multipart upload, e.g. sendDocument with a file
+            params = {}
+
+        result = api.handle(method, params)
+        data = json.dumps({'ok': True, 'result': result}).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBotAPI(object):
+    def __init__(self, host='127.0.0.1', port=0):
+        self.calls = Counter()
+        self.replies = []
+        self.per_chat = Counter()
+        self.last_message = {}
+        self.texts = defaultdict(list)
+        self.on_reply = None
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._httpd = _Server((host, port), _Handler)
+        self._httpd.api = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address
+        return 'http://%s:%d/bot' % (host, port)
+
+    def next_update_id(self):
+        return next(self._update_ids)
+
+    def push(self, updates):
+        """ Queue raw update dicts for getUpdates """
+        with self._cond:
+            self._updates.extend(updates)
+            self._cond.notify_all()
+
+    def handle(self, method, params):
+        with self._cond:
+            self.calls[method] += 1
+
+        if method == 'getUpdates':
+            return self._get_updates(params)
+
+        if method == 'getMe':
+            return user(0, 'Bot')
+
+        if method == 'answerCallbackQuery':
+            self._record(method, int(str(params.get('callback_query_id')).split(':')[0]), params)
+            return True
+
+        if method in _MESSAGE_METHODS:
+            chat_id = int(params.get('chat_id') or 0)
+            message_id = int(params.get('message_id') or 0) or next(self._message_ids)
+            self._record(method, chat_id, params, message_id)
+            return {'message_id': message_id, 'date': int(time.time()),
+                    'from': user(0, 'Bot'), 'chat': {'id': chat_id, 'type': 'private'},
+                    'text': params.get('text', '')}
+
+        return True
+
+    def _record(self, method, chat_id, params, message_id=None):
+        with self._cond:
+            self.replies.append((time.monotonic(), method, chat_id))
+            self.per_chat[chat_id] += 1
+            if message_id is not None:
+                self.last_message[chat_id] = (message_id, params)
+                self.texts[chat_id].append(params.get('text', ''))
+            self._cond.notify_all()
+
+        if self.on_reply:
+            self.on_reply(method, params)
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            while True:
+                self._updates = [u for u in self._updates if u['update_id'] >= offset]
+                if self._updates or time.monotonic() >= deadline:
+                    return self._updates[:100]
+                self._cond.wait(deadline - time.monotonic())
+
+    def wait_for_replies(self, count, timeout=60):
+        """ Block until count replies were sent in total """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(self.replies) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('%d of %d replies received' % (len(self.replies), count))
+                self._cond.wait(remaining)
+
+    def wait_for_chat(self, chat_id, count, timeout=60):
+        """ Block until chat_id received count replies in total """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.per_chat[chat_id] < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('chat %d: %d of %d replies received'
+                                       % (chat_id, self.per_chat[chat_id], count))
+                self._cond.wait(remaining)
+
+    def wait_for_text(self, chat_id, prefix, after=0, timeout=60):
+        """ Block until chat_id got a message starting with prefix, skipping its first after """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not any(text.startswith(prefix) for text in self.texts[chat_id][after:]):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('chat %d: no message starting with %r' % (chat_id, prefix))
+                self._cond.wait(remaining)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
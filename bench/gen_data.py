@@ -0,0 +1,119 @@
+"""
+Generate a synthetic trader database for benchmarks.
+
+    python bench/gen_data.py ROWS PATH
+
+Creates PATH with ROWS reports, one reporter per ten reports and twenty
+admins, then builds the indexes the bot uses. Rows are inserted with plain
+executemany in large transactions, so a million rows take about a minute.
+"""
+import datetime
+import os
+import random
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pony.orm import db_session
+
+from database import db
+from admin import Admin
+from believer import Believer, phone_nr_key, account_nr_key, name_key
+from reporter import Reporter
+import schema
+
+ADMINS = 20
+ADMIN_IDS = range(1, ADMINS + 1)
+REPORTER_ID_BASE = 1000000
+BATCH_SIZE = 50000
+
+FIRST_NAMES = ['Adi', 'Budi', 'Citra', 'Dewi', 'Eko', 'Fajar', 'Gita', 'Hadi', 'Indra',
+               'Joko', 'Kartika', 'Lestari', 'Made', 'Nur', 'Putri', 'Rizky', 'Sari',
+               'Tono', 'Wahyu', 'Yusuf']
+LAST_NAMES = ['Santoso', 'Wijaya', 'Saputra', 'Hidayat', 'Kusuma', 'Pratama', 'Siregar',
+              'Nasution', 'Halim', 'Gunawan', 'Setiawan', 'Susanto', 'Lubis', 'Tanjung']
+REMARKS = ['fast release', 'escrow only', 'met in person', 'bank transfer', 'cash deposit',
+           'trusted since 2015', 'slow but reliable', 'large volumes', '']
+PHONE_FORMATS = ['+62 8{0} {1} {2}', '08{0}-{1}-{2}', '628{0}{1}{2}', '08{0} {1} {2}']
+
+
+def phone(rng):
+    return rng.choice(PHONE_FORMATS).format(rng.randint(11, 99), rng.randint(1000, 9999),
+                                            rng.randint(100, 9999))
+
+
+def name(rng):
+    return '%s %s' % (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+
+
+def reporter_count(rows):
+    return max(rows // 10, 1)
+
+
+def generate(rows, path, seed=1):
+    rng = random.Random(seed)
+    # Pony resolves relative paths against the calling module, not the working directory
+    path = os.path.abspath(path)
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    db.bind('sqlite', path, create_db=True)
+    db.generate_mapping(create_tables=True)
+
+    with db_session:
+        for admin_id in ADMIN_IDS:
+            Admin(id=admin_id, first_name='Admin', last_name=str(admin_id))
+
+    reporters = reporter_count(rows)
+    now = datetime.datetime.now()
+
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            'INSERT INTO Reporter (id, first_name, last_name, username, created) '
+            'VALUES (?, ?, ?, ?, ?)',
+            ((REPORTER_ID_BASE + i, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES),
+              'user%d' % i, str(now)) for i in range(reporters)))
+
+    for start in range(0, rows, BATCH_SIZE):
+        believers, votes = [], []
+
+        for believer_id in range(start + 1, min(start + BATCH_SIZE, rows) + 1):
+            phone_nr = phone(rng)
+            account_nr = rng.choice(['@%s%d' % (rng.choice(FIRST_NAMES).lower(), believer_id),
+                                     str(rng.randint(10 ** 7, 10 ** 9))])
+            voters = rng.sample(range(reporters), min(rng.randint(1, 5), reporters))
+            created = now - datetime.timedelta(minutes=rows - believer_id)
+
+            bank_name = name(rng)
+            believers.append((believer_id, phone_nr, account_nr, bank_name, rng.choice(REMARKS),
+                              '', phone_nr_key(phone_nr), account_nr_key(account_nr),
+                              name_key(bank_name),
+                              len(voters), rng.choice(ADMIN_IDS), str(created)))
+            votes.extend((believer_id, REPORTER_ID_BASE + v) for v in voters)
+
+        with conn:
+            conn.executemany(
+                'INSERT INTO Believer (id, phone_nr, account_nr, bank_name, remark, '
+                'attached_file, phone_nr_key, account_nr_key, name_key, voter_count, added_by, '
+                'created, version) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)', believers)
+            conn.executemany('INSERT INTO Believer_Reporter (believer, reporter) VALUES (?, ?)',
+                             votes)
+
+    conn.close()
+
+    # Builds the indexes and the search index over everything inserted above
+    schema.migrate(path)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    path = sys.argv[2] if len(sys.argv) > 2 else 'bench_%d.sqlite' % rows
+    generate(rows, path)
+    print("Generated %d reports in %s" % (rows, path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+Load test the bot's handlers against a local fake Bot API.
+
+    python bench/loadtest.py --rows 100000 --users 32 --requests 20000
+
+A synthetic database of --rows reports is generated if --db does not exist
+yet. Virtual users then drive a mix of /search, carousel paging, confirms
+and admin edits through the real dispatcher, one update at a time each. The
+latency of an update is measured from enqueueing it until the bot's replies
+reached the fake API. Reports p50/p99 latency and throughput per handler.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# gen_data and the bot read their configuration on import, so both are only
+# imported once the environment below is set up
+import fake_api
+
+TOKEN = '123:loadtest'
+NON_ADMIN_ID_BASE = 5000000
+
+# Relative frequency of the user actions
+MIX = {'search': 50, 'page': 30, 'confirm': 10, 'edit': 10}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+class _ErrorLog(logging.Handler):
+    """ Collects errors logged anywhere, e.g. by a handler that raised on a worker """
+
+    def __init__(self, failures):
+        super(_ErrorLog, self).__init__(logging.ERROR)
+        self.failures = failures
+
+    def emit(self, record):
+        self.failures.append(self.format(record))
+
+
+class LoadTest(object):
+    def __init__(self, api, bot_module, queries):
+        self.api = api
+        self.bot = bot_module
+        self.queries = queries
+        self.latencies = defaultdict(list)
+        # Errors of handlers and virtual users; any of them fails the run
+        self.failures = []
+        self.error_log = _ErrorLog(self.failures)
+        self._lock = threading.Lock()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+
+    def send(self, handler, user_id, payload, replies=1, until=None):
+        """
+        Push one update and wait until the bot answered it with replies
+        messages, and, if until is given, with one starting with until
+        """
+        from telegram import Update
+
+        data = dict(payload, update_id=next(self._update_ids))
+        expected = self.api.per_chat[user_id] + replies
+        texts = len(self.api.texts[user_id])
+
+        started = time.monotonic()
+        self.bot.app.updater.update_queue.put(Update.de_json(data, self.bot.app.updater.bot))
+        self.api.wait_for_chat(user_id, expected)
+        if until is not None:
+            self.api.wait_for_text(user_id, until, texts)
+        elapsed = time.monotonic() - started
+
+        if self.failures:
+            raise RuntimeError("A handler failed while processing %s" % handler)
+
+        with self._lock:
+            self.latencies[handler].append(elapsed)
+
+    def message(self, handler, user_id, text, replies=1, until=None):
+        self.send(handler, user_id,
+                  {'message': fake_api.message(next(self._message_ids), user_id, text)},
+                  replies, until)
+
+    def callback(self, handler, user_id, message_id, data, replies=1):
+        self.send(handler, user_id,
+                  {'callback_query': fake_api.callback_query(next(self._callback_ids), user_id,
+                                                             message_id, data)},
+                  replies)
+
+    def search(self, user_id, rng):
+        """ /search followed by a query; returns (message id, session token) or None """
+        self.message('search', user_id, '/search')
+        self.message('search_2', user_id, rng.choice(self.queries))
+
+        message_id, params = self.api.last_message[user_id]
+        # No results come without the carousel's inline keyboard
+        keyboard = json.loads(params.get('reply_markup') or '{}').get('inline_keyboard')
+        if not keyboard:
+            return None
+
+        data = keyboard[0][0]['callback_data']
+        return message_id, data.partition('sid=')[2]
+
+    def edit(self, user_id, rng, max_id):
+        import gen_data
+
+        self.message('edit_believer', user_id, '/edit')
+        self.message('edit_believer_2', user_id, str(rng.randint(1, max_id)))
+        self.message('select_option', user_id, 'Name of bank account owner')
+        # Names repeat, so the prompt may follow a warning about reports with the same name
+        self.message('edit_bank_name', user_id, gen_data.name(rng), until='Add more info')
+        self.message('done', user_id, '/done')
+
+    def run_user(self, user_id, is_admin, actions, seed, max_id):
+        try:
+            self._run_user(user_id, is_admin, actions, seed, max_id)
+        except Exception:
+            self.failures.append("User %d:\n%s" % (user_id, traceback.format_exc()))
+
+    def _run_user(self, user_id, is_admin, actions, seed, max_id):
+        rng = random.Random(seed)
+        carousel = None
+        kinds, weights = zip(*MIX.items())
+
+        for _ in range(actions):
+            if self.failures:
+                return
+
+            action = rng.choices(kinds, weights)[0]
+
+            if action == 'edit' and not is_admin:
+                action = 'search'
+            if action in ('page', 'confirm') and not carousel:
+                action = 'search'
+
+            if action == 'search':
+                carousel = self.search(user_id, rng)
+            elif action == 'page':
+                self.callback('callback_query:old', user_id, carousel[0],
+                              'act=old%sid=' + carousel[1])
+            elif action == 'confirm':
+                self.callback('callback_query:confirm', user_id, carousel[0],
+                              'act=confirm%sid=' + carousel[1], replies=2)
+            elif action == 'edit':
+                self.edit(user_id, rng, max_id)
+
+    def report(self, elapsed):
+        total = sum(len(v) for v in self.latencies.values())
+        print("%-24s %8s %9s %9s %10s" % ('handler', 'count', 'p50 ms', 'p99 ms', 'updates/s'))
+        for handler, values in sorted(self.latencies.items()):
+            print("%-24s %8d %9.1f %9.1f %10.1f" % (handler, len(values),
+                                                     percentile(values, 50) * 1000,
+                                                     percentile(values, 99) * 1000,
+                                                     len(values) / elapsed))
+        print("%-24s %8d %30.1f" % ('total', total, total / elapsed))
+
+
+def sample_queries(path, count=500, seed=2):
+    """ Realistic queries: names and phone numbers present in the data, plus misses """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    max_id = conn.execute('SELECT MAX(id) FROM Believer').fetchone()[0]
+
+    queries = []
+    for _ in range(count):
+        row = conn.execute('SELECT phone_nr, bank_name FROM Believer WHERE id = ?',
+                           (rng.randint(1, max_id),)).fetchone()
+        kind = rng.random()
+        if row and kind < 0.4:
+            queries.append(row[0])
+        elif row and kind < 0.8:
+            queries.append(rng.choice(row[1].split()))
+        else:
+            queries.append('nobody%d' % rng.randint(0, 10 ** 6))
+
+    conn.close()
+    return queries, max_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--db', default=None)
+    parser.add_argument('--users', type=int, default=16)
+    parser.add_argument('--admins', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=5000,
+                        help='user actions in total, each one or more updates')
+    args = parser.parse_args()
+
+    path = args.db or 'bench_%d.sqlite' % args.rows
+    if not os.path.exists(path):
+        print("Generating %d reports..." % args.rows)
+        # A separate process, as the database mapping can only be bound once
+        subprocess.check_call([sys.executable, os.path.join(os.path.dirname(__file__),
+                                                            'gen_data.py'),
+                               str(args.rows), path])
+
+    queries, max_id = sample_queries(path)
+
+    api = fake_api.FakeBotAPI().start()
+    # The bot resolves relative database paths against its own directory
+    os.environ['CEREBROS_DB'] = os.path.abspath(path)
+    os.environ['CEREBROS_API_URL'] = api.base_url
+    os.environ['CEREBROS_STATE_FILE'] = ''
+    # Virtual users act far faster than people; measure the handlers, not the rate limits
+    for name in ('OUTBOX_RATE', 'OUTBOX_CHAT_RATE', 'OUTBOX_CHAT_BURST', 'SEARCH_RATE',
+                 'SEARCH_BURST'):
+        os.environ.setdefault('CEREBROS_' + name, '1000000')
+
+    import credentials
+    import gen_data
+    credentials.TOKEN = TOKEN
+    credentials.BOTAN_TOKEN = None
+
+    import bot
+    logging.basicConfig(level=logging.WARNING)
+    bot.app.setup_database()
+
+    dispatcher = threading.Thread(target=bot.app.dispatcher.start, daemon=True)
+    dispatcher.start()
+
+    test = LoadTest(api, bot, queries)
+    logging.getLogger().addHandler(test.error_log)
+    per_user = max(args.requests // args.users, 1)
+    users = [threading.Thread(target=test.run_user,
+                              args=(user_id, user_id in gen_data.ADMIN_IDS, per_user, user_id,
+                                    max_id))
+             for user_id in itertools.chain(list(gen_data.ADMIN_IDS)[:args.admins],
+                                            range(NON_ADMIN_ID_BASE,
+                                                  NON_ADMIN_ID_BASE + args.users - args.admins))]
+
+    started = time.monotonic()
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.monotonic() - started
+
+    bot.app.dispatcher.stop()
+    api.stop()
+
+    if test.failures:
+        for failure in test.failures:
+            print(failure, file=sys.stderr)
+        sys.exit("Load test failed: %d errors" % len(test.failures))
+
+    print("%d reports, %d users, %.1f s" % (max_id, args.users, elapsed))
+    test.report(elapsed)
+
+
+if __name__ == '__main__':
+    main()
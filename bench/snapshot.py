@@ -0,0 +1,81 @@
+"""
+Compare searches served by the in-memory read snapshot with SQLite.
+
+    python bench/snapshot.py --rows 100000
+
+Generates a database of --rows reports (or uses --db), loads the snapshot
+and reports its load time and memory use per 100k reports, then runs the
+same sampled queries through search_index and the snapshot and prints the
+median and p99 latency of each. Ranked name searches are not served by the
+snapshot and are left out.
+"""
+import argparse
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from loadtest import percentile, sample_queries
+
+
+def timed(func, queries):
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        func(query)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--db', default=None)
+    parser.add_argument('--queries', type=int, default=500)
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.db or os.path.join(tempfile.mkdtemp(), 'snapshot.sqlite'))
+    if not os.path.exists(path):
+        subprocess.check_call([sys.executable, os.path.join(ROOT, 'bench', 'gen_data.py'),
+                               str(args.rows), path])
+
+    import search_index
+    from admin import Admin
+    from reporter import Reporter
+    from database import db, read_session
+    from read_snapshot import snapshot
+
+    logging.basicConfig(level=logging.INFO)
+    db.bind('sqlite', path)
+    db.generate_mapping(check_tables=False)
+
+    started = time.perf_counter()
+    snapshot.load()
+    loaded = time.perf_counter() - started
+    memory = snapshot.memory_usage()
+
+    queries = [search_index.normalize_query(q)
+               for q in sample_queries(path, args.queries)[0]]
+
+    print("%d reports, loaded in %.0f ms, %.1f MB (%.1f MB per 100k reports)"
+          % (len(snapshot), loaded * 1000, memory / 1e6,
+             memory / 1e6 * 100000 / max(len(snapshot), 1)))
+    print("%-12s %-10s %9s %9s" % ('lookup', 'source', 'p50 ms', 'p99 ms'))
+
+    with read_session:
+        for source in (search_index, snapshot):
+            timings = timed(source.search_ids, queries)
+            print("%-12s %-10s %9.3f %9.3f" % (
+                'search_ids', 'sqlite' if source is search_index else 'snapshot',
+                statistics.median(timings) * 1000, percentile(timings, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Measure how long the bot takes to start.
+
+    python bench/startup.py --rows 100000
+
+Each step runs in a fresh interpreter, --repeat times, and the median is
+reported:
+
+- import:  importing bot.py, which must not touch the database or network
+- fresh:   setting up an empty database (tables, migrations, admin seed)
+- warm:    setting up an up to date database of --rows reports
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child interpreter; prints the timings as JSON
+_CHILD = r'''
+import json, os, sys, time
+
+started = time.perf_counter()
+import bot
+imported = time.perf_counter()
+
+timings = {'import': imported - started,
+           'db_created_on_import': os.path.exists(os.environ['CEREBROS_DB'])}
+
+if sys.argv[1] == 'setup':
+    bot.app.setup_database()
+    timings['setup'] = time.perf_counter() - imported
+
+print(json.dumps(timings))
+'''
+
+
+def run_child(db_path, step):
+    env = dict(os.environ, CEREBROS_DB=db_path, CEREBROS_STATE_FILE='')
+    out = subprocess.check_output([sys.executable, '-c', _CHILD, step], cwd=ROOT, env=env)
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def median_ms(values):
+    return statistics.median(values) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    warm_path = os.path.join(tmp, 'warm.sqlite')
+    subprocess.check_call([sys.executable, os.path.join(ROOT, 'bench', 'gen_data.py'),
+                           str(args.rows), warm_path])
+    # Apply whatever setup_database adds on top of the generated schema once
+    run_child(warm_path, 'setup')
+
+    imports, fresh, warm = [], [], []
+    for i in range(args.repeat):
+        timings = run_child(os.path.join(tmp, 'unused-%d.sqlite' % i), 'import')
+        if timings['db_created_on_import']:
+            sys.exit("Importing bot.py created the database")
+        imports.append(timings['import'])
+
+        fresh.append(run_child(os.path.join(tmp, 'fresh-%d.sqlite' % i), 'setup')['setup'])
+        warm.append(run_child(warm_path, 'setup')['setup'])
+
+    print("import  %8.1f ms" % median_ms(imports))
+    print("fresh   %8.1f ms" % median_ms(fresh))
+    print("warm    %8.1f ms  (%d reports)" % (median_ms(warm), args.rows))
+
+
+if __name__ == '__main__':
+    main()
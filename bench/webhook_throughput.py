@@ -0,0 +1,168 @@
+"""
+Compare update throughput and latency of long polling and the built-in webhook server.
+
+    python bench/webhook_throughput.py --updates 2000 --senders 16
+
+Both modes run against a local fake Bot API with a handler that echoes every
+message, so the numbers reflect update transport and dispatch, not Telegram.
+In both, --senders threads hand over one update at a time, to getUpdates'
+queue for polling or as an HTTP POST to the webhook server, and wait for its
+reply before the next. The latency of an update is measured from handing it
+over until its reply reached the fake API.
+
+Senders keep their connection to the webhook server alive, as Telegram does.
+--no-keep-alive opens a new connection per update instead, which adds a TCP
+handshake and a new server thread to every update.
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.ext import Updater, MessageHandler, Filters
+
+import fake_api
+from webhook import WebhookServer
+
+TOKEN = '123:bench'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def reply_timeout(count):
+    """ Time to wait for the replies to count updates, generous even for slow machines """
+    return 30 + count * 0.1
+
+
+def echo(bot, update):
+    update.message.reply_text(update.message.text)
+
+
+def make_updater(api):
+    updater = Updater(TOKEN, base_url=api.base_url, workers=4)
+    updater.dispatcher.add_handler(MessageHandler([Filters.text], echo))
+    return updater
+
+
+def make_updates(api, count):
+    return [{'update_id': api.next_update_id(),
+             'message': fake_api.message(i + 1, 1000 + i % 50, 'hello %d' % i)}
+            for i in range(count)]
+
+
+def run(api, count, senders, send):
+    """
+    Hand count updates to send() from senders threads, each waiting for the
+    reply to its update before sending the next. Returns updates per second
+    and the latency of each update.
+    """
+    updates = make_updates(api, count)
+    replied = {update['message']['text']: threading.Event() for update in updates}
+    latencies = []
+
+    def on_reply(method, params):
+        replied[params['text']].set()
+
+    def deliver(update):
+        sent = time.monotonic()
+        send(update)
+        if not replied[update['message']['text']].wait(reply_timeout(1)):
+            raise TimeoutError('no reply to update %d' % update['update_id'])
+        latencies.append(time.monotonic() - sent)
+
+    api.on_reply = on_reply
+    started = time.monotonic()
+    with ThreadPoolExecutor(senders) as pool:
+        list(pool.map(deliver, updates))
+    elapsed = time.monotonic() - started
+
+    return count / elapsed, latencies
+
+
+def bench_polling(count, senders):
+    api = fake_api.FakeBotAPI().start()
+    updater = make_updater(api)
+
+    try:
+        updater.start_polling(poll_interval=0, timeout=10)
+        return run(api, count, senders, lambda update: api.push([update]))
+
+    finally:
+        updater.stop()
+        api.stop()
+
+
+def bench_webhook(count, senders, keep_alive=True):
+    api = fake_api.FakeBotAPI().start()
+    updater = make_updater(api)
+    server = WebhookServer(updater.bot, updater.update_queue, '127.0.0.1', 0, TOKEN)
+    server.start()
+    updater.running = True
+    updater.httpd = server
+    updater._init_thread(updater.dispatcher.start, "dispatcher")
+
+    connections = threading.local()
+
+    def send(update):
+        body = json.dumps(update).encode()
+        # Like Telegram, retry deliveries the server pushed back on
+        while True:
+            if not keep_alive or not hasattr(connections, 'http'):
+                connections.http = http.client.HTTPConnection('127.0.0.1', server.port)
+            try:
+                connections.http.request('POST', '/' + TOKEN, body,
+                                         {'Content-Type': 'application/json'})
+                response = connections.http.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                del connections.http
+                time.sleep(0.05)
+                continue
+            finally:
+                if not keep_alive and hasattr(connections, 'http'):
+                    connections.http.close()
+
+            if response.status == 200:
+                return
+            time.sleep(0.05)
+
+    try:
+        return run(api, count, senders, send)
+
+    finally:
+        updater.stop()
+        api.stop()
+
+
+def report(name, result):
+    rate, latencies = result
+    print("%-24s %9.1f %9.2f %9.2f" % (name, rate, percentile(latencies, 50) * 1000,
+                                        percentile(latencies, 99) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--senders', type=int, default=16,
+                        help='threads handing over updates, one at a time each')
+    parser.add_argument('--no-keep-alive', dest='keep_alive', action='store_false',
+                        help='open a new connection to the webhook server per update')
+    args = parser.parse_args()
+
+    print("%-24s %9s %9s %9s" % ('mode', 'updates/s', 'p50 ms', 'p99 ms'))
+    report('polling', bench_polling(args.updates, args.senders))
+    report('webhook' + ('' if args.keep_alive else ' (no keep-alive)'),
+           bench_webhook(args.updates, args.senders, args.keep_alive))
+
+
+if __name__ == '__main__':
+    main()
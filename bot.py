@@ -1,18 +1,36 @@
 import logging
+import os
+import tempfile
+import time
 from datetime import datetime
-from io import BytesIO, BufferedReader
 
-from telegram.ext import Updater, CommandHandler, RegexHandler, \
-    MessageHandler, Filters, CallbackQueryHandler, ConversationHandler
+from telegram.ext import CommandHandler, RegexHandler, \
+    MessageHandler, Filters, CallbackQueryHandler, ConversationHandler, InlineQueryHandler
 from telegram.ext.dispatcher import run_async
 from telegram import ParseMode, ReplyKeyboardMarkup, ReplyKeyboardHide, \
-    ChatAction, ForceReply, InlineKeyboardMarkup, InlineKeyboardButton, Emoji
-from telegram.utils.botan import Botan
-from pony.orm import db_session, select, desc
-
-from credentials import TOKEN, BOTAN_TOKEN
-from start_bot import start_bot
-from database import db
+    ChatAction, ForceReply, InlineKeyboardMarkup, InlineKeyboardButton, Emoji, \
+    InlineQueryResultArticle, InputTextMessageContent
+from pony.orm import select
+
+from application import Application
+from database import db, read_session, write_session
+from config import CONCURRENT_HANDLERS, EXPORT_FORMAT, LOG_LEVEL, INLINE_PAGE_SIZE, \
+    INLINE_CACHE_TIME, SEARCH_RATE, SEARCH_BURST
+import duplicates
+import importer
+import metrics
+import search_index
+from export import iter_search_results, write_results, write_changes
+from changelog import ChangesPruned
+from search_index import normalize_query
+from query_cache import cache as query_cache
+from sessions import SearchSession, search_sessions
+from drafts import ReportDraft
+from identity import identities
+from prefix_index import typeahead
+from read_snapshot import snapshot
+from votes import votes
+from throttle import RateLimiter
 
 from admin import Admin
 from believer import Believer
@@ -37,36 +55,21 @@ _grid = [[options[ACCOUNT_NR]],
          ['/cancel']]
 
 CAT_KEYBOARD = ReplyKeyboardMarkup(_grid, selective=True)
-DB_NAME = 'bot.sqlite'
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-u = Updater(TOKEN)
-dp = u.dispatcher
-
-db.bind('sqlite', DB_NAME, create_db=True)
-db.generate_mapping(create_tables=True)
+# Searches per user, so that no single user can keep the database busy
+search_limiter = RateLimiter(SEARCH_RATE, SEARCH_BURST)
 
-with db_session:
-    if len(select(a for a in Admin if a.id is 10049375)) is 0:
-        # Create initial admin account
-        Admin(id=10049375, first_name="Jannes", super_admin=True)
-    if len(select(a for a in Admin if a.id is 46348706)) is 0:
-        # Create initial admin account
-        Admin(id=46348706, first_name="Jackson", super_admin=True)
-        # pass
+SLOW_DOWN = "You are searching too fast, please wait a few seconds."
 
-botan = False
-if BOTAN_TOKEN:
-    botan = Botan(BOTAN_TOKEN)
+BUSY = "Still working on your previous message, please send this one again in a moment."
 
 help_text = "This bot keeps a database of known trustworthy bitcoin traders by recording " \
             "their phone number, bank account number and name.\n\n" \
             "<b>Usage:</b>\n" \
-            "/search - Search the database for reports\n\n" \
+            "/search - Search the database for reports\n" \
+            "Or type my username and a phone number, Telegram ID or name in any chat\n\n" \
             "Donations via BTC are welcome: 1EPu17mBM2zw4LcupURgwsAuFeKQrTa1jy"
 
 admin_help_text = "\n\n" \
@@ -74,13 +77,35 @@ admin_help_text = "\n\n" \
                   "/new - Add a new trusted trader\n" \
                   "/edit - Edit an existing trusted trader\n" \
                   "/delete - Delete a trusted trader\n" \
+                  "/import - Import trusted traders from a CSV or JSON file\n" \
+                  "/done - Save the report being added or edited\n" \
+                  "/merge N - Merge the report being added or edited into report N\n" \
                   "/cancel - Cancel current operation"
 
 super_admin_help_text = "\n\n" \
                         "<b>Super Admin commands:</b>\n" \
                         "/add_admin - Register a new admin\n" \
                         "/remove_admin - Remove an admin\n" \
-                        "/download_database - Download complete database"
+                        "/download_database - Download complete database\n" \
+                        "/changes N - Download the changes after change number N\n" \
+                        "/stats - Show search cache statistics"
+
+
+def concurrent(func):
+    """
+    Record the handler's metrics and run it on the dispatcher's worker pool
+    when concurrent mode is on
+    """
+    func = metrics.instrumented(func)
+    return run_async(func) if CONCURRENT_HANDLERS else func
+
+
+def busy(bot, update):
+    """
+    Answers a user whose previous step of a conversation is still running.
+    Runs on the dispatcher thread, which must never wait for a worker.
+    """
+    update.message.reply_text(BUSY)
 
 
 def error(bot, update, error):
@@ -88,7 +113,7 @@ def error(bot, update, error):
     logger.exception(error)
 
 
-@db_session
+@concurrent
 def help(bot, update):
     """ Handler for the /help command """
     from_user = update.message.from_user
@@ -105,30 +130,74 @@ def help(bot, update):
 
 
 def get_admin(from_user):
-    admin = Admin.get(id=from_user.id)
-    if admin:
-        admin.first_name = from_user.first_name
-        admin.last_name = from_user.last_name
-        admin.username = from_user.username
-    return admin
+    """ Role of from_user if they are an admin, answered from the identity cache """
+    return identities.role(from_user)
 
 
 def get_reporter(from_user):
-    reporter = Reporter.get(id=from_user.id)
-    if reporter:
-        reporter.first_name = from_user.first_name
-        reporter.last_name = from_user.last_name
-        reporter.username = from_user.username
-    return reporter
+    identities.seen(Reporter, from_user)
+    return Reporter.get(id=from_user.id)
+
+
+def load_believers(ids):
+    """ Fetch the reports with the given ids in one query, keeping their order """
+    loaded = {b.id: b for b in select(b for b in Believer if b.id in ids)}
+    return [loaded[i] for i in ids if i in loaded]
+
+
+def searcher():
+    """
+    The in-memory snapshot once it is loaded, otherwise the database search.
+    Ranked name searches always use search_index.ranked_ids.
+    """
+    return snapshot if snapshot.loaded else search_index
+
+
+def find_ids(search, query, *args, **kwargs):
+    """ Run one of the search_index lookups, answering from the query cache if possible """
+    key = (search.__name__, query, args, tuple(sorted(kwargs.items())))
+    generation = query_cache.generation
+    ids = query_cache.get(key)
+
+    if ids is None:
+        ids = search(query, *args, **kwargs)
+        query_cache.put(key, query, ids, generation)
+
+    return ids
+
+
+def believer_changed(believer, old_values=()):
+    """ Commit a write to a report and evict the search results it affects """
+    believer.touch()
+    db.commit()
+    # The snapshot first, so a search that starts after the invalidation sees the write
+    snapshot.changed(believer.id)
+    query_cache.invalidate(believer.id, tuple(old_values) + believer.search_values())
+    typeahead.refresh(believer.id, believer.phone_nr, believer.account_nr, believer.bank_name)
+
+
+def merge_reports(keeper_id, source_id):
+    """ Fold a report into another and evict both from the caches. Returns whether the other exists """
+    values = duplicates.merge(keeper_id, [source_id])
+    if values is None:
+        return False
+
+    snapshot.changed(source_id)
+    snapshot.changed(keeper_id)
+    query_cache.clear()
+    typeahead.remove(source_id)
+    typeahead.refresh(keeper_id, values['phone_nr'], values['account_nr'], values['bank_name'])
+    return True
 
 
-@run_async
 def track(update, event_name):
-    if botan:
-        botan.track(message=update.message, event_name=event_name)
+    """ Queue an analytics event, delivered in the background """
+    message = update.message or (update.callback_query and update.callback_query.message)
+    if app.analytics and message:
+        app.analytics.track(message, event_name)
 
 
-@db_session
+@concurrent
 def add_believer(bot, update):
     admin = get_admin(update.message.from_user)
 
@@ -141,34 +210,21 @@ def add_believer(bot, update):
     return ADD
 
 
-@db_session
+@concurrent
 def add_believer_2(bot, update, user_data):
     forward_from = update.message.forward_from
-    reporter = get_reporter(forward_from)
-
-    if not reporter:
-        reporter = Reporter(id=forward_from.id,
-                            first_name=forward_from.first_name,
-                            last_name=forward_from.last_name,
-                            username=forward_from.username)
-        track(update, 'new_reporter')
-
-    believer = Believer(added_by=get_admin(update.message.from_user))
-    believer.reported_by.add(reporter)
-    track(update, 'new_report')
-    db.commit()
+
+    user_data['draft'] = ReportDraft(reporter=(forward_from.id, forward_from.first_name,
+                                               forward_from.last_name, forward_from.username))
 
     update.message.reply_text(
-        "Created report <b>#%d</b>! Please enter trustworthy bitcoin trader information:"
-        % believer.id,
-        reply_markup=CAT_KEYBOARD,
-        parse_mode=ParseMode.HTML)
+        "New report! Please enter trustworthy bitcoin trader information:",
+        reply_markup=CAT_KEYBOARD)
 
-    user_data['id'] = believer.id
     return EDIT
 
 
-@db_session
+@concurrent
 def remove_believer(bot, update):
     admin = get_admin(update.message.from_user)
 
@@ -182,7 +238,8 @@ def remove_believer(bot, update):
     return REMOVE
 
 
-@db_session
+@concurrent
+@write_session
 def remove_believer_2(bot, update):
     try:
         report_id = int(update.message.text.replace('#', ''))
@@ -192,7 +249,12 @@ def remove_believer_2(bot, update):
     else:
         believer = Believer.get(id=report_id)
         if believer:
+            old_values = believer.search_values()
             believer.delete()
+            db.commit()
+            snapshot.changed(report_id)
+            query_cache.invalidate(report_id, old_values)
+            typeahead.remove(report_id)
             update.message.reply_text("Deleted report!")
             return ConversationHandler.END
         else:
@@ -201,10 +263,10 @@ def remove_believer_2(bot, update):
                 reply_markup=ForceReply(selective=True))
 
 
+@concurrent
 def edit_believer(bot, update):
-    global state
-    with db_session:
-        admin = get_admin(update.message.from_user)
+    admin = get_admin(update.message.from_user)
+
     if not admin:
         return ConversationHandler.END
 
@@ -215,7 +277,8 @@ def edit_believer(bot, update):
     return WAIT
 
 
-@db_session
+@concurrent
+@read_session
 def edit_believer_2(bot, update, user_data):
     try:
         believer_id = int(update.message.text.replace('#', ''))
@@ -231,7 +294,7 @@ def edit_believer_2(bot, update, user_data):
                 "%s\n\nPlease enter new trustworthy bitcoin trader information:" % str(believer),
                 reply_markup=CAT_KEYBOARD)
 
-            user_data['id'] = believer.id
+            user_data['draft'] = ReportDraft(believer.id)
             return EDIT
 
         else:
@@ -239,7 +302,7 @@ def edit_believer_2(bot, update, user_data):
                 "Could not find report number. Try again or use /cancel to abort.")
 
 
-@db_session
+@concurrent
 def select_option(bot, update, user_data):
     option = options[update.message.text]
     user_data['option'] = option
@@ -254,69 +317,219 @@ def select_option(bot, update, user_data):
     return option
 
 
-@db_session
-def edit_phone_nr(bot, update, user_data):
-    believer = Believer.get(id=user_data['id'])
-    believer.phone_nr = update.message.text
+@read_session
+def warn_duplicates(update, draft, field, value):
+    """ Tell the admin about other reports with the same phone number, Telegram ID or name """
+    ids = duplicates.find_duplicates(field, value, exclude=draft.believer_id)
+
+    if ids:
+        update.message.reply_text(
+            "<b>Already reported</b> with this %s: %s\n"
+            "Send /merge %d to merge this report into #%d when saving."
+            % (duplicates.FIELD_NAMES[field], ', '.join('#%d' % i for i in ids), ids[0], ids[0]),
+            parse_mode=ParseMode.HTML)
 
-    update.message.reply_text("Add more info or send /cancel if you're done.",
-                              reply_markup=CAT_KEYBOARD)
 
+def draft_changed(update):
+    update.message.reply_text("Add more info, send /done to save or /cancel to discard.",
+                              reply_markup=CAT_KEYBOARD)
     return EDIT
 
 
-@db_session
-def edit_account_nr(bot, update, user_data):
-    believer = Believer.get(id=user_data['id'])
-    believer.account_nr = update.message.text
+@concurrent
+def edit_phone_nr(bot, update, user_data):
+    user_data['draft'].set('phone_nr', update.message.text)
+    warn_duplicates(update, user_data['draft'], 'phone_nr', update.message.text)
+    return draft_changed(update)
 
-    update.message.reply_text("Add more info or send /cancel if you're done.",
-                              reply_markup=CAT_KEYBOARD)
 
-    return EDIT
+@concurrent
+def edit_account_nr(bot, update, user_data):
+    user_data['draft'].set('account_nr', update.message.text)
+    warn_duplicates(update, user_data['draft'], 'account_nr', update.message.text)
+    return draft_changed(update)
 
 
-@db_session
+@concurrent
 def edit_bank_name(bot, update, user_data):
-    believer = Believer.get(id=user_data['id'])
-    believer.bank_name = update.message.text
+    user_data['draft'].set('bank_name', update.message.text)
+    warn_duplicates(update, user_data['draft'], 'bank_name', update.message.text)
+    return draft_changed(update)
 
-    update.message.reply_text("Add more info or send /cancel if you're done.",
-                              reply_markup=CAT_KEYBOARD)
 
-    return EDIT
+@concurrent
+def edit_remark(bot, update, user_data):
+    user_data['draft'].set('remark', update.message.text)
+    return draft_changed(update)
 
 
-@db_session
-def edit_remark(bot, update, user_data):
-    believer = Believer.get(id=user_data['id'])
-    believer.remark = update.message.text
+@concurrent
+def edit_attachment(bot, update, user_data):
+    if update.message.photo:
+        user_data['draft'].set('attached_file', 'photo:' + update.message.photo[-1].file_id)
+    elif update.message.document:
+        user_data['draft'].set('attached_file', 'document:' + update.message.document.file_id)
+
+    return draft_changed(update)
+
+
+@write_session
+def save_draft(update, draft):
+    """
+    Write a draft in a single transaction, creating the report and its
+    reporter if needed. Returns the report's id, or None if it was deleted
+    in the meantime.
+    """
+    if draft.believer_id is None:
+        reporter_id, first_name, last_name, username = draft.reporter
+        reporter = Reporter.get(id=reporter_id)
+
+        if not reporter:
+            reporter = Reporter(id=reporter_id,
+                                first_name=first_name,
+                                last_name=last_name or '',
+                                username=username or '')
+            identities.created(reporter)
+            track(update, 'new_reporter')
+
+        believer = Believer(added_by=Admin[update.message.from_user.id])
+        track(update, 'new_report')
+        believer.add_voter(reporter)
+        old_values = ()
 
-    update.message.reply_text("Add more info or send /cancel if you're done.",
-                              reply_markup=CAT_KEYBOARD)
+    else:
+        believer = Believer.get(id=draft.believer_id)
+        if not believer:
+            return None
+        old_values = believer.search_values()
 
-    return EDIT
+    draft.apply(believer)
+    believer_changed(believer, old_values)
+    return believer.id
 
 
-@db_session
-def edit_attachment(bot, update, user_data):
-    believer = Believer.get(id=user_data['id'])
+@concurrent
+@read_session
+def merge_believer(bot, update, user_data, args):
+    draft = user_data.get('draft')
 
-    if update.message.photo:
-        believer.attached_file = \
-            'photo:' + update.message.photo[-1].file_id
-    elif update.message.document:
-        believer.attached_file = \
-            'document:' + update.message.document.file_id
+    if draft is None:
+        update.message.reply_text("Nothing to merge")
+        return
 
-    update.message.reply_text("Add more info or send /cancel if you're done.",
-                              reply_markup=CAT_KEYBOARD)
+    if len(args) != 1 or not args[0].lstrip('#').isdigit():
+        update.message.reply_text("Usage: /merge N, where N is the report to merge this one into")
+        return
 
-    return EDIT
+    keeper_id = int(args[0].lstrip('#'))
+    if keeper_id == draft.believer_id or not Believer.exists(id=keeper_id):
+        update.message.reply_text("Could not find report number. Try again or use /cancel to abort.")
+        return
+
+    user_data['merge_into'] = keeper_id
+    update.message.reply_text("This report will be merged into <b>#%d</b> when you send /done."
+                              % keeper_id, parse_mode=ParseMode.HTML)
+
+
+@concurrent
+def done(bot, update, user_data):
+    draft = user_data.pop('draft', None)
+    user_data.pop('option', None)
+    merge_into = user_data.pop('merge_into', None)
+
+    if draft is None:
+        update.message.reply_text("Nothing to save", reply_markup=ReplyKeyboardHide())
+        return ConversationHandler.END
+
+    believer_id = save_draft(update, draft)
+
+    if believer_id is None:
+        update.message.reply_text("This report was deleted in the meantime",
+                                  reply_markup=ReplyKeyboardHide())
+    elif merge_into and merge_reports(merge_into, believer_id):
+        update.message.reply_text("Saved and merged report into <b>#%d</b>" % merge_into,
+                                  reply_markup=ReplyKeyboardHide(),
+                                  parse_mode=ParseMode.HTML)
+    elif merge_into:
+        update.message.reply_text("Saved report <b>#%d</b>, report #%d to merge it into was "
+                                  "deleted in the meantime" % (believer_id, merge_into),
+                                  reply_markup=ReplyKeyboardHide(),
+                                  parse_mode=ParseMode.HTML)
+    else:
+        update.message.reply_text("Saved report <b>#%d</b>" % believer_id,
+                                  reply_markup=ReplyKeyboardHide(),
+                                  parse_mode=ParseMode.HTML)
+
+    return ConversationHandler.END
+
+
+@concurrent
+def import_believers(bot, update):
+    admin = get_admin(update.message.from_user)
+
+    if not admin:
+        return ConversationHandler.END
+
+    update.message.reply_text(
+        "Send me a CSV or JSON file of reports to import or send /cancel to cancel.\n\n"
+        "Fields: phone_nr, account_nr, bank_name, remark, created, and optionally "
+        "reporter_id, reporter_first_name, reporter_last_name and reporter_username "
+        "of the user that reported the trader.")
+
+    return ADD
+
+
+@metrics.instrumented
+def import_believers_2(bot, update):
+    """
+    Ends the conversation right away and leaves the import to a worker, so
+    the admin's next messages are not held up while it runs
+    """
+    run_import(bot, update)
+    return ConversationHandler.END
+
+
+@run_async
+def run_import(bot, update):
+    """ Always runs on the worker pool, as an import can take a while """
+    document = update.message.document
+    chat_id = update.message.chat_id
+
+    status = update.message.reply_text("Importing %s..." % (document.file_name or 'file'))
+    last_update = [time.monotonic()]
+
+    def progress(result):
+        now = time.monotonic()
+        if now - last_update[0] >= importer.PROGRESS_INTERVAL:
+            last_update[0] = now
+            bot.editMessageText(chat_id=chat_id, message_id=status.message_id,
+                                text=importer.describe(result))
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    try:
+        bot.getFile(document.file_id).download(path)
+
+        with open(path, 'rb') as file:
+            fmt = importer.detect_format(document.file_name, file.read(64))
+            file.seek(0)
+            result, created_reporters = importer.import_reports(
+                file, fmt, update.message.from_user.id, progress)
+
+    finally:
+        os.remove(path)
+
+    for reporter_id in created_reporters:
+        identities.forget(reporter_id)
+
+    bot.editMessageText(chat_id=chat_id, message_id=status.message_id,
+                        text=importer.describe(result, done=True))
+    track(update, 'import')
 
-@db_session
+
+@concurrent
 def add_admin(bot, update):
-    global state
     admin = get_admin(update.message.from_user)
 
     if not admin or not admin.super_admin:
@@ -328,16 +541,19 @@ def add_admin(bot, update):
     return ADD
 
 
-@db_session
+@concurrent
+@write_session
 def add_admin_2(bot, update):
     forward_from = update.message.forward_from
     admin = get_admin(forward_from)
 
     if not admin:
-        Admin(id=forward_from.id,
-              first_name=forward_from.first_name,
-              last_name=forward_from.last_name,
-              username=forward_from.username)
+        admin = Admin(id=forward_from.id,
+                      first_name=forward_from.first_name,
+                      last_name=forward_from.last_name,
+                      username=forward_from.username)
+        db.commit()
+        identities.created(admin)
         update.message.reply_text("Successfully added admin")
 
     else:
@@ -346,7 +562,7 @@ def add_admin_2(bot, update):
     return ConversationHandler.END
 
 
-@db_session
+@concurrent
 def remove_admin(bot, update):
     admin = get_admin(update.message.from_user)
 
@@ -359,22 +575,31 @@ def remove_admin(bot, update):
     return ADD
 
 
-@db_session
+@concurrent
+@write_session
 def remove_admin_2(bot, update):
-    admin = get_admin(update.message.forward_from)
+    admin = Admin.get(id=update.message.forward_from.id)
 
     if admin and not admin.super_admin:
         admin.delete()
+        db.commit()
+        identities.forget(update.message.forward_from.id)
         update.message.reply_text("Successfully removed admin")
     else:
         update.message.reply_text("This user is not an admin")
 
 
-def cancel(bot, update):
+@concurrent
+def cancel(bot, update, user_data):
+    # Unsaved changes to a report are discarded
+    user_data.pop('draft', None)
+    user_data.pop('option', None)
+    user_data.pop('merge_into', None)
     update.message.reply_text("Current operation canceled", reply_markup=ReplyKeyboardHide())
     return ConversationHandler.END
 
 
+@concurrent
 def search(bot, update, user_data):
     user_data['search_time'] = datetime.now()
 
@@ -383,39 +608,36 @@ def search(bot, update, user_data):
     return WAIT
 
 
-@db_session
+@concurrent
+@read_session
 def search_2(bot, update, user_data):
     issued = user_data['search_time']
     if (datetime.now() - issued).seconds > 30:
         update.message.reply_text("Please send your /search query within 30 seconds.")
 
+    elif not search_limiter.allow(update.message.from_user.id):
+        update.message.reply_text(SLOW_DOWN)
+
     else:
-        text = update.message.text.replace('%', '')
-
-        believers = select(
-            s for s in Believer if
-            text in s.phone_nr or
-            text in s.account_nr or
-            text in s.bank_name or
-            text in s.remark
-        ).order_by(
-            desc(Believer.created)
-        )[0:1]
+        text = normalize_query(update.message.text)
+
+        ranked = search_index.is_name_query(text)
+        if ranked:
+            believers = load_believers(find_ids(search_index.ranked_ids, text)[:1])
+        else:
+            believers = load_believers(find_ids(searcher().search_ids, text))
 
         if believers:
             believer = believers[0]
-            reporter = get_reporter(update.message.from_user)
+            identities.seen(Reporter, update.message.from_user)
 
-            kb = search_keyboard(offset=0,
-                                 show_download=True,
-                                 disabled_attachments=[],
-                                 confirmed=reporter in believer.reported_by
-                                 if reporter
-                                 else False,
-                                 query=text)
+            session = SearchSession(text, believer.id,
+                                    believer.has_voter(update.message.from_user.id), ranked)
+            token = search_sessions.create(session)
 
             update.message.reply_text(str(believer),
-                                      reply_markup=InlineKeyboardMarkup(kb),
+                                      reply_markup=InlineKeyboardMarkup(
+                                          search_keyboard(token, session)),
                                       parse_mode=ParseMode.HTML)
 
         else:
@@ -426,65 +648,53 @@ def search_2(bot, update, user_data):
     return ConversationHandler.END
 
 
-@db_session
+@concurrent
+@read_session
 def callback_query(bot, update):
     cb = update.callback_query
     chat_id = cb.message.chat_id
 
     data = update.callback_query.data
 
-    logger.info(data)
-
-    data = data.split('%')
+    logger.debug(data)
 
     action = ''
-    offset = 0
-    disabled_attachments = set()
-    query = ''
-    confirmed = False
-    show_download = True
+    token = ''
 
-    for elem in data:
-        name, *args = elem.split('=')
+    for elem in data.split('%'):
+        name, _, value = elem.partition('=')
 
         if name == 'act':
-            action = args[0]
-        elif name == 'off':
-            offset = int(args[0])
-        elif name == 'noatt':
-            disabled_attachments = set(int(arg) for arg in args if arg != '')
-        elif name == 'qry':
-            query = '='.join(args)
-        elif name == 'cnf':
-            confirmed = bool(int(args[0]))
-        elif name == 'dl':
-            show_download = bool(int(args[0]))
-
-    reporter = get_reporter(cb.from_user)
-
-    if action == 'old':
-        new_offset = offset + 1
-    elif action == 'new':
-        new_offset = offset - 1
-    else:
-        new_offset = offset
+            action = value
+        elif name == 'sid':
+            token = value
 
-    try:
-        believers = select(
-            s for s in Believer if
-            query in s.phone_nr or
-            query in s.account_nr or
-            query in s.bank_name or
-            query in s.remark
-        ).order_by(
-            desc(Believer.created)
-        )[new_offset:new_offset + 1]
-
-    except TypeError:
-        believers = None
+    session = search_sessions.get(token)
+
+    if not session:
+        update.callback_query.answer("This search has expired, please /search again")
+        return
 
+    if action in ('old', 'new', 'dl') and not search_limiter.allow(cb.from_user.id):
+        update.callback_query.answer(SLOW_DOWN)
+        return
+
+    identities.seen(Reporter, cb.from_user)
+
+    # Name searches page through their ranking, others by (created, id)
+    # keyset relative to the currently shown report
+    if action in ('old', 'new') and session.ranked:
+        position = session.offset + (1 if action == 'old' else -1)
+        ranked = find_ids(search_index.ranked_ids, session.query)
+        ids = ranked[position:position + 1] if position >= 0 else []
+    elif action == 'old':
+        ids = find_ids(searcher().older_ids, session.query, session.cursor)
+    elif action == 'new':
+        ids = find_ids(searcher().newer_ids, session.query, session.cursor)
     else:
-        offset = new_offset
+        ids = [session.cursor]
+
+    believers = load_believers(ids)
 
     reply = None
 
@@ -493,10 +703,13 @@ def callback_query(bot, update):
             believer = believers[0]
             reply = str(believer)
 
+            session.offset += 1 if action == 'old' else -1
+            session.cursor = believer.id
+
             if not believer.attached_file:
-                disabled_attachments.add(offset)
+                session.disabled_attachments.add(session.offset)
 
-            confirmed = reporter in believer.reported_by if reporter else False
+            session.confirmed = believer.has_voter(cb.from_user.id)
 
         else:
             update.callback_query.answer("No more results")
@@ -508,21 +721,18 @@ def callback_query(bot, update):
             return
 
         believer = believers[0]
-        if not confirmed:
-            if not reporter:
-                reporter = Reporter(id=cb.from_user.id,
-                                    first_name=cb.from_user.first_name,
-                                    last_name=cb.from_user.last_name,
-                                    username=cb.from_user.username)
-                track(update, 'new_reporter')
+        # Written in the background with other votes; the card shows it right away
+        confirmed = votes.toggle(believer.id, cb.from_user,
+                                 lambda: believer.has_stored_voter(cb.from_user.id))
+        session.confirmed = confirmed
 
-            believer.reported_by.add(reporter)
+        if confirmed:
+            if not get_reporter(cb.from_user):
+                track(update, 'new_reporter')
             update.callback_query.answer("You confirmed this report.")
         else:
-            believer.reported_by.remove(reporter)
             update.callback_query.answer("You removed your confirmation.")
 
-        confirmed = not confirmed
         reply = str(believer)
 
     elif action == 'att':
@@ -539,32 +749,19 @@ def callback_query(bot, update):
             bot.sendDocument(chat_id, document=file_id,
                              reply_to_message_id=cb.message.message_id)
 
-        disabled_attachments.add(offset)
+        session.disabled_attachments.add(session.offset)
 
     elif action == 'dl':
         bot.sendChatAction(chat_id, action=ChatAction.UPLOAD_DOCUMENT)
 
-        with db_session:
-            believers = select(s for s in Believer if
-                              query in s.phone_nr or
-                              query in s.account_nr or
-                              query in s.bank_name or
-                              query in s.remark).limit(100)
-
-            content = "\r\n\r\n".join(str(s) for s in believers)
-
-        file = BytesIO(content.encode())
-        show_download = False
+        with write_results(iter_search_results(session.query), EXPORT_FORMAT) as file:
+            bot.sendDocument(chat_id, document=file,
+                             filename='search.' + EXPORT_FORMAT,
+                             reply_to_message_id=update.callback_query.message.message_id)
 
-        bot.sendDocument(chat_id, document=BufferedReader(file),
-                         filename='search.txt',
-                         reply_to_message_id=update.callback_query.message.message_id)
+        session.show_download = False
 
-    kb = search_keyboard(offset=offset, show_download=show_download,
-                         disabled_attachments=disabled_attachments, confirmed=confirmed,
-                         query=query)
-
-    reply_markup = InlineKeyboardMarkup(kb)
+    reply_markup = InlineKeyboardMarkup(search_keyboard(token, session))
 
     if reply:
         bot.editMessageText(chat_id=chat_id, message_id=cb.message.message_id, text=reply,
@@ -575,20 +772,50 @@ def callback_query(bot, update):
                                    reply_markup=reply_markup)
 
 
-def search_keyboard(offset, show_download, disabled_attachments, confirmed, query):
-    data = list()
-
-    data.append('dl=' + str(int(show_download)))
-
-    data.append('noatt=' + '='.join(str(da) for da in disabled_attachments))
+@concurrent
+@read_session
+def inline_search(bot, update):
+    """ Answer inline queries with the reports whose number, ID or name starts with the query """
+    inline_query = update.inline_query
 
-    data.append('cnf=' + str(int(confirmed)))
-
-    data.append('off=' + str(int(offset)))
+    if not search_limiter.allow(inline_query.from_user.id):
+        inline_query.answer([], cache_time=0, is_personal=True)
+        return
 
-    data.append('qry=' + query)
+    try:
+        offset = int(inline_query.offset or 0)
+    except ValueError:
+        offset = 0
 
-    data = '%'.join(data)
+    cache_time = INLINE_CACHE_TIME
+    if typeahead.loaded:
+        ids, next_offset = typeahead.lookup(inline_query.query, offset, INLINE_PAGE_SIZE)
+    else:
+        # The prefix index is still loading, search the reports containing the query
+        # instead, and keep Telegram from caching these results
+        cache_time = 0
+        query = normalize_query(inline_query.query)
+        ids = find_ids(searcher().search_ids, query, offset=offset,
+                       limit=INLINE_PAGE_SIZE) if query else []
+        next_offset = offset + len(ids) if len(ids) == INLINE_PAGE_SIZE else None
+
+    results = [
+        InlineQueryResultArticle(
+            id=str(believer.id),
+            title=believer.bank_name or believer.phone_nr or believer.account_nr or
+            'C#%d' % believer.id,
+            description=' '.join(v for v in (believer.phone_nr, believer.account_nr) if v),
+            input_message_content=InputTextMessageContent(str(believer),
+                                                          parse_mode=ParseMode.HTML))
+        for believer in load_believers(ids)]
+
+    # Results are the same for everyone, so Telegram may serve them to other users
+    inline_query.answer(results, cache_time=cache_time,
+                        next_offset='' if next_offset is None else str(next_offset))
+
+
+def search_keyboard(token, session):
+    data = 'sid=' + token
 
     kb = [[
         InlineKeyboardButton(
@@ -596,7 +823,7 @@ def search_keyboard(offset, show_download, disabled_attachments, confirmed, quer
             callback_data='act=old%' + data
         ),
         InlineKeyboardButton(
-            text=(Emoji.THUMBS_UP_SIGN) if not confirmed else
+            text=(Emoji.THUMBS_UP_SIGN) if not session.confirmed else
             ('Unliked'),
             callback_data='act=confirm%' + data
         ),
@@ -606,7 +833,7 @@ def search_keyboard(offset, show_download, disabled_attachments, confirmed, quer
         ),
     ], list()]
 
-#    if offset not in disabled_attachments:
+#    if session.offset not in session.disabled_attachments:
 #        kb[1].append(
 #            InlineKeyboardButton(
 #                text=Emoji.FLOPPY_DISK + ' Attachment',
@@ -614,7 +841,7 @@ def search_keyboard(offset, show_download, disabled_attachments, confirmed, quer
 #            )
 #        )
 
-#    if show_download:
+#    if session.show_download:
 #        kb[1].append(
 #            InlineKeyboardButton(
 #                text=Emoji.BLACK_DOWN_POINTING_DOUBLE_TRIANGLE + ' Download all',
@@ -624,25 +851,91 @@ def search_keyboard(offset, show_download, disabled_attachments, confirmed, quer
     return kb
 
 
-@db_session
+@concurrent
 def download_db(bot, update):
-    global state
     admin = get_admin(update.message.from_user)
 
     if not admin or not admin.super_admin:
         return
 
     update.message.chat.send_action(ChatAction.UPLOAD_DOCUMENT)
-    update.message.reply_document(open(DB_NAME, 'rb'), filename='trustworthy.sqlite')
 
+    with app.database_export.open_snapshot() as exported:
+        update.message.reply_document(exported, filename='trustworthy.sqlite.gz')
+
+
+@concurrent
+def download_changes(bot, update, args):
+    admin = get_admin(update.message.from_user)
+
+    if not admin or not admin.super_admin:
+        return
+
+    if len(args) != 1 or not args[0].isdigit():
+        update.message.reply_text("Usage: /changes N, where N is the last change number you have, "
+                                  "or 0 for all changes")
+        return
+
+    since = int(args[0])
+    update.message.chat.send_action(ChatAction.UPLOAD_DOCUMENT)
+
+    try:
+        changes, until, count = write_changes(app.db_name, since)
+    except ChangesPruned as e:
+        update.message.reply_text("Changes up to %d are no longer kept, please download the "
+                                  "database again with /download_database." % e.horizon)
+        return
+
+    with changes:
+        if not count:
+            update.message.reply_text("No changes after %d." % since)
+            return
+
+        update.message.reply_document(changes, filename='changes-%d-%d.jsonl.gz' % (since, until),
+                                      caption="%d changes, up to %d" % (count, until))
 
-# Add all handlers to the dispatcher and run the bot
-dp.add_handler(CommandHandler('start', help))
-dp.add_handler(CommandHandler('help', help))
-dp.add_handler(CallbackQueryHandler(callback_query))
-dp.add_handler(CommandHandler('download_database', download_db))
 
-cancel_handler = CommandHandler('cancel', cancel)
+@concurrent
+def stats(bot, update):
+    admin = get_admin(update.message.from_user)
+
+    if not admin or not admin.super_admin:
+        return
+
+    cache_stats = query_cache.stats()
+    lookups = cache_stats['hits'] + cache_stats['misses']
+    cache_stats['hit_rate'] = 100.0 * cache_stats['hits'] / lookups if lookups else 0.0
+
+    update.message.reply_text(
+        "<b>Search cache</b>\n"
+        "Hits: {hits}\n"
+        "Misses: {misses}\n"
+        "Hit rate: {hit_rate:.1f}%\n"
+        "Entries: {size}/{max_size}\n\n".format(**cache_stats) +
+        "<b>Outbox</b>\n"
+        "Queued: {queued}\n"
+        "Sent: {sent}\n"
+        "Coalesced edits: {coalesced}\n"
+        "Flood limit retries: {retried}\n"
+        "Failed: {failed}\n"
+        "Searches limited: {limited}".format(limited=search_limiter.limited,
+                                              **app.outbox.stats()) +
+        ("\n\n<b>Read snapshot</b>\n"
+         "Reports: %d\n"
+         "Memory: %.1f MB" % (len(snapshot), snapshot.memory_usage() / 1e6)
+         if snapshot.loaded else ""),
+        parse_mode=ParseMode.HTML)
+
+
+# Handlers of the conversations; registered on the dispatcher by install_handlers
+busy_handler = MessageHandler(None, busy)
+# Instead of waiting for a user's previous step that still runs on the worker
+# pool, which would hold up the updates of everyone else, the conversations
+# answer that user with busy_handler
+conversation_options = {'run_async_timeout': 0, 'timed_out_behavior': [busy_handler]}
+cancel_handler = CommandHandler('cancel', cancel, pass_user_data=True)
+done_handler = CommandHandler('done', done, pass_user_data=True)
+merge_handler = CommandHandler('merge', merge_believer, pass_user_data=True, pass_args=True)
 select_option_handler = MessageHandler([Filters.text], select_option, pass_user_data=True)
 edit_option_dict = {
     PHONE_NR: [MessageHandler([Filters.text], edit_phone_nr, pass_user_data=True)],
@@ -659,7 +952,8 @@ conv_add_admin = ConversationHandler(
     states={
         ADD: [MessageHandler([Filters.forwarded], add_admin_2)],
     },
-    fallbacks=[cancel_handler]
+    fallbacks=[cancel_handler],
+    **conversation_options
 )
 
 conv_remove_admin = ConversationHandler(
@@ -667,7 +961,8 @@ conv_remove_admin = ConversationHandler(
     states={
         REMOVE: [MessageHandler([Filters.forwarded], remove_admin_2)],
     },
-    fallbacks=[cancel_handler]
+    fallbacks=[cancel_handler],
+    **conversation_options
 )
 
 conv_search = ConversationHandler(
@@ -675,7 +970,17 @@ conv_search = ConversationHandler(
     states={
         WAIT: [MessageHandler([Filters.text], search_2, pass_user_data=True)],
     },
-    fallbacks=[cancel_handler]
+    fallbacks=[cancel_handler],
+    **conversation_options
+)
+
+conv_import = ConversationHandler(
+    entry_points=[CommandHandler('import', import_believers)],
+    states={
+        ADD: [MessageHandler([Filters.document], import_believers_2)],
+    },
+    fallbacks=[cancel_handler],
+    **conversation_options
 )
 
 conv_add_believer = ConversationHandler(
@@ -685,7 +990,8 @@ conv_add_believer = ConversationHandler(
         EDIT: [select_option_handler],
         **edit_option_dict,
     },
-    fallbacks=[cancel_handler]
+    fallbacks=[cancel_handler, done_handler, merge_handler],
+    **conversation_options
 )
 
 conv_remove_believer = ConversationHandler(
@@ -693,7 +999,8 @@ conv_remove_believer = ConversationHandler(
     states={
         REMOVE: [MessageHandler([Filters.forwarded], remove_believer_2, pass_user_data=True)],
     },
-    fallbacks=[cancel_handler]
+    fallbacks=[cancel_handler],
+    **conversation_options
 )
 
 conv_edit = ConversationHandler(
@@ -703,17 +1010,55 @@ conv_edit = ConversationHandler(
         EDIT: [select_option_handler],
         **edit_option_dict,
     },
-    fallbacks=[cancel_handler]
+    fallbacks=[cancel_handler, done_handler, merge_handler],
+    **conversation_options
 )
 
-dp.add_handler(conv_add_admin)
-dp.add_handler(conv_remove_admin)
-dp.add_handler(conv_edit)
-dp.add_handler(conv_search)
-dp.add_handler(conv_add_believer)
-dp.add_handler(conv_remove_believer)
 
-dp.addErrorHandler(error)
+def install_handlers(app):
+    """ Add all handlers to the dispatcher and keep conversation state in app's store """
+    dp = app.dispatcher
+
+    dp.add_handler(CommandHandler('start', help))
+    dp.add_handler(CommandHandler('help', help))
+    dp.add_handler(CallbackQueryHandler(callback_query))
+    dp.add_handler(InlineQueryHandler(inline_search))
+    dp.add_handler(CommandHandler('download_database', download_db))
+    dp.add_handler(CommandHandler('changes', download_changes, pass_args=True))
+    dp.add_handler(CommandHandler('stats', stats))
+
+    dp.add_handler(conv_add_admin)
+    dp.add_handler(conv_remove_admin)
+    dp.add_handler(conv_edit)
+    dp.add_handler(conv_search)
+    dp.add_handler(conv_add_believer)
+    dp.add_handler(conv_remove_believer)
+    dp.add_handler(conv_import)
+
+    # Conversations, user_data and search carousels survive restarts and are dropped when idle
+    app.conversation_state.attach(dp, {'add_admin': conv_add_admin,
+                                       'remove_admin': conv_remove_admin,
+                                       'edit': conv_edit,
+                                       'search': conv_search,
+                                       'add_believer': conv_add_believer,
+                                       'remove_believer': conv_remove_believer,
+                                       'import': conv_import})
+    app.conversation_state.add_store('search_sessions', search_sessions.sessions)
+
+    dp.addErrorHandler(error)
+
+
+# Nothing is set up before app is first used, see Application
+app = Application(install_handlers)
+
+
+def main():
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=LOG_LEVEL)
+
+    app.run()
+
 
-start_bot(u)
-u.idle()
+if __name__ == '__main__':
+    main()
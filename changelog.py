@@ -0,0 +1,171 @@
+from contextlib import contextmanager
+
+# Logged tables and the columns identifying their rows. Votes are rows of
+# Believer_Reporter, keyed by report and reporter.
+TABLES = {
+    'Believer': ('id',),
+    'Reporter': ('id',),
+    'Admin': ('id',),
+    'Believer_Reporter': ('believer', 'reporter'),
+}
+
+# Changed rows looked up per query when exporting
+ROW_BATCH_SIZE = 500
+
+# Sequence numbers pruned per transaction
+PRUNE_BATCH_SIZE = 10000
+
+# Append-only log of the rows changed by each insert, update and delete,
+# numbered by a sequence that only ever grows. Triggers fill it, so writes
+# through Pony, the importer and raw SQL are all recorded.
+_table = (
+    "CREATE TABLE IF NOT EXISTS ChangeLog ("
+    "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "name TEXT NOT NULL, "
+    "row_id INTEGER NOT NULL, "
+    "ref_id INTEGER, "
+    "op TEXT NOT NULL)"
+)
+
+
+def _triggers(tables=TABLES):
+    for table in sorted(tables):
+        key = TABLES[table]
+        events = [('i', 'INSERT', 'new'), ('u', 'UPDATE', 'new'), ('d', 'DELETE', 'old')]
+        if len(key) > 1:
+            # Link tables are only ever inserted into and deleted from
+            del events[1]
+
+        for op, event, row in events:
+            ref = '%s.%s' % (row, key[1]) if len(key) > 1 else 'NULL'
+            yield ("CREATE TRIGGER IF NOT EXISTS %s_log_%s AFTER %s ON %s BEGIN "
+                   "INSERT INTO ChangeLog(name, row_id, ref_id, op) "
+                   "VALUES ('%s', %s.%s, %s, '%s'); "
+                   "END" % (table, op, event, table, table, row, key[0], ref, op))
+
+
+class ChangesPruned(Exception):
+    """ The changes asked for start before what the log still keeps """
+
+    def __init__(self, horizon):
+        super(ChangesPruned, self).__init__("Changes up to %d are no longer kept" % horizon)
+        self.horizon = horizon
+
+
+def create(connection):
+    """ Create the change log and its triggers on a sqlite3 connection. Run as a schema migration. """
+    connection.execute(_table)
+    for statement in _triggers():
+        connection.execute(statement)
+
+
+def create_row_index(connection):
+    """ Index finding the entries of a row, for pruning. Run as a schema migration. """
+    connection.execute('CREATE INDEX IF NOT EXISTS ChangeLog_row '
+                       'ON ChangeLog (name, row_id, ref_id, seq)')
+
+
+@contextmanager
+def unlogged(connection, table):
+    """
+    Leave the changes to table made within out of the log, e.g. a schema
+    migration's backfill, which every copy of the database applies itself.
+    Use inside the migration's transaction.
+    """
+    prefix = '%s_log_' % table
+    existing = [row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND substr(name, 1, ?) = ?",
+        (len(prefix), prefix))]
+
+    for name in existing:
+        connection.execute('DROP TRIGGER "%s"' % name)
+    yield
+    if existing:
+        for statement in _triggers([table]):
+            connection.execute(statement)
+
+
+def last_seq(connection):
+    """ Sequence number of the latest change, 0 if there is none """
+    row = connection.execute('SELECT MAX(seq) FROM ChangeLog').fetchone()
+    return row[0] or 0
+
+
+def horizon(connection, keep):
+    """
+    Sequence number a delta must start from at least: only changes after the
+    last keep ones are kept, so earlier ones may already be pruned
+    """
+    return max(last_seq(connection) - keep, 0)
+
+
+def prune(connection, keep):
+    """
+    Delete the entries no delta needs: those up to the horizon, and those of
+    rows changed again later, which changes() skips anyway. Commits after
+    each batch of sequence numbers, so writers are not blocked for the whole
+    pass. Returns how many entries were deleted.
+    """
+    first, last = connection.execute('SELECT MIN(seq), MAX(seq) FROM ChangeLog').fetchone()
+    if first is None:
+        return 0
+
+    pruned = 0
+    for start in range(first - 1, last, PRUNE_BATCH_SIZE):
+        with connection:
+            pruned += connection.execute(
+                'DELETE FROM ChangeLog WHERE seq > ? AND seq <= ? AND (seq <= ? OR EXISTS ('
+                'SELECT 1 FROM ChangeLog AS later WHERE later.name = ChangeLog.name '
+                'AND later.row_id = ChangeLog.row_id AND later.ref_id IS ChangeLog.ref_id '
+                'AND later.seq > ChangeLog.seq))',
+                (start, start + PRUNE_BATCH_SIZE, horizon(connection, keep))).rowcount
+    return pruned
+
+
+def _rows(connection, table, keys):
+    """ Current rows of table with the given keys, as dicts by key tuple """
+    columns = TABLES[table]
+    first = sorted(set(key[0] for key in keys))
+
+    cursor = connection.execute('SELECT * FROM "%s" WHERE "%s" IN (%s)'
+                                % (table, columns[0], ', '.join('?' * len(first))), first)
+    names = [description[0] for description in cursor.description]
+
+    rows = {}
+    for values in cursor:
+        row = dict(zip(names, values))
+        rows[tuple(row[column] for column in columns)] = row
+    return rows
+
+
+def changes(connection, since, until):
+    """
+    Yield the rows changed after sequence number since up to until, each
+    once, in the order of their last change: a dict with the table, the
+    sequence number and either the row as it is now or, if it was deleted,
+    its key. Read within one transaction so the rows match until.
+    """
+    cursor = connection.execute(
+        'SELECT MAX(seq), name, row_id, ref_id FROM ChangeLog '
+        'WHERE seq > ? AND seq <= ? GROUP BY name, row_id, ref_id ORDER BY MAX(seq)',
+        (since, until))
+
+    while True:
+        batch = cursor.fetchmany(ROW_BATCH_SIZE)
+        if not batch:
+            return
+
+        keys = {}
+        for seq, table, row_id, ref_id in batch:
+            keys.setdefault(table, []).append((row_id,) if ref_id is None else (row_id, ref_id))
+        current = {table: _rows(connection, table, table_keys)
+                   for table, table_keys in keys.items()}
+
+        for seq, table, row_id, ref_id in batch:
+            key = (row_id,) if ref_id is None else (row_id, ref_id)
+            row = current[table].get(key)
+            if row is None:
+                yield {'seq': seq, 'table': table, 'op': 'delete',
+                       'key': dict(zip(TABLES[table], key))}
+            else:
+                yield {'seq': seq, 'table': table, 'op': 'upsert', 'row': row}
@@ -0,0 +1,91 @@
+# Runtime settings, overridable through environment variables so that
+# deployments do not need to edit source files
+import os
+
+
+def _env_bool(name, default):
+    return os.environ.get(name, '1' if default else '0').lower() in ('1', 'true', 'yes', 'on')
+
+
+DB_NAME = os.environ.get('CEREBROS_DB', 'bot.sqlite')
+
+# Bot API endpoint, only changed to point the bot at a local stand-in for benchmarks
+API_URL = os.environ.get('CEREBROS_API_URL') or None
+
+# Number of worker threads handlers run on in concurrent mode
+WORKERS = int(os.environ.get('CEREBROS_WORKERS', 8))
+
+# Run every handler on the worker pool instead of the dispatcher thread
+CONCURRENT_HANDLERS = _env_bool('CEREBROS_CONCURRENT', False)
+
+# How long a connection waits for SQLite's write lock, in milliseconds
+BUSY_TIMEOUT = int(os.environ.get('CEREBROS_BUSY_TIMEOUT', 5000))
+
+# Format of exported search results, 'csv' or 'jsonl'
+EXPORT_FORMAT = os.environ.get('CEREBROS_EXPORT_FORMAT', 'csv')
+
+# How updates are received: 'polling' (getUpdates) or 'webhook'
+MODE = os.environ.get('CEREBROS_MODE', 'polling')
+
+# Public base URL Telegram delivers webhook updates to, e.g. https://bot.example.com
+WEBHOOK_URL = os.environ.get('CEREBROS_WEBHOOK_URL', '')
+
+# Address and port the built-in webhook server listens on
+WEBHOOK_LISTEN = os.environ.get('CEREBROS_WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('CEREBROS_WEBHOOK_PORT', 8443))
+
+# Updates accepted but not yet handed to the dispatcher; beyond this Telegram gets a 503
+WEBHOOK_MAX_PENDING = int(os.environ.get('CEREBROS_WEBHOOK_MAX_PENDING', 1000))
+
+# Endpoint analytics events are POSTed to in JSON batches; takes precedence over botan.io
+ANALYTICS_URL = os.environ.get('CEREBROS_ANALYTICS_URL', '')
+
+# Log level of the bot, e.g. DEBUG, INFO or WARNING
+LOG_LEVEL = os.environ.get('CEREBROS_LOG_LEVEL', 'INFO')
+
+# Local HTTP endpoint serving Prometheus metrics on /metrics; port 0 disables it
+METRICS_LISTEN = os.environ.get('CEREBROS_METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('CEREBROS_METRICS_PORT', 0))
+
+# Also serve /profile?seconds=N, which samples the stacks of all threads
+PROFILING = _env_bool('CEREBROS_PROFILING', False)
+
+# Log of changes to user_data and conversation states, restored on startup; relative
+# to the bot's directory like DB_NAME, empty disables it
+STATE_FILE = os.environ.get('CEREBROS_STATE_FILE', 'state.pickle')
+
+# Conversation states and user_data of users idle for this many seconds are dropped
+STATE_TTL = int(os.environ.get('CEREBROS_STATE_TTL', 24 * 60 * 60))
+
+# Seconds between snapshots of the conversation states
+STATE_SNAPSHOT_INTERVAL = int(os.environ.get('CEREBROS_STATE_SNAPSHOT_INTERVAL', 10))
+
+# Super admins created on startup if they do not exist, as comma separated id:first_name pairs
+SUPER_ADMINS = os.environ.get('CEREBROS_SUPER_ADMINS', '10049375:Jannes,46348706:Jackson')
+
+# Inline mode: results per page, and seconds Telegram may cache them
+INLINE_PAGE_SIZE = int(os.environ.get('CEREBROS_INLINE_PAGE_SIZE', 20))
+INLINE_CACHE_TIME = int(os.environ.get('CEREBROS_INLINE_CACHE_TIME', 30))
+
+# Outgoing requests per second overall and per chat (with bursts of up to
+# OUTBOX_CHAT_BURST), and the number of threads sending them
+OUTBOX_RATE = float(os.environ.get('CEREBROS_OUTBOX_RATE', 30))
+OUTBOX_CHAT_RATE = float(os.environ.get('CEREBROS_OUTBOX_CHAT_RATE', 1))
+OUTBOX_CHAT_BURST = int(os.environ.get('CEREBROS_OUTBOX_CHAT_BURST', 3))
+OUTBOX_SENDERS = int(os.environ.get('CEREBROS_OUTBOX_SENDERS', 4))
+
+# Searches (including carousel pages and inline queries) a user may run per
+# second on average, and in a burst
+SEARCH_RATE = float(os.environ.get('CEREBROS_SEARCH_RATE', 0.5))
+SEARCH_BURST = int(os.environ.get('CEREBROS_SEARCH_BURST', 10))
+
+# Seconds between writes of buffered report confirmations
+VOTE_FLUSH_INTERVAL = float(os.environ.get('CEREBROS_VOTE_FLUSH_INTERVAL', 1))
+
+# Answer searches from an in-memory copy of the searchable report columns,
+# loaded in the background on startup, instead of from SQLite
+READ_SNAPSHOT = _env_bool('CEREBROS_READ_SNAPSHOT', False)
+
+# /changes answers deltas covering at most this many of the latest changes;
+# older change log entries are pruned when the database is exported
+CHANGELOG_KEEP = max(int(os.environ.get('CEREBROS_CHANGELOG_KEEP', 1000000)), 1)
@@ -0,0 +1,363 @@
+import gc
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+from telegram.ext import ConversationHandler
+from telegram.utils.promise import Promise
+
+from lru import ExpiringLRU
+from worker import PeriodicWorker
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 2
+
+# The state log is rewritten with only the latest record of each key once it
+# holds twice as many records as that, but not before it holds this many
+COMPACT_MIN = 10000
+
+# Marks keys without a live entry
+_MISSING = object()
+
+
+class ExpiringDict(MutableMapping):
+    """
+    Mapping whose entries expire ttl seconds after they were last used.
+
+    Drop-in replacement for the plain dicts that hold user_data and
+    conversation states, which otherwise keep an entry for every user ever
+    seen. With a factory, looking up a missing key creates its value, like
+    defaultdict; such values are filled in by whoever looked them up, so []
+    counts as a change of the key. get() never does. Expiry times are wall
+    clock times, so they stay meaningful across restarts. changes() hands
+    out what changed since its last call.
+    """
+
+    def __init__(self, ttl, factory=None, max_size=None):
+        self.factory = factory
+        self._entries = ExpiringLRU(max_size, ttl, clock=time.time)
+        self._lock = threading.RLock()
+        # Keys set, removed or handed out to be changed since the last changes()
+        self._changed = set()
+
+    @property
+    def dirty(self):
+        return bool(self._changed)
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is _MISSING:
+                if self.factory is None:
+                    raise KeyError(key)
+                value = self.factory()
+                self._entries.put(key, value)
+
+            if self.factory is not None:
+                self._changed.add(key)
+            return value
+
+    def get(self, key, default=None):
+        # Unlike [], never creates or changes an entry; check_update calls this for every update
+        with self._lock:
+            return self._entries.get(key, default)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries.put(key, value)
+            self._changed.add(key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if self._entries.pop(key, _MISSING) is _MISSING:
+                raise KeyError(key)
+            self._changed.add(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __iter__(self):
+        with self._lock:
+            return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def changes(self, convert=None):
+        """
+        (key, expires, value) of the keys changed since the last call and
+        the keys removed meanwhile. Values are passed through convert, which
+        may return None to have the key counted as removed.
+        """
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            entries = [(key, self._entries.peek(key)) for key in changed]
+
+        items, removed = [], []
+        try:
+            for key, entry in entries:
+                value = None
+                if entry is not None:
+                    expires, value = entry
+                    if convert:
+                        value = convert(value)
+                if value is None:
+                    removed.append(key)
+                else:
+                    items.append((key, expires, value))
+        except Exception:
+            # A handler changed a value while it was converted, hand it out next time
+            self.mark_changed(changed)
+            raise
+        return items, removed
+
+    def mark_changed(self, keys):
+        """ Have changes() hand out keys again, e.g. after they could not be saved """
+        with self._lock:
+            self._changed.update(keys)
+
+    def restore(self, entries):
+        """ Add the entries of a {key: (expires, value)} mapping listed in order of last use """
+        with self._lock:
+            self._entries.extend(entries)
+
+
+def _settled_state(state):
+    """
+    The state to persist for a conversation. A state still waiting for a
+    run_async handler is saved as the state before it, or as its result if
+    it finished; None drops the conversation.
+    """
+    if isinstance(state, tuple) and len(state) == 2 and isinstance(state[1], Promise):
+        old_state, promise = state
+        if not promise.done.is_set():
+            return old_state
+        result = promise.result()
+        if result == ConversationHandler.END:
+            return None
+        return old_state if result is None else result
+
+    return state
+
+
+class ConversationState(PeriodicWorker):
+    """
+    user_data and ConversationHandler states of all users, evicted when
+    idle and saved to a log file in the background.
+
+    Handlers keep working on the in-memory mappings. Without a path nothing
+    is saved, but idle entries are still evicted. A background thread
+    appends the entries changed since its last pass to the log every
+    snapshot_interval seconds, so a restart only loses the last few
+    seconds, and rewrites the log from its own records once most of them
+    are outdated. Reads refresh an entry's expiry in memory only, so after
+    a restart entries that were only read may expire early.
+
+    The log is a pickled header followed by pickled records, each a list of
+    (store, [(key, expires, value)], [removed key]). Loading keeps the latest
+    record of each key.
+    """
+
+    failure = "Could not save state snapshot"
+
+    def __init__(self, path, ttl=24 * 60 * 60, snapshot_interval=10, max_size=None):
+        super(ConversationState, self).__init__(snapshot_interval, 'state-snapshots')
+        self.path = path
+        self.ttl = ttl
+        self.user_data = ExpiringDict(ttl, factory=dict, max_size=max_size)
+        self._max_size = max_size
+        # Store name -> (store, convert), convert turning a value into what is saved
+        self._stores = OrderedDict([('user_data', (self.user_data, dict))])
+        # Records in the log, None until there is a log to append to
+        self._records = None
+
+    def conversations(self, name):
+        """ The store for the states of the ConversationHandler called name """
+        key = 'conversation:' + name
+        if key not in self._stores:
+            self._stores[key] = (ExpiringDict(self.ttl, max_size=self._max_size), _settled_state)
+        return self._stores[key][0]
+
+    def add_store(self, name, store, convert=None):
+        """ Also save store, an ExpiringDict, as name; it is restored if added before load() """
+        self._stores[name] = (store, convert)
+
+    def attach(self, dispatcher, handlers):
+        """ Use the stores for the dispatcher's user_data and the given {name: handler} """
+        dispatcher.user_data = self.user_data
+        for name, handler in handlers.items():
+            handler.conversations = self.conversations(name)
+
+    def _store(self, name):
+        """ The store saved as name, None if there is no such store (any more) """
+        if name.startswith('conversation:'):
+            return self.conversations(name[len('conversation:'):])
+        return self._stores[name][0] if name in self._stores else None
+
+    def _read(self):
+        """
+        {store: {key: (expires, value)}} of the latest records in the log, in
+        order of last change, or None if there is no log or it has an unknown
+        format. A record cut off by a crash while it was appended is removed
+        from the file.
+        """
+        entries = {}
+        records = 0
+        with open(self.path, 'rb') as file:
+            end = os.fstat(file.fileno()).st_size
+            if pickle.load(file) != {'format': SNAPSHOT_FORMAT}:
+                logger.warning("Ignoring state snapshot of unknown format")
+                return None
+
+            while file.tell() < end:
+                position = file.tell()
+                try:
+                    record = pickle.load(file)
+                except Exception:
+                    logger.warning("Dropping incomplete record at the end of %s", self.path)
+                    os.truncate(self.path, position)
+                    break
+
+                for name, items, removed in record:
+                    store = entries.setdefault(name, {})
+                    # Moved to the end, so the keys stay in order of last change
+                    for key, expires, value in items:
+                        store.pop(key, None)
+                        store[key] = (expires, value)
+                    for key in removed:
+                        store.pop(key, None)
+                    records += len(items) + len(removed)
+
+        self._records = records
+        return entries
+
+    def load(self):
+        if not self.path:
+            return
+
+        started = time.monotonic()
+
+        try:
+            with _collector_paused():
+                entries = self._read()
+                if entries is None:
+                    return
+
+                for name, items in entries.items():
+                    store = self._store(name)
+                    if store is not None:
+                        store.restore(items)
+
+                # Restored entries stay until they expire; spare the collector from
+                # walking all of them once it runs again, and on every full pass after
+                gc.freeze()
+
+        except FileNotFoundError:
+            return
+        except Exception:
+            logger.exception("Could not read state snapshot %s, starting empty", self.path)
+            self._records = None
+            return
+
+        logger.info("Restored state of %d users in %.1f ms", len(self.user_data),
+                    (time.monotonic() - started) * 1000)
+
+    def _write(self, data):
+        """ Start a new log with data as its only record """
+        header = pickle.dumps({'format': SNAPSHOT_FORMAT}, pickle.HIGHEST_PROTOCOL)
+
+        # Written next to the target and renamed, so a crash never leaves half a file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(header)
+                file.write(data)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def snapshot(self):
+        """ Append the entries changed since the last snapshot to the log """
+        if not self.path:
+            return
+
+        record = []
+        try:
+            for name, (store, convert) in list(self._stores.items()):
+                items, removed = store.changes(convert)
+                if items or removed:
+                    record.append((name, items, removed))
+            if not record:
+                return
+            data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # A handler changed a value while it was saved, try again next time
+            for name, items, removed in record:
+                self._stores[name][0].mark_changed([key for key, _, _ in items] + removed)
+            raise
+
+        if self._records is None:
+            self._write(data)
+            self._records = 0
+        else:
+            with open(self.path, 'ab') as file:
+                file.write(data)
+
+        count = sum(len(items) + len(removed) for _, items, removed in record)
+        self._records += count
+        logger.debug("Saved %d state changes (%d bytes)", count, len(data))
+
+        # The log keeps the keys in memory, and some expired or evicted since
+        live = sum(len(store) for store, _ in self._stores.values())
+        if self._records > max(2 * live, COMPACT_MIN):
+            self.compact()
+
+    def compact(self):
+        """ Rewrite the log with only the latest record of each live key """
+        started = time.monotonic()
+        with _collector_paused():
+            entries = self._read()
+            if entries is None:
+                return
+
+            now = time.time()
+            record = []
+            for name, store in entries.items():
+                items = [(key, expires, value) for key, (expires, value) in store.items()
+                         if expires is None or expires >= now]
+                if items:
+                    record.append((name, items, []))
+
+            self._write(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+        self._records = sum(len(items) for _, items, _ in record)
+        logger.info("Compacted state log to %d entries in %.1f ms", self._records,
+                    (time.monotonic() - started) * 1000)
+
+    def run_once(self):
+        self.snapshot()
+
+
+@contextmanager
+def _collector_paused():
+    """
+    Pause the cyclic garbage collector while the log is read, which
+    unpickles into a dict per user; their allocation would set off
+    repeated passes.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
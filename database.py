@@ -1,4 +1,24 @@
 from pony.orm import *
 
+from config import BUSY_TIMEOUT
+import metrics
+
 # Database singleton
 db = Database()
+
+# Sessions that only read run in autocommit mode and never wait for the write
+# lock. Sessions that write take SQLite's write lock up front (BEGIN
+# IMMEDIATE), so concurrent writers queue instead of failing to upgrade a
+# read transaction. Both add their time to the handler metrics.
+read_session = metrics.TimedSession(db_session)
+write_session = metrics.TimedSession(db_session(immediate=True))
+
+
+@db.on_connect(provider='sqlite')
+def _sqlite_pragmas(db, connection):
+    """ WAL lets readers proceed while a write is in progress """
+    metrics.install(connection)
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.execute('PRAGMA busy_timeout = %d' % BUSY_TIMEOUT)
@@ -0,0 +1,75 @@
+"""
+Fold duplicate reports together while the bot is stopped.
+
+    python dedupe.py [--db bot.sqlite] [--dry-run]
+
+Reports sharing a phone number or Telegram ID, whose phone number,
+Telegram ID and name do not contradict each other, are merged into the
+oldest of them, which gets all their votes. Groups are merged in batches,
+each in its own transaction. A relative --db is resolved against the bot's
+directory, like the bot does.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+from config import DB_NAME
+import duplicates
+import schema
+
+# Groups of duplicates merged per transaction
+MERGE_BATCH_SIZE = 200
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', default=DB_NAME,
+                        help="database file, relative to the bot's directory")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only count the duplicates")
+    args = parser.parse_args()
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), args.db)
+    # sqlite3 would create an empty database instead
+    if not os.path.isfile(path):
+        sys.exit("No database at %s" % path)
+
+    connection = sqlite3.connect(path, isolation_level=None)
+
+    try:
+        if schema.schema_version(connection) < schema.MIGRATIONS[-1][0]:
+            sys.exit("The database schema is outdated, start the bot once to migrate it")
+
+        started = time.perf_counter()
+        groups = duplicates.duplicate_groups(connection.execute(
+            'SELECT id, phone_nr_key, account_nr_key, name_key FROM Believer ORDER BY id'))
+        print("%d groups of duplicates, %d reports to fold, found in %.1f s"
+              % (len(groups), sum(len(ids) - 1 for ids in groups),
+                 time.perf_counter() - started))
+
+        if args.dry_run:
+            return
+
+        cursor = connection.cursor()
+        for start in range(0, len(groups), MERGE_BATCH_SIZE):
+            batch = groups[start:start + MERGE_BATCH_SIZE]
+
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                for ids in batch:
+                    duplicates.merge_reports(cursor, ids[0], ids[1:])
+                cursor.execute('COMMIT')
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+
+            print("Merged %d of %d groups" % (start + len(batch), len(groups)))
+
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+class ReportDraft(object):
+    """
+    Changes to a report collected during the add/edit conversation, kept in
+    user_data until the admin sends /done and written in one transaction.
+    """
+
+    __slots__ = ('believer_id', 'reporter', 'changes')
+
+    # Fields an admin can edit, and the setter maintaining their lookup keys
+    FIELDS = {'phone_nr': 'set_phone_nr', 'account_nr': 'set_account_nr',
+              'bank_name': 'set_bank_name', 'remark': None, 'attached_file': None}
+
+    def __init__(self, believer_id=None, reporter=None):
+        # believer_id is None for a report that does not exist yet
+        self.believer_id = believer_id
+        # (id, first_name, last_name, username) of the reporting user of a new report
+        self.reporter = reporter
+        self.changes = {}
+
+    def set(self, field, value):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        self.changes[field] = value
+
+    def apply(self, believer):
+        """ Write the collected changes to the Believer entity """
+        for field, value in self.changes.items():
+            setter = self.FIELDS[field]
+            if setter:
+                getattr(believer, setter)(value)
+            else:
+                setattr(believer, field, value)
+
+    # Saved with the conversation state; a tuple pickles smaller and faster than the slots
+    def __getstate__(self):
+        return self.believer_id, self.reporter, self.changes
+
+    def __setstate__(self, state):
+        self.believer_id, self.reporter, self.changes = state
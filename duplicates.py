@@ -0,0 +1,176 @@
+from believer import phone_nr_key, account_nr_key, name_key, MIN_PHONE_DIGITS
+from database import db, write_session
+import search_index
+
+# Other reports listed when warning about a duplicate
+MAX_DUPLICATES = 5
+
+# How the fields are called in warnings
+FIELD_NAMES = {'phone_nr': 'phone number', 'account_nr': 'Telegram ID', 'bank_name': 'name'}
+
+# Fields combined when reports are merged, and the lookup keys derived from them
+MERGED_FIELDS = ('phone_nr', 'account_nr', 'bank_name', 'remark', 'attached_file')
+KEY_COLUMNS = (('phone_nr', 'phone_nr_key', phone_nr_key),
+               ('account_nr', 'account_nr_key', account_nr_key),
+               ('bank_name', 'name_key', name_key))
+
+
+def find_duplicates(field, value, exclude=None, limit=MAX_DUPLICATES):
+    """
+    Ids of the reports, oldest first, with the same phone number, Telegram
+    ID or name as value, looked up through the index of the field's key.
+    """
+    if field == 'phone_nr':
+        key = phone_nr_key(value)
+        if len(key) < MIN_PHONE_DIGITS:
+            return []
+        condition, params = search_index.phone_key_condition(key)
+    else:
+        column, key_of = {'account_nr': ('account_nr_key', account_nr_key),
+                          'bank_name': ('name_key', name_key)}[field]
+        params = {'key': key_of(value)}
+        if not params['key']:
+            return []
+        condition = '%s = $key' % column
+
+    # Report ids start at 1
+    params.update(exclude=exclude or 0, limit=limit)
+    return db.select("id FROM Believer WHERE " + condition +
+                     " AND id != $exclude ORDER BY id LIMIT $limit", params)
+
+
+def merged_values(rows):
+    """
+    Field values of reports folded into the first one: its own values, with
+    empty fields filled from the others in order and their remarks appended.
+    """
+    values = dict(zip(MERGED_FIELDS, rows[0]))
+
+    for row in rows[1:]:
+        for field, value in zip(MERGED_FIELDS, row):
+            if not value:
+                continue
+            if not values[field]:
+                values[field] = value
+            elif field == 'remark' and value not in values[field]:
+                values[field] += '\n' + value
+
+    return values
+
+
+def merge_reports(cursor, keeper_id, source_ids):
+    """
+    Fold the source reports into the keeper on a sqlite3 cursor, within
+    the caller's transaction: the keeper gets their votes and missing
+    fields, and they are deleted. Returns the keeper's field values, or
+    None if it does not exist.
+    """
+    ids = [keeper_id] + [i for i in source_ids if i != keeper_id]
+    placeholders = ', '.join('?' * len(ids))
+
+    rows = {row[0]: row[1:] for row in cursor.execute(
+        'SELECT id, %s FROM Believer WHERE id IN (%s)' % (', '.join(MERGED_FIELDS), placeholders),
+        ids)}
+    if keeper_id not in rows:
+        return None
+
+    sources = [i for i in ids[1:] if i in rows]
+    values = merged_values([rows[i] for i in [keeper_id] + sources])
+
+    if sources:
+        source_list = ', '.join('?' * len(sources))
+        cursor.execute('INSERT OR IGNORE INTO Believer_Reporter (believer, reporter) '
+                       'SELECT ?, reporter FROM Believer_Reporter WHERE believer IN (%s)'
+                       % source_list, [keeper_id] + sources)
+        cursor.execute('DELETE FROM Believer_Reporter WHERE believer IN (%s)' % source_list,
+                       sources)
+        cursor.execute('DELETE FROM Believer WHERE id IN (%s)' % source_list, sources)
+
+    columns = dict(values)
+    for field, column, key_of in KEY_COLUMNS:
+        columns[column] = key_of(values[field])
+
+    cursor.execute('UPDATE Believer SET %s, version = version + 1, voter_count = '
+                   '(SELECT COUNT(*) FROM Believer_Reporter WHERE believer = Believer.id) '
+                   'WHERE id = ?' % ', '.join('%s = ?' % column for column in columns),
+                   list(columns.values()) + [keeper_id])
+
+    return values
+
+
+def merge(keeper_id, source_ids):
+    """ Fold the source reports into the keeper in one transaction, see merge_reports """
+    with write_session:
+        return merge_reports(db.get_connection().cursor(), keeper_id, source_ids)
+
+
+def _same_phone(a, b):
+    """
+    Whether two phone number keys are the same number, by the rule of
+    search_index.phone_key_condition: equal, or one is the other with a
+    country code in front
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    return a == b or (len(a) >= MIN_PHONE_DIGITS and b.startswith(a))
+
+
+def _compatible(keys, group_keys):
+    """ Whether each of the keys is the same as the group's or missing on one side """
+    phone, group_phone = keys[0], group_keys[0]
+    if phone and group_phone and not _same_phone(phone, group_phone):
+        return False
+    return all(not a or not b or a == b for a, b in zip(keys[1:], group_keys[1:]))
+
+
+def duplicate_groups(rows):
+    """
+    Group reports sharing a phone number or Telegram ID that do not
+    contradict each other: their phone number, Telegram ID and name keys
+    are each the same or missing on one side, where phone numbers with and
+    without country code are the same. Takes (id, phone key, account key,
+    name key) rows in id order and returns the ids of each group of more
+    than one report, oldest first.
+    """
+    groups = []
+    # (key column, key): indexes of the groups having that key
+    by_key = {}
+    # Leading part of a group's phone key: indexes of the groups whose phone
+    # key is longer, i.e. the number with a country code in front
+    by_phone_prefix = {}
+
+    for row in rows:
+        report_id, keys = row[0], [key or '' for key in row[1:]]
+        phone = keys[0]
+
+        candidates = set()
+        for column in (0, 1):
+            if keys[column]:
+                candidates.update(by_key.get((column, keys[column]), ()))
+        if len(phone) >= MIN_PHONE_DIGITS:
+            candidates.update(by_phone_prefix.get(phone, ()))
+            for length in range(MIN_PHONE_DIGITS, len(phone)):
+                candidates.update(by_key.get((0, phone[:length]), ()))
+
+        for number in sorted(candidates):
+            ids, group_keys = groups[number]
+            if _compatible(keys, group_keys):
+                ids.append(report_id)
+                merged = [a or b for a, b in zip(group_keys, keys)]
+                # Keep the phone number with country code, it still matches the one without
+                if len(phone) > len(group_keys[0]):
+                    merged[0] = phone
+                groups[number][1] = merged
+                break
+        else:
+            number = len(groups)
+            groups.append([[report_id], list(keys)])
+
+        group_keys = groups[number][1]
+        for column in (0, 1):
+            if group_keys[column]:
+                by_key.setdefault((column, group_keys[column]), set()).add(number)
+        for length in range(MIN_PHONE_DIGITS, len(group_keys[0])):
+            by_phone_prefix.setdefault(group_keys[0][:length], set()).add(number)
+
+    return [ids for ids, _ in groups if len(ids) > 1]
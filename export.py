@@ -0,0 +1,219 @@
+import csv
+import gzip
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+import changelog
+from config import BUSY_TIMEOUT, CHANGELOG_KEEP
+from database import db, read_session
+import search_index
+
+logger = logging.getLogger(__name__)
+
+# Size of the pieces the snapshot is copied and compressed in
+CHUNK_SIZE = 1 << 20
+
+# Reports loaded per query when exporting search results
+EXPORT_BATCH_SIZE = 500
+
+# Exported search results stay in memory up to this size, then spill to disk
+SPOOL_SIZE = 1 << 20
+
+EXPORT_FIELDS = ('id', 'phone_nr', 'account_nr', 'bank_name', 'remark', 'voter_count', 'created')
+
+# Pages copied per step of the online backup, so writers are not blocked
+# for the whole copy
+BACKUP_PAGES = 1024
+
+
+class DatabaseExport(object):
+    """
+    Compressed, consistent snapshot of the database for /download_database.
+
+    The snapshot is taken through SQLite's online backup API, so it is never
+    torn by concurrent writes, and is kept until the database changes.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.path = None
+        self._version = None
+        self._lock = threading.Lock()
+        self._monitor = None
+
+    def _data_version(self):
+        """
+        PRAGMA data_version changes whenever another connection commits, so
+        a long-lived connection tells us whether the snapshot is stale.
+        """
+        if self._monitor is None:
+            self._monitor = sqlite3.connect(self.filename, check_same_thread=False)
+        return self._monitor.execute('PRAGMA data_version').fetchone()[0]
+
+    def _snapshot(self):
+        fd, raw_path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+
+        try:
+            source = sqlite3.connect(self.filename)
+            target = sqlite3.connect(raw_path)
+            try:
+                source.backup(target, pages=BACKUP_PAGES)
+                # Ship a self-contained file rather than one expecting a WAL
+                target.execute('PRAGMA journal_mode = DELETE')
+            finally:
+                target.close()
+                source.close()
+
+            fd, path = tempfile.mkstemp(suffix='.sqlite.gz')
+            with open(raw_path, 'rb') as raw, os.fdopen(fd, 'wb') as out, \
+                    gzip.GzipFile('trustworthy.sqlite', 'wb', fileobj=out) as packed:
+                shutil.copyfileobj(raw, packed, CHUNK_SIZE)
+
+        finally:
+            os.remove(raw_path)
+
+        return path
+
+    def _prune(self):
+        connection = sqlite3.connect(self.filename, timeout=BUSY_TIMEOUT / 1000)
+        try:
+            pruned = changelog.prune(connection, CHANGELOG_KEEP)
+        finally:
+            connection.close()
+
+        if pruned:
+            logger.info("Pruned %d change log entries", pruned)
+
+    def open_snapshot(self):
+        """
+        Open an up to date compressed snapshot for reading, taking a new one
+        if needed. The caller closes the file.
+        """
+        with self._lock:
+            version = self._data_version()
+
+            if self.path is None or version != self._version:
+                self._prune()
+                # Pruning is a change too, which the snapshot includes
+                version = self._data_version()
+                old_path = self.path
+                self.path = self._snapshot()
+                self._version = version
+                logger.info("Exported database snapshot (%d bytes)", os.path.getsize(self.path))
+
+                if old_path:
+                    # Downloads still reading the old file keep their handle
+                    os.remove(old_path)
+
+            # Opened under the lock, as the next call may remove the file
+            return open(self.path, 'rb')
+
+    def stop(self):
+        """ Remove the snapshot file on shutdown; downloads still reading it keep their handle """
+        with self._lock:
+            if self.path:
+                os.remove(self.path)
+                self.path = None
+            if self._monitor is not None:
+                self._monitor.close()
+                self._monitor = None
+
+
+def iter_search_results(query, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield every report matching query as a dict, newest first. Results are
+    fetched in keyset batches as plain rows, which Pony does not keep in the
+    session cache, so memory use does not depend on the number of results.
+    """
+    cursor = None
+
+    while True:
+        with read_session:
+            if cursor is None:
+                ids = search_index.search_ids(query, limit=batch_size)
+            else:
+                ids = search_index.older_ids(query, cursor, limit=batch_size)
+
+            if not ids:
+                return
+
+            loaded = {row[0]: dict(zip(EXPORT_FIELDS, row)) for row in db.select(
+                "%s FROM Believer WHERE id IN (%s)"
+                % (', '.join(EXPORT_FIELDS), ', '.join(str(int(i)) for i in ids)))}
+            rows = [loaded[i] for i in ids if i in loaded]
+
+        for row in rows:
+            yield row
+
+        cursor = ids[-1]
+
+
+class _EncodingWriter(object):
+    """ Lets the csv module write text into a binary file """
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, text):
+        self.file.write(text.encode('utf-8'))
+
+
+def write_results(rows, fmt='csv'):
+    """
+    Write rows incrementally to a spooled temporary file as CSV or JSON lines
+    and return it, rewound.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+    if fmt == 'jsonl':
+        for row in rows:
+            out.write(json.dumps(row, default=str, ensure_ascii=False).encode('utf-8'))
+            out.write(b'\n')
+    else:
+        writer = csv.DictWriter(_EncodingWriter(out), EXPORT_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+    out.seek(0)
+    return out
+
+
+def write_changes(filename, since, keep=CHANGELOG_KEEP):
+    """
+    Write the rows changed after sequence number since as compressed JSON
+    lines to a temporary file and return it rewound, together with the
+    sequence number it is complete up to and the number of changes. The
+    first line holds both sequence numbers, every other line a changed row.
+    Raises ChangesPruned if since is before the last keep changes.
+    """
+    connection = sqlite3.connect(filename)
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    count = 0
+
+    try:
+        # A read transaction, so the rows are those of the last change read
+        connection.execute('BEGIN')
+        until = changelog.last_seq(connection)
+        oldest = changelog.horizon(connection, keep)
+        if since < oldest:
+            raise changelog.ChangesPruned(oldest)
+
+        with gzip.GzipFile('changes.jsonl', 'wb', fileobj=out) as packed:
+            packed.write(json.dumps({'since': since, 'until': until}).encode('utf-8') + b'\n')
+            for change in changelog.changes(connection, since, until):
+                packed.write(json.dumps(change, default=str, ensure_ascii=False).encode('utf-8'))
+                packed.write(b'\n')
+                count += 1
+
+    finally:
+        connection.close()
+
+    out.seek(0)
+    return out, until, count
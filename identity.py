@@ -0,0 +1,131 @@
+import logging
+import threading
+from collections import namedtuple
+
+from database import read_session, write_session
+from lru import ExpiringLRU
+from worker import PeriodicWorker
+from admin import Admin
+from reporter import Reporter
+
+logger = logging.getLogger(__name__)
+
+# Permissions of a known admin
+Role = namedtuple('Role', ['super_admin'])
+
+# Marks users that have no row of the given kind
+_MISSING = object()
+
+
+def profile_of(user):
+    """ The profile fields we store for a Telegram user, as a comparable tuple """
+    return user.first_name, user.last_name or '', user.username or ''
+
+
+class IdentityCache(PeriodicWorker):
+    """
+    In-memory view of who is an admin and of the profile stored for each
+    admin and reporter.
+
+    Permission checks are answered from memory after the first lookup.
+    Profile changes are only queued when a user's name actually differs from
+    what is stored, and are written in batches by a background thread.
+    """
+
+    failure = "Could not write profile changes"
+
+    def __init__(self, max_size=100000, flush_interval=10):
+        super(IdentityCache, self).__init__(flush_interval, 'identity-flusher')
+        self.max_size = max_size
+        self._roles = ExpiringLRU(max_size)
+        self._profiles = ExpiringLRU(max_size)
+        self._pending = {}
+        # Bumped after a flush renamed a Reporter, as report cards show their names
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def role(self, user):
+        """ Role of user if they are an admin, otherwise None """
+        with self._lock:
+            role = self._roles.get(user.id)
+
+        if role is None:
+            with read_session:
+                admin = Admin.get(id=user.id)
+                role = Role(bool(admin.super_admin)) if admin else _MISSING
+                profile = profile_of(admin) if admin else _MISSING
+
+            with self._lock:
+                self._roles.put(user.id, role)
+                self._profiles.put((Admin, user.id), profile)
+
+        self.seen(Admin, user)
+        return role if role is not _MISSING else None
+
+    def forget(self, user_id):
+        """ Drop everything known about a user, e.g. after their admin status changed """
+        with self._lock:
+            self._roles.pop(user_id, None)
+            self._profiles.pop((Admin, user_id), None)
+            self._profiles.pop((Reporter, user_id), None)
+
+    def created(self, entity):
+        """ Record a freshly created Admin or Reporter row """
+        with self._lock:
+            self._profiles.put((type(entity), entity.id), profile_of(entity))
+            if isinstance(entity, Admin):
+                self._roles.put(entity.id, Role(bool(entity.super_admin)))
+
+    def seen(self, kind, user):
+        """
+        Note that user sent an update. If the profile stored for their Admin
+        or Reporter row differs, or is not known yet, queue a write.
+        """
+        key = (kind, user.id)
+        profile = profile_of(user)
+
+        with self._lock:
+            stored = self._profiles.get(key)
+            if stored is _MISSING or stored == profile:
+                return
+            self._pending[key] = profile
+
+    def flush(self):
+        """ Write all queued profile changes in a single transaction """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return
+
+        renamed = False
+
+        with write_session:
+            for (kind, user_id), (first_name, last_name, username) in pending.items():
+                entity = kind.get(id=user_id)
+                if entity:
+                    if profile_of(entity) != (first_name, last_name, username):
+                        entity.first_name = first_name
+                        entity.last_name = last_name
+                        entity.username = username
+                        renamed = renamed or kind is Reporter
+                    profile = profile_of(entity)
+                else:
+                    profile = _MISSING
+
+                with self._lock:
+                    self._profiles.put((kind, user_id), profile)
+
+        if renamed:
+            # Only once committed, so no card with the old names is cached anew
+            with self._lock:
+                self.generation += 1
+
+        logger.debug("Synced %d profiles", len(pending))
+
+    def run_once(self):
+        self.flush()
+
+
+# Cache singleton
+identities = IdentityCache()
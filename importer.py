@@ -0,0 +1,278 @@
+import csv
+import datetime
+import io
+import json
+import logging
+
+from database import db, write_session
+from believer import is_phone_like, phone_nr_key, account_nr_key, name_key
+from query_cache import cache as query_cache
+from prefix_index import typeahead
+from read_snapshot import snapshot
+
+logger = logging.getLogger(__name__)
+
+# Rows written per transaction
+IMPORT_BATCH_SIZE = 1000
+
+# Longest accepted value of a text field
+MAX_FIELD_LENGTH = 500
+
+# Row errors kept for the final report; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+# Minimum time between two updates of the progress message, in seconds
+PROGRESS_INTERVAL = 3
+
+# Size of the pieces a JSON file is read in
+JSON_CHUNK_SIZE = 1 << 16
+
+REPORT_FIELDS = ('phone_nr', 'account_nr', 'bank_name', 'remark')
+REPORTER_FIELDS = ('reporter_first_name', 'reporter_last_name', 'reporter_username')
+
+_DATETIME_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f',
+                     '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
+class ImportRowError(ValueError):
+    pass
+
+
+class ImportResult(object):
+    """ Running totals of an import """
+
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.new_reporters = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+
+def detect_format(filename, head=b''):
+    """ 'csv' or 'json', from the file name or else from its first bytes """
+    name = (filename or '').lower()
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.json', '.jsonl', '.ndjson')):
+        return 'json'
+    return 'json' if head.lstrip(b'\xef\xbb\xbf \t\r\n')[:1] in (b'[', b'{') else 'csv'
+
+
+def _iter_csv(file):
+    reader = csv.DictReader(io.TextIOWrapper(file, encoding='utf-8-sig', newline=''))
+    for row in reader:
+        yield reader.line_num, row
+
+
+def _iter_json(file):
+    """
+    Objects of a JSON array or of JSON lines, decoded one at a time from
+    chunks of the file instead of loading it as a whole.
+    """
+    text = io.TextIOWrapper(file, encoding='utf-8-sig')
+    decoder = json.JSONDecoder()
+    buffer = ''
+    line = 1
+    eof = False
+
+    while True:
+        # Skip whitespace and the array's punctuation between objects
+        stripped = buffer.lstrip(' \t\r\n[],')
+        line += buffer.count('\n', 0, len(buffer) - len(stripped))
+        buffer = stripped
+
+        try:
+            value, end = decoder.raw_decode(buffer)
+        except ValueError:
+            if eof:
+                if buffer:
+                    raise ImportRowError("Line %d: invalid JSON" % line)
+                return
+
+            chunk = text.read(JSON_CHUNK_SIZE)
+            eof = not chunk
+            buffer += chunk
+            continue
+
+        # A number cut off at the end of a chunk decodes without error
+        if end == len(buffer) and not eof:
+            chunk = text.read(JSON_CHUNK_SIZE)
+            if chunk:
+                buffer += chunk
+                continue
+            eof = True
+
+        yield line, value
+        line += buffer.count('\n', 0, end)
+        buffer = buffer[end:]
+
+
+def _text(row, field):
+    value = row.get(field)
+    value = '' if value is None else str(value).strip()
+    if len(value) > MAX_FIELD_LENGTH:
+        raise ImportRowError("%s is longer than %d characters" % (field, MAX_FIELD_LENGTH))
+    return value
+
+
+def _created(value):
+    if not value:
+        return datetime.datetime.now()
+
+    for fmt in _DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(str(value).strip(), fmt)
+        except ValueError:
+            pass
+
+    raise ImportRowError("created is not a date: %r" % value)
+
+
+def validate(row):
+    """ Cleaned copy of one input row, raises ImportRowError if it is unusable """
+    if not isinstance(row, dict):
+        raise ImportRowError("expected an object with report fields")
+
+    report = {field: _text(row, field) for field in REPORT_FIELDS}
+
+    if not report['phone_nr'] and not report['account_nr'] and not report['bank_name']:
+        raise ImportRowError("needs a phone_nr, account_nr or bank_name")
+
+    if report['phone_nr'] and not is_phone_like(report['phone_nr']):
+        raise ImportRowError("phone_nr is not a phone number: %r" % report['phone_nr'])
+
+    report['created'] = _created(row.get('created'))
+
+    reporter_id = row.get('reporter_id')
+    if reporter_id in (None, ''):
+        report['reporter_id'] = None
+    else:
+        try:
+            report['reporter_id'] = int(reporter_id)
+        except (TypeError, ValueError):
+            raise ImportRowError("reporter_id is not a number: %r" % reporter_id)
+
+        for field in REPORTER_FIELDS:
+            report[field] = _text(row, field)
+        report['reporter_username'] = report['reporter_username'].lstrip('@')
+
+    return report
+
+
+def _write_batch(reports, admin_id):
+    """ Insert one batch of validated reports and their reporters in a single transaction """
+    with write_session:
+        connection = db.get_connection()
+        cursor = connection.cursor()
+
+        reporter_ids = {r['reporter_id'] for r in reports if r['reporter_id'] is not None}
+        existing = set()
+        if reporter_ids:
+            existing = {row[0] for row in cursor.execute(
+                'SELECT id FROM Reporter WHERE id IN (%s)' % ', '.join(map(str, reporter_ids)))}
+
+        new_reporters = {}
+        for r in reports:
+            reporter_id = r['reporter_id']
+            if reporter_id is not None and reporter_id not in existing \
+                    and reporter_id not in new_reporters:
+                new_reporters[reporter_id] = (
+                    reporter_id, r['reporter_first_name'] or str(reporter_id),
+                    r['reporter_last_name'], r['reporter_username'], str(datetime.datetime.now()))
+
+        cursor.executemany('INSERT INTO Reporter (id, first_name, last_name, username, created) '
+                           'VALUES (?, ?, ?, ?, ?)', new_reporters.values())
+
+        votes = []
+        inserted = []
+        for r in reports:
+            cursor.execute(
+                'INSERT INTO Believer (phone_nr, account_nr, bank_name, remark, attached_file, '
+                'phone_nr_key, account_nr_key, name_key, voter_count, added_by, created, version) '
+                'VALUES (?, ?, ?, ?, \'\', ?, ?, ?, ?, ?, ?, 0)',
+                (r['phone_nr'], r['account_nr'], r['bank_name'], r['remark'],
+                 phone_nr_key(r['phone_nr']), account_nr_key(r['account_nr']),
+                 name_key(r['bank_name']),
+                 0 if r['reporter_id'] is None else 1, admin_id, str(r['created'])))
+
+            inserted.append((cursor.lastrowid, r['phone_nr'], r['account_nr'], r['bank_name']))
+            if r['reporter_id'] is not None:
+                votes.append((cursor.lastrowid, r['reporter_id']))
+
+        cursor.executemany('INSERT INTO Believer_Reporter (believer, reporter) VALUES (?, ?)',
+                           votes)
+
+    for believer_id, phone_nr, account_nr, bank_name in inserted:
+        snapshot.changed(believer_id)
+        typeahead.refresh(believer_id, phone_nr, account_nr, bank_name)
+    # Search results cached before the batch may now be incomplete
+    query_cache.clear()
+
+    return list(new_reporters)
+
+
+def describe(result, done=False):
+    """ Progress or final report of an import, for a Telegram message """
+    text = "%s %d of %d rows, %d new reporters." % (
+        "Imported" if done else "Importing... imported", result.imported, result.rows,
+        result.new_reporters)
+
+    if result.failed:
+        text += "\n%d rows skipped:" % result.failed
+        for line, message in result.errors:
+            text += "\n" + ("Line %d: %s" % (line, message) if line else message)
+
+    # Stay below Telegram's message length limit
+    return text[:4000]
+
+
+def import_reports(file, fmt, admin_id, progress=None, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Stream reports from a binary CSV or JSON file into the database,
+    batch_size rows per transaction, attributed to the admin admin_id.
+
+    Rows that fail validation are skipped and counted. progress, if given,
+    is called with the ImportResult after every batch. Returns the result
+    and the ids of the reporters that were created.
+    """
+    result = ImportResult()
+    created_reporters = []
+    batch = []
+
+    rows = _iter_csv(file) if fmt == 'csv' else _iter_json(file)
+
+    def flush():
+        created_reporters.extend(_write_batch(batch, admin_id))
+        result.imported += len(batch)
+        result.new_reporters = len(created_reporters)
+        del batch[:]
+        if progress:
+            progress(result)
+
+    try:
+        for line, row in rows:
+            result.rows += 1
+            try:
+                batch.append(validate(row))
+            except ImportRowError as e:
+                result.error(line, str(e))
+
+            if len(batch) >= batch_size:
+                flush()
+
+    except (ImportRowError, UnicodeDecodeError, csv.Error) as e:
+        # The rest of the file cannot be read, keep what was imported so far
+        result.error(None, str(e))
+
+    if batch:
+        flush()
+
+    logger.info("Imported %d of %d rows, %d new reporters", result.imported, result.rows,
+                result.new_reporters)
+    return result, created_reporters
@@ -0,0 +1,122 @@
+import time
+from collections import OrderedDict
+
+
+class ExpiringLRU(object):
+    """
+    Keeps the max_size most recently used entries, each until ttl seconds
+    after it was stored or last refreshed. Not thread safe; callers hold
+    their own lock.
+
+    Without max_size or ttl, entries are kept regardless of count or age.
+    Expiry times come from clock; time.time keeps them meaningful for
+    entries that are saved and restored across restarts.
+    """
+
+    def __init__(self, max_size=None, ttl=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        # key: (expires or None, value), least recently used first
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None, refresh=True):
+        """
+        The value of key if it has not expired, else default. A hit becomes
+        the most recently used entry; with refresh its ttl also starts over.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        expires, value = entry
+        if expires is not None and expires < self.clock():
+            del self._entries[key]
+            return default
+
+        if refresh and self.ttl is not None:
+            self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, expires=None):
+        """
+        Store value as the most recently used entry, until expires or else
+        for ttl seconds, evicting the least recently used beyond max_size.
+        """
+        now = self.clock()
+        self.drop_expired(now)
+
+        if expires is None and self.ttl is not None:
+            expires = now + self.ttl
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+
+        while self.max_size and len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def extend(self, entries):
+        """
+        Add the entries of a {key: (expires, value)} mapping listed in order
+        of last use, skipping expired ones. Quicker than put() for each.
+        """
+        now = self.clock()
+        for key, entry in entries.items():
+            if entry[0] is None or entry[0] >= now:
+                self._entries.pop(key, None)
+                self._entries[key] = entry
+
+        while self.max_size and len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def peek(self, key):
+        """ (expires, value) of key if it has not expired, else None; unlike get() it stays put """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] is not None and entry[0] < self.clock():
+            return None
+        return entry
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def drop_expired(self, now=None):
+        """ Remove expired entries from the least recently used end, return how many """
+        if self.ttl is None:
+            return 0
+
+        now = self.clock() if now is None else now
+        dropped = 0
+        # Refreshing moves an entry to the end with the latest expiry, so the
+        # first live entry ends the scan. Entries read without refresh may
+        # stay behind it until they are looked up or evicted.
+        while self._entries:
+            key, (expires, _) = next(iter(self._entries.items()))
+            if expires is None or expires >= now:
+                break
+            del self._entries[key]
+            dropped += 1
+        return dropped
+
+    def entries(self):
+        """ (key, expires, value) of the live entries, least recently used first """
+        now = self.clock()
+        return [(key, expires, value) for key, (expires, value) in self._entries.items()
+                if expires is None or expires >= now]
+
+    def items(self):
+        """ (key, value) of the live entries, least recently used first """
+        return [(key, value) for key, _, value in self.entries()]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and (entry[0] is None or entry[0] >= self.clock())
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,312 @@
+import logging
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from functools import wraps
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from inspect import isgeneratorfunction
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+STEP_BUCKETS = (0, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+# SQLite calls the progress handler every PROGRESS_STEPS virtual machine steps
+PROGRESS_STEPS = 1000
+
+# Longest /profile run that can be requested, in seconds
+MAX_PROFILE_SECONDS = 60
+
+
+def _format_value(value):
+    return '+Inf' if value == float('inf') else '%g' % value
+
+
+class Histogram(object):
+    """ Prometheus-style histogram with a single label """
+
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # Per bucket counts, the last one for +Inf, then sum and count
+                series = self._series[label_value] = [0] * (len(self.buckets) + 3)
+
+            series[bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+
+        with self._lock:
+            series = sorted((k, list(v)) for k, v in self._series.items())
+
+        for label_value, counts in series:
+            label = '%s="%s"' % (self.label, label_value)
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, label,
+                                                          _format_value(bound), total))
+            lines.append('%s_sum{%s} %s' % (self.name, label, _format_value(counts[-2])))
+            lines.append('%s_count{%s} %d' % (self.name, label, counts[-1]))
+
+        return lines
+
+
+class LabeledCounter(object):
+    """ Prometheus-style counter with a single label """
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self._lock:
+            self._counts[label_value] += amount
+
+    def expose(self):
+        with self._lock:
+            counts = sorted(self._counts.items())
+
+        return ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name] + \
+               ['%s{%s="%s"} %d' % (self.name, self.label, k, v) for k, v in counts]
+
+
+handler_seconds = Histogram('cerebros_handler_seconds',
+                            'Wall time spent in each handler', 'handler', LATENCY_BUCKETS)
+handler_db_seconds = Histogram('cerebros_handler_db_session_seconds',
+                               'Time each handler spent inside db_session, commit included',
+                               'handler', LATENCY_BUCKETS)
+handler_statements = Histogram('cerebros_handler_sql_statements',
+                               'SQL statements executed per handler call',
+                               'handler', STATEMENT_BUCKETS)
+handler_steps = Histogram('cerebros_handler_sqlite_steps',
+                          'SQLite virtual machine steps per handler call, '
+                          'a proxy for rows scanned (resolution %d)' % PROGRESS_STEPS,
+                          'handler', STEP_BUCKETS)
+handler_errors = LabeledCounter('cerebros_handler_errors_total',
+                                'Handler calls that raised an exception', 'handler')
+
+METRICS = [handler_seconds, handler_db_seconds, handler_statements, handler_steps,
+           handler_errors]
+
+
+class _Current(threading.local):
+    """ Measurements of the handler running on this thread """
+    handler = None
+    statements = 0
+    steps = 0
+    db_time = 0.0
+    session_depth = 0
+    session_started = 0.0
+
+
+_current = _Current()
+
+
+def instrumented(func):
+    """ Record latency and database usage of each call of the handler func """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        current = _current
+        if current.handler is not None:
+            return func(*args, **kwargs)
+
+        current.handler = name
+        current.statements = current.steps = 0
+        current.db_time = 0.0
+        started = time.perf_counter()
+
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(name, time.perf_counter() - started)
+            handler_db_seconds.observe(name, current.db_time)
+            handler_statements.observe(name, current.statements)
+            handler_steps.observe(name, current.steps)
+            current.handler = None
+
+    return wrapper
+
+
+def _trace(statement):
+    if _current.handler is not None:
+        _current.statements += 1
+
+
+def _progress():
+    if _current.handler is not None:
+        _current.steps += PROGRESS_STEPS
+    return 0
+
+
+def install(connection):
+    """ Count statements and VM steps on a new sqlite3 connection """
+    connection.set_trace_callback(_trace)
+    connection.set_progress_handler(_progress, PROGRESS_STEPS)
+
+
+class TimedSession(object):
+    """
+    Wraps a Pony db_session, adding the time spent inside the outermost
+    session to the handler running on the current thread. Works as a
+    decorator and as a context manager, like db_session itself.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    @staticmethod
+    def _begin():
+        current = _current
+        current.session_depth += 1
+        if current.session_depth == 1:
+            current.session_started = time.perf_counter()
+
+    @staticmethod
+    def _end():
+        current = _current
+        current.session_depth -= 1
+        if not current.session_depth and current.handler is not None:
+            current.db_time += time.perf_counter() - current.session_started
+
+    def __enter__(self):
+        result = self.session.__enter__()
+        self._begin()
+        return result
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            return self.session.__exit__(exc_type, exc, tb)
+        finally:
+            self._end()
+
+    def __call__(self, func):
+        # Pony's own decorator keeps its retry and generator handling
+        wrapped = self.session(func)
+        if isgeneratorfunction(func):
+            return wrapped
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            self._begin()
+            try:
+                return wrapped(*args, **kwargs)
+            finally:
+                self._end()
+
+        return wrapper
+
+
+def expose():
+    """ All metrics in the Prometheus text format """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+def profile(seconds, interval=0.005):
+    """
+    Sample the stacks of all other threads for the given time and return
+    them in collapsed format (one 'frame;frame;... count' line per stack),
+    as read by flamegraph.pl and speedscope.
+    """
+    samples = Counter()
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (code.co_filename.rsplit('/', 1)[-1], code.co_name))
+                frame = frame.f_back
+
+            stack.append(names.get(ident, str(ident)))
+            samples[';'.join(reversed(stack))] += 1
+
+        time.sleep(interval)
+
+    return ''.join('%s %d\n' % item for item in samples.most_common())
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path == '/metrics':
+            body = expose()
+        elif url.path == '/profile':
+            if not self.server.profiling:
+                self._respond(404, 'Profiling is disabled\n')
+                return
+            try:
+                seconds = float(parse_qs(url.query).get('seconds', ['10'])[0])
+            except ValueError:
+                self._respond(400, 'Invalid seconds\n')
+                return
+            body = profile(min(max(seconds, 0), MAX_PROFILE_SECONDS))
+        else:
+            self._respond(404, 'Not found\n')
+            return
+
+        self._respond(200, body)
+
+    def _respond(self, status, body):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(listen, port, profiling=False):
+    """
+    Serve /metrics, and /profile?seconds=N if profiling is enabled, on a
+    background thread. Returns the server; call shutdown() to stop it.
+    """
+    httpd = _ThreadingHTTPServer((listen, port), _MetricsHandler)
+    httpd.profiling = profiling
+
+    thread = threading.Thread(target=httpd.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+
+    logger.info("Serving metrics on port %d", httpd.server_address[1])
+    return httpd
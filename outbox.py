@@ -0,0 +1,259 @@
+import logging
+import threading
+import time
+from collections import deque
+from functools import partial
+from itertools import chain
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+from throttle import TokenBucket, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Priorities of outgoing requests, most urgent first
+INTERACTIVE, NORMAL, BULK = range(3)
+
+
+class Delivery(object):
+    """
+    Result of a request queued in the Outbox. Attributes are looked up on
+    the result once it arrives, so `reply_text(...).message_id` still works;
+    callers that never use the result never wait for it.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def _settle(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """ Wait for the request to be sent and return its result, or raise its error """
+        if not self._done.wait(timeout):
+            raise TimeoutError("Request still queued after %s seconds" % timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def __getattr__(self, name):
+        return getattr(self.result(), name)
+
+
+class _Request(object):
+    __slots__ = ('priority', 'chat_id', 'key', 'call', 'delivery', 'superseded')
+
+    def __init__(self, priority, chat_id, key, call):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.key = key
+        self.call = call
+        self.delivery = Delivery()
+        # Deliveries of retried requests this one replaced, settled along with it
+        self.superseded = []
+
+    def settle(self, result=None, error=None):
+        for delivery in [self.delivery] + self.superseded:
+            delivery._settle(result, error)
+
+
+class Outbox(object):
+    """
+    Queue of outgoing Bot API requests, sent by a few background threads
+    within Telegram's flood limits.
+
+    A global token bucket caps requests per second overall, and one bucket
+    per chat caps them per chat. Of the requests allowed to go, the most
+    urgent one goes first, e.g. answers to button presses before exported
+    files; within a chat, requests of a priority go in order. An edit of a
+    message that is still queued replaces the queued edit. When Telegram
+    answers with a flood limit anyway, the chat is paused for as long as it
+    asks and the request is retried.
+    """
+
+    def __init__(self, rate=30, chat_rate=1, chat_burst=3, senders=4):
+        self.senders = senders
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+        self._global = TokenBucket(rate, rate)
+        self._chats = RateLimiter(chat_rate, chat_burst)
+        self._queues = [deque() for _ in (INTERACTIVE, NORMAL, BULK)]
+        # Queued requests that later ones with the same key replace
+        self._by_key = {}
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = []
+
+    def submit(self, call, chat_id=None, priority=NORMAL, key=None):
+        """ Queue call() for sending and return its Delivery """
+        with self._cond:
+            queued = self._by_key.get(key) if key is not None else None
+            if queued is not None:
+                queued.call = call
+                self.coalesced += 1
+                return queued.delivery
+
+            request = _Request(priority, chat_id, key, call)
+            self._queues[priority].append(request)
+            if key is not None:
+                self._by_key[key] = request
+            self._cond.notify()
+
+        return request.delivery
+
+    def _next(self):
+        """ Wait for a request that may be sent now and take it; None once stopped and empty """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self._global.delay(now)
+
+                if not wait:
+                    throttled = set()
+                    for queue in self._queues:
+                        for i, request in enumerate(queue):
+                            if request.chat_id in throttled:
+                                continue
+
+                            chat = None
+                            if request.chat_id is not None:
+                                chat = self._chats.bucket(request.chat_id)
+                                delay = chat.delay(now)
+                                if delay:
+                                    throttled.add(request.chat_id)
+                                    wait = min(wait, delay) if wait else delay
+                                    continue
+
+                            del queue[i]
+                            if request.key is not None:
+                                self._by_key.pop(request.key, None)
+                            self._global.take()
+                            if chat:
+                                chat.take()
+                            return request
+
+                    if self._stopping and not any(self._queues):
+                        return None
+
+                self._cond.wait(wait or None)
+
+    def _send(self, request):
+        try:
+            result = request.call()
+
+        except RetryAfter as e:
+            self.retried += 1
+            logger.warning("Flood limit for chat %s, pausing for %.0f s",
+                           request.chat_id, e.retry_after)
+
+            with self._cond:
+                now = time.monotonic()
+                if request.chat_id is not None:
+                    self._chats.bucket(request.chat_id).pause(e.retry_after, now)
+                else:
+                    self._global.pause(e.retry_after, now)
+
+                newer = self._by_key.get(request.key) if request.key is not None else None
+                if newer is not None:
+                    # The message was edited again in the meantime, only the newer edit is sent
+                    newer.superseded.append(request.delivery)
+                    newer.superseded.extend(request.superseded)
+                    self.coalesced += 1
+                else:
+                    self._queues[request.priority].appendleft(request)
+                    if request.key is not None:
+                        self._by_key[request.key] = request
+                self._cond.notify()
+
+        except Exception as e:
+            self.failed += 1
+            logger.warning("Could not send to chat %s: %s", request.chat_id, e)
+            request.settle(error=e)
+
+        else:
+            self.sent += 1
+            request.settle(result)
+
+    def _run(self):
+        while True:
+            request = self._next()
+            if request is None:
+                return
+            self._send(request)
+
+    def start(self):
+        for i in range(self.senders):
+            thread = threading.Thread(target=self._run, name='outbox-%d' % i, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ Send what is queued, then stop the background threads """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        return {'queued': sum(len(queue) for queue in self._queues), 'sent': self.sent,
+                'coalesced': self.coalesced, 'retried': self.retried, 'failed': self.failed}
+
+
+def _holds_file(args, kwargs):
+    return any(hasattr(value, 'read') for value in chain(args, kwargs.values()))
+
+
+def _queued(name, priority, chat_arg=True, coalesce=False):
+    """ Bot method that queues the request in the bot's outbox instead of sending it """
+    send = getattr(Bot, name)
+
+    def method(self, *args, **kwargs):
+        chat_id = kwargs.get('chat_id', args[0] if chat_arg and args else None)
+        key = None
+        if coalesce and kwargs.get('message_id') is not None:
+            key = (name, chat_id, kwargs['message_id'])
+
+        delivery = self.outbox.submit(partial(send, self, *args, **kwargs),
+                                      chat_id, priority, key)
+
+        # Open files may be closed by the caller as soon as this returns
+        if _holds_file(args, kwargs):
+            return delivery.result()
+        return delivery
+
+    method.__name__ = name
+    method.__doc__ = send.__doc__
+    return method
+
+
+class OutboxBot(Bot):
+    """ Bot whose messages, edits and answers go through an Outbox """
+
+    def __init__(self, token, base_url=None, request=None, outbox=None):
+        super(OutboxBot, self).__init__(token, base_url, request=request)
+        self.outbox = outbox
+
+    answerCallbackQuery = answer_callback_query = _queued(
+        'answerCallbackQuery', INTERACTIVE, chat_arg=False)
+    answerInlineQuery = answer_inline_query = _queued(
+        'answerInlineQuery', INTERACTIVE, chat_arg=False)
+    sendMessage = send_message = _queued('sendMessage', NORMAL)
+    sendChatAction = send_chat_action = _queued('sendChatAction', NORMAL)
+    editMessageText = edit_message_text = _queued(
+        'editMessageText', NORMAL, chat_arg=False, coalesce=True)
+    editMessageReplyMarkup = edit_message_reply_markup = _queued(
+        'editMessageReplyMarkup', NORMAL, chat_arg=False, coalesce=True)
+    sendPhoto = send_photo = _queued('sendPhoto', BULK)
+    sendDocument = send_document = _queued('sendDocument', BULK)
@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+from bisect import bisect_left, bisect_right
+
+from database import db, read_session
+from believer import is_phone_shaped, phone_nr_key, account_nr_key
+from search_index import normalize_query
+
+logger = logging.getLogger(__name__)
+
+# Kinds of keys, stored as the first character of each key
+PHONE, ACCOUNT, NAME = 'p', 'a', 'n'
+
+# Sorts after every character that can occur in a key
+_END = '\U0010ffff'
+
+
+def phone_prefix(phone_nr):
+    """ Digits of a phone number without leading zeros, in the order they are typed """
+    return phone_nr_key(phone_nr)[::-1]
+
+
+def report_keys(phone_nr, account_nr, bank_name):
+    """ Keys a report is found by: its phone number, Telegram ID and every word suffix of its name """
+    keys = set()
+
+    if phone_prefix(phone_nr):
+        keys.add(PHONE + phone_prefix(phone_nr))
+    if account_nr_key(account_nr):
+        keys.add(ACCOUNT + account_nr_key(account_nr))
+
+    words = normalize_query(bank_name or '').split()
+    for i in range(len(words)):
+        keys.add(NAME + ' '.join(words[i:]))
+
+    return tuple(sorted(keys))
+
+
+def query_prefixes(text):
+    """ Key prefixes to look up for what a user typed so far """
+    query = normalize_query(text)
+
+    if not query:
+        return []
+    if query.startswith('@'):
+        return [ACCOUNT + account_nr_key(query)] if len(query) > 1 else []
+    if is_phone_shaped(query):
+        return [PHONE + phone_prefix(query)] if phone_prefix(query) else []
+
+    return [NAME + query, ACCOUNT + account_nr_key(query)]
+
+
+class PrefixIndex(object):
+    """
+    In-memory index for as-you-type lookups, answering "which reports have a
+    phone number, Telegram ID or name starting with this" without touching
+    the database.
+
+    Keys are kept in a sorted array with the report id at the same position
+    in a second one, so a prefix is a bisect for the start of its range and
+    a page of results is a slice. Writes to reports update the keys of the
+    one report; load() builds the arrays from the database once, after
+    which loaded is set.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._ids = []
+        # Keys currently indexed per report id, to remove them when it changes
+        self._report_keys = {}
+        # Writes that happened while load() was reading the database
+        self._pending = None
+        self.loaded = False
+        self._lock = threading.RLock()
+
+    def load(self):
+        started = time.monotonic()
+
+        with self._lock:
+            self._pending = {}
+
+        with read_session:
+            rows = db.select("id, phone_nr, account_nr, bank_name FROM Believer")
+
+        report_keys_of = {}
+        entries = []
+        for believer_id, phone_nr, account_nr, bank_name in rows:
+            keys = report_keys(phone_nr, account_nr, bank_name)
+            report_keys_of[believer_id] = keys
+            entries.extend((key, believer_id) for key in keys)
+        entries.sort()
+
+        with self._lock:
+            self._keys = [key for key, _ in entries]
+            self._ids = [believer_id for _, believer_id in entries]
+            self._report_keys = report_keys_of
+            pending, self._pending = self._pending, None
+            for believer_id, keys in pending.items():
+                self._set(believer_id, keys)
+            self.loaded = True
+
+        logger.info("Built prefix index of %d keys in %.1f ms", len(entries),
+                    (time.monotonic() - started) * 1000)
+
+    def refresh(self, believer_id, phone_nr, account_nr, bank_name):
+        """ Index the current field values of a report that was created or changed """
+        self._update(believer_id, report_keys(phone_nr, account_nr, bank_name))
+
+    def remove(self, believer_id):
+        self._update(believer_id, ())
+
+    def _update(self, believer_id, keys):
+        with self._lock:
+            if self._pending is not None:
+                self._pending[believer_id] = keys
+            elif self.loaded:
+                self._set(believer_id, keys)
+
+    def _set(self, believer_id, keys):
+        old = self._report_keys.get(believer_id, ())
+        if old == keys:
+            return
+
+        for key in old:
+            i = bisect_left(self._keys, key)
+            while self._ids[i] != believer_id:
+                i += 1
+            del self._keys[i]
+            del self._ids[i]
+
+        for key in keys:
+            i = bisect_right(self._keys, key)
+            self._keys.insert(i, key)
+            self._ids.insert(i, believer_id)
+
+        if keys:
+            self._report_keys[believer_id] = keys
+        else:
+            self._report_keys.pop(believer_id, None)
+
+    def lookup(self, text, offset=0, limit=20):
+        """
+        Ids of reports with a key starting with what the user typed, from
+        position offset of all matches on. Returns (ids, next offset), the
+        latter None when there are no more matches.
+        """
+        prefixes = query_prefixes(text)
+        ids = []
+        # Offsets count positions in the ranges of all prefixes one after another
+        position = 0
+
+        with self._lock:
+            for n, prefix in enumerate(prefixes):
+                start = bisect_left(self._keys, prefix)
+                end = bisect_left(self._keys, prefix + _END, start)
+
+                i = start + max(offset - position, 0)
+                while i < end:
+                    if len(ids) == limit:
+                        return ids, position + i - start
+                    # A report matching under several keys is listed at the
+                    # first of them only, whichever page that is on
+                    if self._first_match(self._ids[i], prefixes) == (n, self._keys[i]):
+                        ids.append(self._ids[i])
+                    i += 1
+
+                position += end - start
+
+        return ids, None
+
+    def _first_match(self, believer_id, prefixes):
+        """ (number of the prefix, key) of the first position a report has in lookup's ranges """
+        return min((n, key) for key in self._report_keys[believer_id]
+                   for n, prefix in enumerate(prefixes) if key.startswith(prefix))
+
+    def __len__(self):
+        return len(self._keys)
+
+
+# Index singleton
+typeahead = PrefixIndex()
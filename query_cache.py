@@ -0,0 +1,79 @@
+import threading
+
+from lru import ExpiringLRU
+from search_index import could_match
+
+
+class QueryCache(object):
+    """
+    LRU cache for search results with a time to live per entry.
+
+    Each entry remembers the query it was computed for and the report ids it
+    returned, so that a write to a report only evicts the entries it can
+    actually affect.
+
+    generation counts invalidations. A search that started before one may
+    have read the old data, so its result is only stored if the generation
+    is still the one read before searching.
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        # key: (query, ids)
+        self._entries = ExpiringLRU(max_size, ttl)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Return the cached ids for key, or None """
+        with self._lock:
+            # Results age from when they were computed, hits do not extend them
+            entry = self._entries.get(key, refresh=False)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, query, ids, generation=None):
+        """ Store the ids found for key, unless there were invalidations since generation """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._entries.put(key, (query, list(ids)))
+
+    def invalidate(self, believer_id, values=()):
+        """
+        Evict every entry that contains the report believer_id or whose query
+        matches one of values, the old and new searchable field values of the
+        report that was written.
+        """
+        values = [v for v in values if v]
+
+        with self._lock:
+            self.generation += 1
+            stale = [key for key, (query, ids) in self._entries.items()
+                     if believer_id in ids or could_match(query, values)]
+
+            for key in stale:
+                self._entries.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries), 'max_size': self.max_size}
+
+
+# Cache singleton
+cache = QueryCache()
@@ -0,0 +1,420 @@
+import datetime
+import gc
+import heapq
+import logging
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+
+from database import db, read_session
+from believer import is_phone_like, phone_nr_key, account_nr_key, MIN_PHONE_DIGITS
+from search_index import normalize_query
+
+logger = logging.getLogger(__name__)
+
+# Reports per block of search text; a change rebuilds the text of its block
+BLOCK_SIZE = 1024
+
+# Once this share of the reports has the trigrams of a query, scanning all
+# text is cheaper than checking each of them
+SCAN_SHARE = 0.25
+
+# Separates the fields of a report in the search text, and the reports
+FIELD_SEPARATOR, ROW_SEPARATOR = '\x00', '\n'
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+_columns = "id, phone_nr, account_nr, bank_name, remark, phone_nr_key, account_nr_key, created"
+
+
+def _timestamp(created):
+    if isinstance(created, str):
+        created = datetime.datetime.fromisoformat(created)
+    return (created - _EPOCH).total_seconds()
+
+
+def _search_text(phone_nr, account_nr, bank_name, remark):
+    return FIELD_SEPARATOR.join(normalize_query(value or '')
+                                for value in (phone_nr, account_nr, bank_name, remark))
+
+
+def _trigrams(text):
+    """ Three character substrings of text that lie within one field """
+    grams = set()
+    for field in text.split(FIELD_SEPARATOR):
+        grams.update(map(''.join, zip(field, field[1:], field[2:])))
+    return grams
+
+
+class _Block(object):
+    """ Search texts of BLOCK_SIZE consecutive reports, joined into one string """
+
+    __slots__ = ('text', 'starts')
+
+    def __init__(self, texts):
+        self.text = ROW_SEPARATOR.join(texts)
+        self.starts = array('l')
+        position = 0
+        for text in texts:
+            self.starts.append(position)
+            position += len(text) + 1
+
+    def texts(self):
+        return self.text.split(ROW_SEPARATOR)
+
+    def find(self, needle):
+        """ Positions within the block of the reports whose text contains needle """
+        rows = []
+        text, starts = self.text, self.starts
+        i = text.find(needle)
+
+        while i != -1:
+            row = bisect_right(starts, i) - 1
+            rows.append(row)
+            if row + 1 == len(starts):
+                break
+            i = text.find(needle, starts[row + 1])
+
+        return rows
+
+
+class ReportSnapshot(object):
+    """
+    Column-oriented copy of the searchable part of the Believer table,
+    answering the paged search_index lookups without a database query.
+    Ranked name searches stay with search_index, whose FTS5 index ranks
+    fuzzy matches faster than the trigram postings here.
+
+    Reports are stored by position, in id order: ids and creation times in
+    arrays, and the normalized search fields joined into one string per
+    block of reports. A trigram index maps every trigram to the sorted
+    positions of the reports containing it; a substring search intersects
+    the lists of the query's trigrams and checks the remaining reports'
+    text. Phone number and Telegram ID keys are kept in dicts for exact
+    lookups. Writers report changed ids with changed(); every lookup first
+    re-reads those reports, so it must run inside a database session.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._loading = False
+        self._lock = threading.RLock()
+        self._changed = set()
+        self._reset()
+
+    def _reset(self):
+        self._ids = array('q')
+        self._created = array('d')
+        # Rank of each report in (created, id) order, the order results are paged in
+        self._order = array('l')
+        self._reorder = False
+        self._live = bytearray()
+        self._blocks = []
+        # Key -> report id, or tuple of ids if several share it
+        self._phone = {}
+        self._account = {}
+        # Distinct phone keys in order, for numbers stored with a country code
+        self._phone_keys = []
+        # Trigram -> positions of the reports containing it, in order
+        self._postings = {}
+
+    def load(self):
+        started = time.monotonic()
+
+        # Collections triggered by the many new objects would take most of the time
+        gc_enabled = gc.isenabled()
+        gc.disable()
+
+        with self._lock:
+            self._loading = True
+
+        # Built aside, so that writers noting changes meanwhile are not held up
+        fresh = ReportSnapshot()
+        try:
+            with read_session:
+                fresh._build(db.select("%s FROM Believer ORDER BY id" % _columns))
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        with self._lock:
+            self.__dict__.update((name, value) for name, value in fresh.__dict__.items()
+                                 if name not in ('_lock', '_changed', 'loaded', '_loading'))
+            self.loaded = True
+            self._loading = False
+
+        memory = self.memory_usage()
+        logger.info("Loaded snapshot of %d reports in %.1f ms, %.1f MB (%.1f MB per 100k reports)",
+                    len(self._ids), (time.monotonic() - started) * 1000, memory / 1e6,
+                    memory / 1e6 * 100000 / max(len(self._ids), 1))
+
+    def _build(self, rows):
+        self._reset()
+        texts = []
+        postings = defaultdict(list)
+        for position, row in enumerate(rows):
+            self._append(row, ordered=False)
+            texts.append(_search_text(*row[1:5]))
+            for gram in _trigrams(texts[-1]):
+                postings[gram].append(position)
+
+        self._postings = {gram: array('i', positions) for gram, positions in postings.items()}
+        self._phone_keys = sorted(self._phone)
+        self._blocks = [_Block(texts[i:i + BLOCK_SIZE]) for i in range(0, len(texts), BLOCK_SIZE)]
+        self._rank()
+
+    def _rank(self):
+        ranked = sorted(range(len(self._ids)), key=lambda p: (self._created[p], self._ids[p]))
+        for rank, position in enumerate(ranked):
+            self._order[position] = rank
+        self._reorder = False
+
+    def changed(self, believer_id):
+        """ Note that a report was created, changed or deleted """
+        with self._lock:
+            if self.loaded or self._loading:
+                self._changed.add(believer_id)
+
+    def _append(self, row, ordered=True):
+        believer_id, _, _, _, _, phone_key, account_key, created = row
+        created = _timestamp(created)
+        # Reports are usually added newest last, which keeps the ranks valid
+        if self._created and (created, believer_id) < (self._created[-1], self._ids[-1]):
+            self._reorder = True
+        self._order.append(len(self._order))
+        self._ids.append(believer_id)
+        self._created.append(created)
+        self._live.append(1)
+        self._index_keys(believer_id, phone_key, account_key, ordered)
+
+    def _index_keys(self, believer_id, phone_key, account_key, ordered=True):
+        # While building, the phone keys are sorted once at the end instead
+        if ordered and phone_key and phone_key not in self._phone:
+            insort(self._phone_keys, phone_key)
+
+        for index, key in ((self._phone, phone_key), (self._account, account_key)):
+            if key:
+                ids = index.get(key)
+                if ids is None:
+                    index[key] = believer_id
+                else:
+                    index[key] = (ids if isinstance(ids, tuple) else (ids,)) + (believer_id,)
+
+    def _unindex_keys(self, believer_id, phone_key, account_key):
+        for index, key in ((self._phone, phone_key), (self._account, account_key)):
+            ids = index.get(key)
+            if ids is None:
+                continue
+            ids = tuple(i for i in (ids if isinstance(ids, tuple) else (ids,)) if i != believer_id)
+            if not ids:
+                del index[key]
+            else:
+                index[key] = ids[0] if len(ids) == 1 else ids
+
+        if phone_key and phone_key not in self._phone:
+            del self._phone_keys[bisect_left(self._phone_keys, phone_key)]
+
+    @staticmethod
+    def _lookup(index, key):
+        ids = index.get(key, ())
+        return ids if isinstance(ids, tuple) else (ids,)
+
+    def _text(self, position):
+        block = self._blocks[position // BLOCK_SIZE]
+        row = position % BLOCK_SIZE
+        end = block.starts[row + 1] - 1 if row + 1 < len(block.starts) else len(block.text)
+        return block.text[block.starts[row]:end]
+
+    def _fields(self, position):
+        """ Normalized phone number, Telegram ID, name and remark of the report at position """
+        text = self._text(position)
+        return text.split(FIELD_SEPARATOR) if text else ('', '', '', '')
+
+    def _index_text(self, position, old, new):
+        old_grams, new_grams = _trigrams(old), _trigrams(new)
+
+        for gram in old_grams - new_grams:
+            positions = self._postings[gram]
+            del positions[bisect_left(positions, position)]
+            if not positions:
+                del self._postings[gram]
+
+        for gram in new_grams - old_grams:
+            insort(self._postings.setdefault(gram, array('i')), position)
+
+    def _catch_up(self):
+        """ Re-read the reports changed since the last lookup """
+        if not self._changed:
+            return
+
+        changed, self._changed = self._changed, set()
+        rows = {row[0]: row for row in db.select(
+            "%s FROM Believer WHERE id IN (%s)" % (_columns, ', '.join(map(str, changed))))}
+
+        if any(self._ids and believer_id < self._ids[-1] and
+               self._position(believer_id, True) is None
+               for believer_id in rows):
+            # An id below the highest one, reused after a delete; rare enough to rebuild
+            self._build(db.select("%s FROM Believer ORDER BY id" % _columns))
+            return
+
+        rebuild = {}
+        for believer_id in sorted(changed):
+            position = self._position(believer_id, True)
+            row = rows.get(believer_id)
+
+            old = ''
+            if position is not None:
+                old = self._text(position)
+                phone_nr, account_nr, _, _ = self._fields(position)
+                self._unindex_keys(believer_id, phone_nr_key(phone_nr), account_nr_key(account_nr))
+            elif row is None:
+                continue
+
+            if row is None:
+                self._live[position] = 0
+                text = ''
+            else:
+                if position is None:
+                    position = len(self._ids)
+                    self._append(row)
+                else:
+                    if self._created[position] != _timestamp(row[7]):
+                        self._created[position] = _timestamp(row[7])
+                        self._reorder = True
+                    self._live[position] = 1
+                    self._index_keys(believer_id, row[5], row[6])
+                text = _search_text(*row[1:5])
+
+            self._index_text(position, old, text)
+            rebuild.setdefault(position // BLOCK_SIZE, {})[position % BLOCK_SIZE] = text
+
+        for number, texts in sorted(rebuild.items()):
+            block = self._blocks[number].texts() if number < len(self._blocks) else []
+            for row, text in sorted(texts.items()):
+                if row < len(block):
+                    block[row] = text
+                else:
+                    block.append(text)
+            if number < len(self._blocks):
+                self._blocks[number] = _Block(block)
+            else:
+                self._blocks.append(_Block(block))
+
+        if self._reorder:
+            self._rank()
+
+    def _position(self, believer_id, deleted=False):
+        """ Position of a report, None if it is unknown or deleted (unless deleted is set) """
+        position = bisect_left(self._ids, believer_id)
+        if position < len(self._ids) and self._ids[position] == believer_id \
+                and (deleted or self._live[position]):
+            return position
+        return None
+
+    def _exact(self, query):
+        """ Ids found by phone number or Telegram ID key, None if query looks like neither """
+        if query.startswith('@'):
+            return set(self._lookup(self._account, account_nr_key(query)))
+
+        if not is_phone_like(query):
+            return None
+
+        ids = set(self._lookup(self._account, account_nr_key(query)))
+
+        # Same rules as search_index: stored keys starting with the queried
+        # key, and stored keys of at least MIN_PHONE_DIGITS the queried key starts with
+        key = phone_nr_key(query)
+        i = bisect_left(self._phone_keys, key)
+        while i < len(self._phone_keys) and self._phone_keys[i].startswith(key):
+            ids.update(self._lookup(self._phone, self._phone_keys[i]))
+            i += 1
+        for length in range(MIN_PHONE_DIGITS, len(key)):
+            ids.update(self._lookup(self._phone, key[:length]))
+
+        return ids
+
+    def _find(self, needle):
+        """ Positions of the live reports whose search text contains needle """
+        if len(needle) < 3:
+            # Too short for the trigram index
+            return self._scan(needle)
+
+        lists = sorted((self._postings.get(gram, ()) for gram in _trigrams(needle)), key=len)
+        candidates = set(lists[0])
+        for positions in lists[1:]:
+            if len(candidates) < 32:
+                break
+            candidates.intersection_update(positions)
+
+        if len(needle) == 3:
+            return [p for p in candidates if self._live[p]]
+        if len(candidates) > len(self._ids) * SCAN_SHARE:
+            return self._scan(needle)
+        return [p for p in candidates if self._live[p] and needle in self._text(p)]
+
+    def _scan(self, needle):
+        """ Positions of the live reports containing needle, by scanning all text """
+        positions = []
+        for number, block in enumerate(self._blocks):
+            base = number * BLOCK_SIZE
+            positions.extend(base + row for row in block.find(needle))
+        return [p for p in positions if self._live[p]]
+
+    def _matches(self, query):
+        """ Positions of the reports a query finds, as search_index._match_condition """
+        exact = self._exact(query)
+        if exact:
+            return [p for p in map(self._position, exact) if p is not None]
+        return self._find(query)
+
+    def search_ids(self, query, offset=0, limit=1):
+        with self._lock:
+            self._catch_up()
+            found = heapq.nlargest(offset + limit, self._matches(query), key=self._order.__getitem__)
+            return [self._ids[p] for p in found[offset:]]
+
+    def older_ids(self, query, cursor, limit=1):
+        with self._lock:
+            self._catch_up()
+            position = self._position(cursor)
+            if position is None:
+                return []
+            order, before = self._order, self._order[position]
+            found = heapq.nlargest(limit, (p for p in self._matches(query) if order[p] < before),
+                                   key=order.__getitem__)
+            return [self._ids[p] for p in found]
+
+    def newer_ids(self, query, cursor, limit=1):
+        with self._lock:
+            self._catch_up()
+            position = self._position(cursor)
+            if position is None:
+                return []
+            order, after = self._order, self._order[position]
+            found = heapq.nsmallest(limit, (p for p in self._matches(query) if order[p] > after),
+                                    key=order.__getitem__)
+            return [self._ids[p] for p in found]
+
+    def memory_usage(self):
+        """ Approximate bytes held by the snapshot """
+        with self._lock:
+            size = sum(sys.getsizeof(column) for column in
+                       (self._ids, self._created, self._order, self._live,
+                        self._blocks,
+                        self._phone, self._account, self._phone_keys, self._postings))
+            size += sum(sys.getsizeof(block.text) + sys.getsizeof(block.starts)
+                        for block in self._blocks)
+            for index in (self._phone, self._account, self._postings):
+                size += sum(sys.getsizeof(key) + sys.getsizeof(ids) for key, ids in index.items())
+            return size
+
+    def __len__(self):
+        return sum(self._live)
+
+
+# Snapshot singleton, loaded in the background on startup if READ_SNAPSHOT is set
+snapshot = ReportSnapshot()
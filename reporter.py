@@ -4,6 +4,18 @@ from pony.orm import *
 from database import db
 
 
+def display_name(first_name, last_name, username):
+    """ How a reporter is shown on report cards """
+    s = first_name
+    if last_name:
+        s += " " + last_name
+
+    if username:
+        s += " (@%s)" % username
+
+    return s
+
+
 class Reporter(db.Entity):
     id = PrimaryKey(int, auto=False)
     first_name = Required(str)
@@ -13,14 +25,7 @@ class Reporter(db.Entity):
     created = Required(datetime.datetime, default=datetime.datetime.now)
 
     def __str__(self):
-        s = self.first_name
-        if self.last_name:
-            s += " " + self.last_name
-
-        if self.username:
-            s += " (@%s)" % self.username
-
-        return s
+        return display_name(self.first_name, self.last_name, self.username)
 
     def __repr__(self):
         return str(self)
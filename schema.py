@@ -0,0 +1,119 @@
+import logging
+import sqlite3
+
+from believer import phone_nr_key, account_nr_key, name_key
+import changelog
+import search_index
+
+logger = logging.getLogger(__name__)
+
+# Columns added to existing tables after their creation, with the SQL
+# expression used to fill them for rows that already exist
+_added_columns = {
+    'Believer': [
+        ('phone_nr_key', "TEXT NOT NULL DEFAULT ''", 'phone_nr_key(phone_nr)'),
+        ('account_nr_key', "TEXT NOT NULL DEFAULT ''", 'account_nr_key(account_nr)'),
+        ('voter_count', "INTEGER NOT NULL DEFAULT 0",
+         '(SELECT COUNT(*) FROM Believer_Reporter WHERE believer = Believer.id)'),
+        ('version', "INTEGER NOT NULL DEFAULT 0", '0'),
+    ],
+}
+
+# Columns added by later migrations, in the same form
+_name_key_column = {
+    'Believer': [
+        ('name_key', "TEXT NOT NULL DEFAULT ''", 'name_key(bank_name)'),
+    ],
+}
+
+_indexes = (
+    "CREATE INDEX IF NOT EXISTS idx_believer_phone_nr_key ON Believer(phone_nr_key)",
+    "CREATE INDEX IF NOT EXISTS idx_believer_account_nr_key ON Believer(account_nr_key)",
+)
+
+
+def _add_columns(connection, added_columns=_added_columns):
+    """
+    Tables created by Pony already have all columns; tables of databases
+    from before the columns were introduced get them added and backfilled.
+    """
+    for table, columns in added_columns.items():
+        existing = [row[1] for row in connection.execute('PRAGMA table_info("%s")' % table)]
+
+        for name, definition, backfill in columns:
+            if name not in existing:
+                connection.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s'
+                                   % (table, name, definition))
+                connection.execute('UPDATE "%s" SET "%s" = %s' % (table, name, backfill))
+
+
+def _create_indexes(connection):
+    for statement in _indexes:
+        connection.execute(statement)
+
+
+def _add_name_key(connection):
+    """ Normalized name column for finding duplicate reports, and its index """
+    with changelog.unlogged(connection, 'Believer'):
+        _add_columns(connection, _name_key_column)
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_believer_name_key ON Believer(name_key)")
+
+
+# Schema changes in the order they were introduced. A database records the
+# number of the last one applied; never renumber or edit applied migrations,
+# append new ones instead. They run after Pony created missing tables, and
+# the early ones tolerate databases that already had them applied before
+# schema versions were recorded.
+MIGRATIONS = [
+    (1, "Lookup key, voter count and version columns", _add_columns),
+    (2, "Indexes on the lookup keys", _create_indexes),
+    (3, "Trigram search index", search_index.create),
+    (4, "Change log", changelog.create),
+    (5, "Name lookup key", _add_name_key),
+    (6, "Change log index by row", changelog.create_row_index),
+]
+
+
+def schema_version(connection):
+    connection.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+    row = connection.execute('SELECT version FROM schema_version').fetchone()
+    return row[0] if row else 0
+
+
+def migrate(filename):
+    """
+    Apply the migrations the database does not have yet, each in its own
+    transaction together with the new schema version. Returns the number of
+    migrations applied.
+    """
+    connection = sqlite3.connect(filename, isolation_level=None)
+    connection.create_function('phone_nr_key', 1, phone_nr_key)
+    connection.create_function('account_nr_key', 1, account_nr_key)
+    connection.create_function('name_key', 1, name_key)
+
+    applied = 0
+
+    try:
+        version = schema_version(connection)
+
+        for number, description, migration in MIGRATIONS:
+            if number <= version:
+                continue
+
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                migration(connection)
+                connection.execute('DELETE FROM schema_version')
+                connection.execute('INSERT INTO schema_version (version) VALUES (?)', (number,))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+            logger.info("Applied schema migration %d: %s", number, description)
+            applied += 1
+
+    finally:
+        connection.close()
+
+    return applied
@@ -0,0 +1,272 @@
+from database import db
+from believer import is_phone_like, phone_nr_key, account_nr_key, MIN_PHONE_DIGITS
+
+# Columns of the Believer table that /search looks into
+SEARCH_COLUMNS = ('phone_nr', 'account_nr', 'bank_name', 'remark')
+
+# The trigram tokenizer can only match queries of at least this length
+MIN_QUERY_LENGTH = 3
+
+# Columns holding names, which are searched with typo tolerance
+FUZZY_COLUMNS = ('bank_name', 'remark')
+
+# Most results a name search returns; the carousel pages through them
+MAX_RANKED_RESULTS = 100
+
+# Similar names are added to the results of a name search when fewer than
+# this many reports contain the query exactly
+FUZZY_FILL = 10
+
+# Reports sharing trigrams with the query that are compared to it, best
+# ranked by the index first
+FUZZY_CANDIDATES = 500
+
+# Least trigram similarity of a name to the query to count as a match
+MIN_SIMILARITY = 0.3
+
+_columns = ', '.join(SEARCH_COLUMNS)
+_new_columns = ', '.join('new.' + c for c in SEARCH_COLUMNS)
+_old_columns = ', '.join('old.' + c for c in SEARCH_COLUMNS)
+
+# External content FTS5 table over Believer, kept in sync by triggers so that
+# every insert, update and delete done through Pony is reflected immediately
+_schema = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS BelieverSearch USING fts5("
+    "%s, content='Believer', content_rowid='id', tokenize='trigram')" % _columns,
+
+    "CREATE TRIGGER IF NOT EXISTS BelieverSearch_ai AFTER INSERT ON Believer BEGIN "
+    "INSERT INTO BelieverSearch(rowid, %s) VALUES (new.id, %s); "
+    "END" % (_columns, _new_columns),
+
+    "CREATE TRIGGER IF NOT EXISTS BelieverSearch_ad AFTER DELETE ON Believer BEGIN "
+    "INSERT INTO BelieverSearch(BelieverSearch, rowid, %s) "
+    "VALUES ('delete', old.id, %s); "
+    "END" % (_columns, _old_columns),
+
+    "CREATE TRIGGER IF NOT EXISTS BelieverSearch_au AFTER UPDATE OF %s ON Believer BEGIN "
+    "INSERT INTO BelieverSearch(BelieverSearch, rowid, %s) "
+    "VALUES ('delete', old.id, %s); "
+    "INSERT INTO BelieverSearch(rowid, %s) VALUES (new.id, %s); "
+    "END" % (_columns, _columns, _old_columns, _columns, _new_columns),
+
+    # Keyset pagination walks reports in (created, id) order
+    "CREATE INDEX IF NOT EXISTS idx_believer_created ON Believer(created, id)",
+)
+
+
+def create(connection):
+    """
+    Create the search index and its triggers on a sqlite3 connection,
+    filling it from the existing reports. Run as a schema migration.
+    """
+    exists = connection.execute("SELECT name FROM sqlite_master "
+                                "WHERE type = 'table' AND name = 'BelieverSearch'").fetchone()
+
+    for statement in _schema:
+        connection.execute(statement)
+
+    if not exists:
+        connection.execute("INSERT INTO BelieverSearch(BelieverSearch) VALUES ('rebuild')")
+
+
+def normalize_query(text):
+    """ Canonical form of a search query, used both as cache key and for searching """
+    return ' '.join(text.split()).lower()
+
+
+def is_name_query(query):
+    """ Whether query is looked up as a name, rather than as a phone number or Telegram ID """
+    return not query.startswith('@') and not is_phone_like(query)
+
+
+def trigrams(text):
+    """ Set of the three character sequences of the words of text, padded with spaces """
+    grams = set()
+    for word in normalize_query(text).split():
+        padded = ' %s ' % word
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(query, text):
+    """
+    Trigram similarity (0 to 1) of query to the closest run of as many
+    consecutive words in text, so a name is found inside a longer remark.
+    """
+    query_grams = trigrams(query)
+    if not query_grams or not text:
+        return 0.0
+
+    words = normalize_query(text).split()
+    width = min(len(query.split()), len(words)) or 1
+    best = 0.0
+
+    for i in range(max(len(words) - width + 1, 1)):
+        grams = trigrams(' '.join(words[i:i + width]))
+        if grams:
+            best = max(best, len(query_grams & grams) / float(len(query_grams | grams)))
+
+    return best
+
+
+def could_match(query, values):
+    """
+    Whether a report with one of the given field values could be found by
+    query. Used to decide which cached results a write makes stale.
+    """
+    for value in values:
+        if query in normalize_query(value):
+            return True
+
+        if is_name_query(query) and similarity(query, value) >= MIN_SIMILARITY:
+            return True
+
+        if query.startswith('@') or is_phone_like(query):
+            if account_nr_key(value) == account_nr_key(query):
+                return True
+
+            key, value_key = phone_nr_key(query), phone_nr_key(value)
+            if value_key.startswith(key) or \
+                    (len(value_key) >= MIN_PHONE_DIGITS and key.startswith(value_key)):
+                return True
+
+    return False
+
+
+def _match_expression(query):
+    """ Quote the query as a single FTS5 phrase, i.e. a substring match """
+    return '"%s"' % query.replace('"', '""')
+
+
+def _exact_condition(query):
+    """
+    Indexed equality lookup on the normalized phone number and Telegram ID
+    columns, for queries that look like one of them. Returns None otherwise.
+    """
+    if query.startswith('@'):
+        return "account_nr_key = $account", {'account': account_nr_key(query)}
+
+    if not is_phone_like(query):
+        return None
+
+    condition, params = phone_key_condition(phone_nr_key(query))
+    params['account'] = account_nr_key(query)
+    return "(account_nr_key = $account OR " + condition + ")", params
+
+
+def phone_key_condition(key):
+    """ Indexed SQL condition and parameters selecting reports with the phone number of key """
+    # The stored key is reversed, so a number stored with a country code
+    # has the queried key as prefix, and a number stored without one is a
+    # prefix of the queried key
+    params = {'key': key, 'key_end': key + ':'}
+    prefixes = []
+    for length in range(MIN_PHONE_DIGITS, len(key)):
+        params['prefix%d' % length] = key[:length]
+        prefixes.append('$prefix%d' % length)
+
+    condition = "(phone_nr_key >= $key AND phone_nr_key < $key_end)"
+    if prefixes:
+        condition += " OR phone_nr_key IN (%s)" % ', '.join(prefixes)
+
+    return "(" + condition + ")", params
+
+
+def _match_condition(query):
+    """ SQL condition and parameters selecting reports that contain query """
+    exact = _exact_condition(query)
+    if exact and db.select("1 FROM Believer WHERE " + exact[0] + " LIMIT 1", exact[1]):
+        return exact
+
+    if len(query) >= MIN_QUERY_LENGTH:
+        return ("id IN (SELECT rowid FROM BelieverSearch "
+                "WHERE BelieverSearch MATCH $match)",
+                {'match': _match_expression(query)})
+
+    # Too short for the trigram index, fall back to a scan. Pony turns on
+    # case_sensitive_like, so the values are lowered like the query, with
+    # Pony's py_lower for the same Unicode rules as the snapshot
+    pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    return ("(" + " OR ".join("py_lower(%s) LIKE $pattern ESCAPE '\\'" % c
+                              for c in SEARCH_COLUMNS) + ")",
+            {'pattern': pattern})
+
+
+def search_ids(query, offset=0, limit=1):
+    """
+    Return the ids of reports containing query in any of the search columns,
+    newest first.
+    """
+    condition, params = _match_condition(query)
+    params.update(limit=limit, offset=offset)
+    return db.select("id FROM Believer WHERE " + condition +
+                     " ORDER BY created DESC, id DESC LIMIT $limit OFFSET $offset",
+                     params)
+
+
+def older_ids(query, cursor, limit=1):
+    """
+    Keyset pagination: ids of matching reports that come after the report
+    with id cursor in newest first order.
+    """
+    condition, params = _match_condition(query)
+    params.update(cursor=cursor, limit=limit)
+    return db.select("id FROM Believer WHERE " + condition +
+                     " AND (created, id) < (SELECT created, id FROM Believer WHERE id = $cursor)"
+                     " ORDER BY created DESC, id DESC LIMIT $limit",
+                     params)
+
+
+def newer_ids(query, cursor, limit=1):
+    """
+    Keyset pagination: ids of matching reports that come before the report
+    with id cursor in newest first order, closest first.
+    """
+    condition, params = _match_condition(query)
+    params.update(cursor=cursor, limit=limit)
+    return db.select("id FROM Believer WHERE " + condition +
+                     " AND (created, id) > (SELECT created, id FROM Believer WHERE id = $cursor)"
+                     " ORDER BY created ASC, id ASC LIMIT $limit",
+                     params)
+
+
+def _fuzzy_expression(query):
+    """ FTS5 query for reports sharing any trigram with query in the name columns """
+    grams = sorted(g for g in set(normalize_query(query)[i:i + 3]
+                                  for i in range(len(query) - 2)) if g.strip())
+    return '{%s} : (%s)' % (' '.join(FUZZY_COLUMNS),
+                            ' OR '.join('"%s"' % g.replace('"', '""') for g in grams))
+
+
+def ranked_ids(query, limit=MAX_RANKED_RESULTS):
+    """
+    Ids of reports matching a name query, best first: reports containing the
+    query, then similar names if there are few of those, each ordered by
+    similarity, then by number of confirmations, then newest first.
+    """
+    condition, params = _match_condition(query)
+    params.update(limit=limit)
+    rows = db.select("id, voter_count, created FROM Believer WHERE " + condition +
+                     " ORDER BY voter_count DESC, created DESC, id DESC LIMIT $limit", params)
+
+    ranked = [(1.0, voter_count, created, believer_id)
+              for believer_id, voter_count, created in rows]
+
+    if len(ranked) < FUZZY_FILL and len(query) >= MIN_QUERY_LENGTH:
+        found = set(believer_id for believer_id, _, _ in rows)
+        fuzzy_params = {'match': _fuzzy_expression(query), 'candidates': FUZZY_CANDIDATES}
+
+        for believer_id, voter_count, created, bank_name, remark in db.select(
+                "b.id, b.voter_count, b.created, b.bank_name, b.remark "
+                "FROM (SELECT rowid FROM BelieverSearch WHERE BelieverSearch MATCH $match "
+                "      ORDER BY rank LIMIT $candidates) AS s "
+                "JOIN Believer AS b ON b.id = s.rowid", fuzzy_params):
+            if believer_id in found:
+                continue
+
+            score = max(similarity(query, bank_name), similarity(query, remark))
+            if score >= MIN_SIMILARITY:
+                ranked.append((score, voter_count, created, believer_id))
+
+    ranked.sort(reverse=True)
+    return [believer_id for _, _, _, believer_id in ranked[:limit]]
@@ -0,0 +1,71 @@
+import base64
+import os
+
+from conversation_state import ExpiringDict
+
+
+class SearchSession(object):
+    """ State of one search result carousel """
+
+    __slots__ = ('query', 'offset', 'cursor', 'disabled_attachments', 'confirmed',
+                 'show_download', 'ranked')
+
+    def __init__(self, query, cursor, confirmed, ranked=False):
+        self.query = query
+        # Ranked sessions page by position in search_index.ranked_ids instead of by date
+        self.ranked = ranked
+        self.offset = 0
+        self.cursor = cursor
+        self.disabled_attachments = set()
+        self.confirmed = confirmed
+        self.show_download = True
+
+    # Saved with the conversation state; a tuple pickles smaller and faster than the slots
+    def __getstate__(self):
+        return (self.query, self.offset, self.cursor, self.disabled_attachments, self.confirmed,
+                self.show_download, self.ranked)
+
+    def __setstate__(self, state):
+        (self.query, self.offset, self.cursor, self.disabled_attachments, self.confirmed,
+         self.show_download, self.ranked) = state
+
+
+def new_token():
+    """ Short random token that fits easily into callback_data """
+    return base64.urlsafe_b64encode(os.urandom(6)).decode()
+
+
+class SessionStore(object):
+    """
+    Bounded store of search sessions, addressed by short opaque tokens.
+
+    Sessions expire ttl seconds after they were last used; when the store is
+    full the least recently used session is evicted. The sessions mapping is
+    saved with the conversation states, so carousels outlive a restart.
+    """
+
+    def __init__(self, max_size=100000, ttl=24 * 60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sessions = ExpiringDict(ttl, max_size=max_size)
+
+    def create(self, session):
+        """ Store session and return its token """
+        token = new_token()
+        self.sessions[token] = session
+        return token
+
+    def get(self, token):
+        """ The session stored under token, or None if it expired """
+        session = self.sessions.get(token)
+        if session is not None:
+            # Paging changes the session in place; stored again, it is saved again
+            self.sessions[token] = session
+        return session
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+# Store singleton
+search_sessions = SessionStore()
@@ -1,13 +1,33 @@
-# Modify this file if you want a different startup sequence, for example using
-# a Webhook
+# Modify this file if you want a different startup sequence. Polling and the
+# built-in webhook server can be selected without editing it, see config.py
 from credentials import TOKEN
+from config import MODE, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_MAX_PENDING
 
-BASE_URL = ''
-HOST = ''
-PORT = 0
+
+def start_webhook(updater, base_url=WEBHOOK_URL, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                  url_path=TOKEN, max_pending=WEBHOOK_MAX_PENDING):
+    """
+    Serve updates through the built-in webhook server. The Updater only
+    runs the dispatcher; stopping it shuts the server down as well.
+    """
+    from webhook import WebhookServer
+
+    server = WebhookServer(updater.bot, updater.update_queue, listen, port, url_path,
+                           max_pending=max_pending)
+    server.start()
+
+    updater.running = True
+    updater.httpd = server
+    updater._init_thread(updater.dispatcher.start, "dispatcher")
+
+    if base_url:
+        updater.bot.setWebhook(webhook_url='%s/%s' % (base_url.rstrip('/'), url_path))
+
+    return server
 
 
 def start_bot(updater):
-    updater.start_polling()
-    # updater.bot.setWebhook(webhook_url='https://%s/%s' % (BASE_URL, TOKEN))
-    # updater.start_webhook(HOST, PORT, url_path=TOKEN)
+    if MODE == 'webhook':
+        start_webhook(updater)
+    else:
+        updater.start_polling()
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# The bot's modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ADMIN_ID = 1
+
+
+@pytest.fixture(scope='session')
+def database(tmp_path_factory):
+    """ The bot's database, set up in a temporary file once for all tests """
+    from application import Application
+
+    path = str(tmp_path_factory.mktemp('db') / 'test.sqlite')
+    Application(db_name=path, super_admins='%d:Admin' % ADMIN_ID).setup_database()
+    return path
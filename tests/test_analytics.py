@@ -0,0 +1,55 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from telegram import Message
+
+
+class Collector(BaseHTTPRequestHandler):
+    """ Stands in for an analytics endpoint, failing the first request """
+
+    batches = []
+    failures = 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if Collector.failures:
+            Collector.failures -= 1
+            self.send_response(500)
+        else:
+            Collector.batches.append(json.loads(body.decode()))
+            self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def message(message_id):
+    user = {'id': 30, 'first_name': 'User'}
+    return Message.de_json({'message_id': message_id, 'from': user, 'date': int(time.time()),
+                            'chat': dict(user, type='private'), 'text': '/search'}, None)
+
+
+def test_http_sink_posts_batches_and_retries():
+    from analytics import EventQueue, HttpSink
+
+    server = HTTPServer(('127.0.0.1', 0), Collector)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        url = 'http://127.0.0.1:%d/events' % server.server_port
+        events = EventQueue(HttpSink(url), batch_size=2, flush_interval=60, backoff=0)
+        for i in range(3):
+            events.track(message(i), 'search')
+        events.run_once()
+
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert [[(event['uid'], event['name'], event['message']['message_id']) for event in batch]
+            for batch in Collector.batches] == [[(30, 'search', 0), (30, 'search', 1)],
+                                                [(30, 'search', 2)]]
+    assert events.stats() == {'queued': 0, 'sent': 3, 'dropped': 0, 'failed': 0}
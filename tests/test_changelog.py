@@ -0,0 +1,51 @@
+import sqlite3
+
+import pytest
+
+import changelog
+
+
+def logged_database(path):
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+        CREATE TABLE Admin (id INTEGER PRIMARY KEY, first_name TEXT);
+        CREATE TABLE Reporter (id INTEGER PRIMARY KEY, first_name TEXT);
+        CREATE TABLE Believer (id INTEGER PRIMARY KEY, bank_name TEXT);
+        CREATE TABLE Believer_Reporter (believer INTEGER, reporter INTEGER,
+                                        PRIMARY KEY (believer, reporter));
+    ''')
+    changelog.create(connection)
+    changelog.create_row_index(connection)
+    return connection
+
+
+def test_prune_keeps_the_deltas_after_the_horizon(tmp_path):
+    from export import write_changes
+
+    path = str(tmp_path / 'log.sqlite')
+    connection = logged_database(path)
+    try:
+        connection.executescript('''
+            INSERT INTO Believer (id, bank_name) VALUES (1, 'Andi'), (2, 'Budi');
+            UPDATE Believer SET bank_name = 'Andi S' WHERE id = 1;
+            UPDATE Believer SET bank_name = 'Andi Santoso' WHERE id = 1;
+            DELETE FROM Believer WHERE id = 2;
+            INSERT INTO Believer (id, bank_name) VALUES (3, 'Citra');
+            UPDATE Believer SET bank_name = 'Citra Dewi' WHERE id = 3;
+        ''')
+        before = list(changelog.changes(connection, 3, 7))
+
+        connection.commit()
+        # Up to the horizon at 3, and the insert at 6 superseded by the update at 7
+        assert changelog.prune(connection, keep=4) == 4
+        assert [row[0] for row in connection.execute('SELECT seq FROM ChangeLog')] == [4, 5, 7]
+        assert list(changelog.changes(connection, 3, 7)) == before
+
+    finally:
+        connection.close()
+
+    with pytest.raises(changelog.ChangesPruned):
+        write_changes(path, 2, keep=4)
+    changes, until, count = write_changes(path, 3, keep=4)
+    changes.close()
+    assert (until, count) == (7, 3)
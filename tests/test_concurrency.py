@@ -0,0 +1,113 @@
+import threading
+import time
+
+from pony.orm import flush
+from telegram import Update
+from telegram.utils.promise import Promise
+
+from conftest import ADMIN_ID
+
+
+class FakeBot(object):
+    """ Records the messages handlers send instead of calling the Bot API """
+
+    def __init__(self):
+        self.sent = []
+
+    def sendMessage(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+    send_message = sendMessage
+
+
+def message_update(bot, user_id, text, update_id=1):
+    user = {'id': user_id, 'first_name': 'User %d' % user_id}
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'from': user, 'date': int(time.time()),
+                    'chat': dict(user, type='private'), 'text': text},
+    }, bot)
+
+
+class FakeDispatcher(object):
+    def __init__(self, bot):
+        self.bot = bot
+
+
+def test_reads_proceed_during_write(database):
+    from believer import Believer
+    from database import db, read_session, write_session
+    from admin import Admin
+    import search_index
+
+    writing = threading.Event()
+    release = threading.Event()
+
+    def write():
+        with write_session:
+            believer = Believer(added_by=Admin[ADMIN_ID])
+            believer.set_bank_name('Pending Trader')
+            flush()
+            # Holds the write transaction open until the reads are done
+            writing.set()
+            release.wait(10)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+
+    try:
+        assert writing.wait(5)
+
+        started = time.monotonic()
+        with read_session:
+            ids = search_index.search_ids('pending trader', limit=5)
+            count = db.select('COUNT(*) FROM Believer')[0]
+        elapsed = time.monotonic() - started
+
+        assert elapsed < 1
+        # The write is not committed yet
+        assert ids == []
+        assert count == 0
+
+    finally:
+        release.set()
+        writer.join()
+
+    with read_session:
+        assert len(search_index.search_ids('pending trader', limit=5)) == 1
+
+
+def test_pending_step_does_not_block_dispatcher():
+    import bot as handlers
+
+    fake_bot = FakeBot()
+    conversation = handlers.conv_search
+    follow_up = message_update(fake_bot, 10, 'second query', update_id=2)
+    other = message_update(fake_bot, 20, '/search', update_id=3)
+    later = message_update(fake_bot, 10, 'third query', update_id=4)
+
+    # User 10's search_2 still runs on a worker, for another two seconds
+    pending = Promise(lambda: handlers.WAIT, (), {})
+    conversation.conversations[(10, 10)] = (handlers.WAIT, pending)
+    worker = threading.Timer(2, pending.run)
+    worker.start()
+
+    try:
+        started = time.monotonic()
+        assert conversation.check_update(follow_up)
+        assert conversation.current_handler is handlers.busy_handler
+        conversation.handle_update(follow_up, FakeDispatcher(fake_bot))
+        assert conversation.check_update(other)
+        elapsed = time.monotonic() - started
+
+        assert elapsed < 0.5
+        assert fake_bot.sent == [(10, handlers.BUSY)]
+
+        # Once the step finished, the user's conversation continues as usual
+        worker.join()
+        assert conversation.check_update(later)
+        assert conversation.current_handler is not handlers.busy_handler
+
+    finally:
+        worker.cancel()
+        conversation.conversations.pop((10, 10), None)
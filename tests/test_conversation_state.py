@@ -0,0 +1,118 @@
+import os
+
+from conversation_state import ConversationState
+
+
+def restored(path):
+    state = ConversationState(path)
+    state.load()
+    return state
+
+
+def test_reads_are_not_changes(tmp_path):
+    state = ConversationState(str(tmp_path / 'state.pickle'))
+    conversations = state.conversations('edit')
+    conversations[1] = 2
+    state.user_data[1]['option'] = 'remark'
+    state.snapshot()
+
+    assert conversations.get(1) == 2
+    assert 1 in conversations and 1 in state.user_data
+    assert not conversations.dirty and not state.user_data.dirty
+
+    # Handlers fill in the user_data they are handed
+    state.user_data[1]
+    assert state.user_data.dirty
+
+
+def test_snapshots_append_changes(tmp_path):
+    path = str(tmp_path / 'state.pickle')
+    state = ConversationState(path)
+    state.load()
+    conversations = state.conversations('edit')
+    for user_id in range(3):
+        state.user_data[user_id]['option'] = 'remark'
+        conversations[user_id] = 2
+    state.snapshot()
+    size = os.path.getsize(path)
+
+    state.user_data[0]['option'] = 'phone_nr'
+    conversations[1] = 3
+    del conversations[2]
+    state.snapshot()
+    assert os.path.getsize(path) < 2 * size
+
+    loaded = restored(path)
+    assert dict(loaded.user_data.items()) == {0: {'option': 'phone_nr'},
+                                              1: {'option': 'remark'},
+                                              2: {'option': 'remark'}}
+    assert dict(loaded.conversations('edit').items()) == {0: 2, 1: 3}
+
+    # A restored log is appended to
+    loaded.conversations('edit')[2] = 4
+    loaded.snapshot()
+    assert restored(path).conversations('edit').get(2) == 4
+
+
+def test_log_is_compacted(tmp_path, monkeypatch):
+    import conversation_state
+    monkeypatch.setattr(conversation_state, 'COMPACT_MIN', 10)
+
+    path = str(tmp_path / 'state.pickle')
+    state = ConversationState(path)
+    conversations = state.conversations('edit')
+    sizes = []
+    for i in range(50):
+        conversations[1] = i
+        conversations[2] = i
+        state.snapshot()
+        sizes.append(os.path.getsize(path))
+
+    # Rewritten once it holds COMPACT_MIN records, so it stops growing after that
+    assert max(sizes) == max(sizes[:5])
+    assert dict(restored(path).conversations('edit').items()) == {1: 49, 2: 49}
+
+
+def test_incomplete_record_is_dropped(tmp_path):
+    path = str(tmp_path / 'state.pickle')
+    state = ConversationState(path)
+    state.conversations('edit')[1] = 2
+    state.snapshot()
+    size = os.path.getsize(path)
+    state.conversations('edit')[1] = 3
+    state.snapshot()
+
+    # Cut off while the second record was written
+    os.truncate(path, size + 5)
+
+    loaded = restored(path)
+    assert loaded.conversations('edit').get(1) == 2
+    assert os.path.getsize(path) == size
+
+    loaded.conversations('edit')[2] = 4
+    loaded.snapshot()
+    assert dict(restored(path).conversations('edit').items()) == {1: 2, 2: 4}
+
+
+def test_search_sessions_survive_restart(tmp_path):
+    from sessions import SearchSession, SessionStore
+
+    path = str(tmp_path / 'state.pickle')
+    store = SessionStore()
+    state = ConversationState(path)
+    state.add_store('search_sessions', store.sessions)
+    token = store.create(SearchSession('qx trader', 5, False))
+    state.snapshot()
+
+    session = store.get(token)
+    session.offset, session.cursor = 1, 3
+    session.disabled_attachments.add(1)
+    state.snapshot()
+
+    restarted = SessionStore()
+    state = ConversationState(path)
+    state.add_store('search_sessions', restarted.sessions)
+    state.load()
+    session = restarted.get(token)
+    assert (session.query, session.offset, session.cursor, session.disabled_attachments) == \
+        ('qx trader', 1, 3, {1})
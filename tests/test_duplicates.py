@@ -0,0 +1,27 @@
+from believer import phone_nr_key, account_nr_key, name_key
+from duplicates import duplicate_groups
+
+
+def row(report_id, phone_nr='', account_nr='', bank_name=''):
+    return report_id, phone_nr_key(phone_nr), account_nr_key(account_nr), name_key(bank_name)
+
+
+def test_groups_phone_numbers_with_and_without_country_code():
+    rows = [row(1, '+62 812 3456 789'), row(2, '0812 3456 789'), row(3, '0812-3456-789')]
+    assert duplicate_groups(rows) == [[1, 2, 3]]
+
+
+def test_groups_country_code_after_local_number():
+    rows = [row(1, '0812 3456 789', bank_name='Budi'), row(2, '+62 812 3456 789')]
+    assert duplicate_groups(rows) == [[1, 2]]
+
+
+def test_keeps_contradicting_reports_apart():
+    rows = [row(1, '0812 3456 789', '@budi'), row(2, '+62 812 3456 789', '@andi'),
+            row(3, '0812 3456 780'), row(4, account_nr='@Budi', bank_name='Budi')]
+    assert duplicate_groups(rows) == [[1, 4]]
+
+
+def test_short_numbers_only_group_when_equal():
+    rows = [row(1, '12345'), row(2, '912345'), row(3, '12345')]
+    assert duplicate_groups(rows) == [[1, 3]]
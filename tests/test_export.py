@@ -0,0 +1,47 @@
+import gzip
+import os
+
+from pony.orm import flush
+
+from conftest import ADMIN_ID
+
+
+def test_open_snapshot_survives_a_newer_one(database):
+    from admin import Admin
+    from believer import Believer
+    from database import write_session
+    from export import DatabaseExport
+
+    export = DatabaseExport(database)
+    with export.open_snapshot() as first:
+        # Unchanged data, same snapshot
+        with export.open_snapshot() as again:
+            assert again.name == first.name
+
+        with write_session:
+            believer = Believer(added_by=Admin[ADMIN_ID])
+            believer.set_bank_name('Exported Trader')
+            flush()
+            believer_id = believer.id
+
+        try:
+            with export.open_snapshot() as second:
+                assert second.name != first.name
+
+            # The replaced snapshot is removed, but still readable through the open handle
+            with gzip.GzipFile(fileobj=first) as packed:
+                assert packed.read(16) == b'SQLite format 3\x00'
+
+        finally:
+            with write_session:
+                Believer[believer_id].delete()
+
+
+def test_stop_removes_the_snapshot(database):
+    from export import DatabaseExport
+
+    export = DatabaseExport(database)
+    with export.open_snapshot() as exported:
+        export.stop()
+        assert not os.path.exists(exported.name)
+        assert export.path is None
@@ -0,0 +1,33 @@
+from pony.orm import flush
+from telegram import User
+
+from conftest import ADMIN_ID
+
+
+def test_card_shows_renamed_voters(database):
+    from admin import Admin
+    from believer import Believer
+    from database import read_session, write_session
+    from identity import identities
+    from reporter import Reporter
+
+    with write_session:
+        believer = Believer(added_by=Admin[ADMIN_ID])
+        believer.add_voter(Reporter(id=104, first_name='Old Name'))
+        flush()
+        believer_id = believer.id
+
+    try:
+        with read_session:
+            assert "Voted by: Old Name\n" in str(Believer[believer_id])
+
+        identities.seen(Reporter, User(104, 'New Name'))
+        identities.flush()
+
+        with read_session:
+            assert "Voted by: New Name\n" in str(Believer[believer_id])
+
+    finally:
+        with write_session:
+            Believer[believer_id].delete()
+            Reporter[104].delete()
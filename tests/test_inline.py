@@ -0,0 +1,76 @@
+from pony.orm import flush
+from telegram import Update
+
+from conftest import ADMIN_ID
+
+
+class FakeBot(object):
+    """ Records the answers to inline queries instead of calling the Bot API """
+
+    def __init__(self):
+        self.answers = []
+
+    def answerInlineQuery(self, inline_query_id, results, **kwargs):
+        self.answers.append(([result.id for result in results], kwargs))
+
+    answer_inline_query = answerInlineQuery
+
+
+def inline_update(bot, user_id, query):
+    return Update.de_json({
+        'update_id': 1,
+        'inline_query': {'id': '1', 'from': {'id': user_id, 'first_name': 'User'},
+                         'query': query, 'offset': ''},
+    }, bot)
+
+
+def test_inline_queries_search_until_the_prefix_index_is_loaded(database):
+    from admin import Admin
+    from believer import Believer
+    from database import write_session
+    from prefix_index import typeahead
+    import bot
+
+    with write_session:
+        believer = Believer(added_by=Admin[ADMIN_ID])
+        believer.set_bank_name('Inline Zyrkon')
+        believer.set_phone_nr('+62 812 555 0101')
+        flush()
+        believer_id = believer.id
+
+    fake = FakeBot()
+    try:
+        assert not typeahead.loaded
+        # Contained in the name, found by the search
+        bot.inline_search(fake, inline_update(fake, 20, 'yrkon'))
+
+        typeahead.load()
+        # The prefix index only finds words starting with the query
+        bot.inline_search(fake, inline_update(fake, 20, 'yrkon'))
+        bot.inline_search(fake, inline_update(fake, 20, '+62 812 5'))
+
+    finally:
+        with write_session:
+            Believer[believer_id].delete()
+        typeahead.remove(believer_id)
+
+    assert [ids for ids, _ in fake.answers] == [[str(believer_id)], [], [str(believer_id)]]
+    assert fake.answers[0][1]['cache_time'] == 0
+
+
+def test_pages_list_each_report_once(database):
+    from prefix_index import PrefixIndex
+
+    index = PrefixIndex()
+    index.load()
+    # Found under both "qyv qyvo" and "qyvo"
+    index.refresh(1001, '', '', 'Qyv Qyvo')
+    index.refresh(1002, '', '', 'Qyvx')
+
+    pages = []
+    offset = 0
+    while offset is not None:
+        ids, offset = index.lookup('qyv', offset, limit=1)
+        pages.append(ids)
+
+    assert pages == [[1001], [1002]]
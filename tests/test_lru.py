@@ -0,0 +1,54 @@
+from lru import ExpiringLRU
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_evicts_least_recently_used():
+    cache = ExpiringLRU(max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert list(cache) == ['a', 'c']
+
+
+def test_entries_expire_unless_refreshed():
+    clock = Clock()
+    cache = ExpiringLRU(ttl=10, clock=clock)
+    cache.put('a', 1)
+    cache.put('b', 2)
+
+    clock.now = 8
+    assert cache.get('a') == 1
+    assert cache.get('b', refresh=False) == 2
+
+    clock.now = 15
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.drop_expired() == 1
+    assert cache.items() == [('a', 1)]
+
+
+def test_put_keeps_given_expiry():
+    clock = Clock()
+    cache = ExpiringLRU(ttl=10, clock=clock)
+    cache.put('a', 1, expires=3)
+    clock.now = 5
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_extend_skips_expired_and_keeps_order():
+    clock = Clock()
+    cache = ExpiringLRU(max_size=2, ttl=10, clock=clock)
+    clock.now = 5
+    cache.extend({'a': (3, 1), 'b': (12, 2), 'c': (8, 3), 'd': (14, 4)})
+    assert cache.items() == [('c', 3), ('d', 4)]
+    assert cache.peek('c') == (8, 3)
+    assert list(cache) == ['c', 'd']
@@ -0,0 +1,90 @@
+import threading
+
+from telegram.error import RetryAfter
+
+from outbox import Outbox, NORMAL
+
+
+def make_outbox():
+    outbox = Outbox(rate=1000, chat_rate=1000, chat_burst=1000, senders=1)
+    outbox.start()
+    return outbox
+
+
+def test_sends_and_returns_result():
+    outbox = make_outbox()
+    try:
+        assert outbox.submit(lambda: 'sent', chat_id=1).result(timeout=5) == 'sent'
+    finally:
+        outbox.stop()
+
+
+def test_coalesces_queued_edits():
+    outbox = make_outbox()
+    release = threading.Event()
+    sent = []
+
+    try:
+        # Keeps the only sender busy, so both edits are queued together
+        blocker = outbox.submit(release.wait, chat_id=1)
+        first = outbox.submit(lambda: sent.append(1) or 1, chat_id=2, key=('edit', 2, 10))
+        second = outbox.submit(lambda: sent.append(2) or 2, chat_id=2, key=('edit', 2, 10))
+        release.set()
+
+        assert first is second
+        assert second.result(timeout=5) == 2
+        blocker.result(timeout=5)
+        assert sent == [2]
+        assert outbox.coalesced == 1
+    finally:
+        outbox.stop()
+
+
+def test_retry_after_with_newer_edit_queued():
+    outbox = make_outbox()
+    key = ('edit', 2, 10)
+    attempts = []
+    holder = {}
+
+    def first_edit():
+        attempts.append('first')
+        if len(attempts) == 1:
+            # The message is edited again while this edit is being sent
+            holder['second'] = outbox.submit(second_edit, chat_id=2, priority=NORMAL, key=key)
+            raise RetryAfter(0)
+        return 'first'
+
+    def second_edit():
+        attempts.append('second')
+        return 'second'
+
+    try:
+        first = outbox.submit(first_edit, chat_id=2, key=key)
+
+        assert first.result(timeout=5) == 'second'
+        assert holder['second'].result(timeout=5) == 'second'
+        assert attempts == ['first', 'second']
+
+        # The sender survived and still delivers everything else
+        assert outbox.submit(lambda: 'later', chat_id=3).result(timeout=5) == 'later'
+        assert outbox.stats()['queued'] == 0
+        assert outbox.retried == 1
+    finally:
+        outbox.stop()
+
+
+def test_retry_after_resends_request():
+    outbox = make_outbox()
+    attempts = []
+
+    def edit():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RetryAfter(0)
+        return 'edited'
+
+    try:
+        assert outbox.submit(edit, chat_id=2, key=('edit', 2, 10)).result(timeout=5) == 'edited'
+        assert len(attempts) == 2
+    finally:
+        outbox.stop()
@@ -0,0 +1,25 @@
+from query_cache import QueryCache
+
+
+def test_put_after_invalidation_is_dropped():
+    cache = QueryCache()
+    key = ('search_ids', 'budi', (), ())
+
+    generation = cache.generation
+    assert cache.get(key) is None
+    # A report is written while the search runs
+    cache.invalidate(7, ['Budi'])
+    cache.put(key, 'budi', [3], generation)
+    assert cache.get(key) is None
+
+    generation = cache.generation
+    cache.put(key, 'budi', [7, 3], generation)
+    assert cache.get(key) == [7, 3]
+
+
+def test_clear_starts_a_new_generation():
+    cache = QueryCache()
+    generation = cache.generation
+    cache.clear()
+    cache.put('key', 'budi', [1], generation)
+    assert cache.get('key') is None
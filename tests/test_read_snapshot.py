@@ -0,0 +1,88 @@
+import datetime
+
+from pony.orm import flush
+
+from conftest import ADMIN_ID
+
+QUERIES = ('+49 171 2345678', '01712345', '@seller', 'qx', 'trader', 'fake ps5', 'ps', 'zz top')
+
+
+def add_report(phone_nr='', account_nr='', bank_name='Qx Trader', remark='', days=0):
+    from admin import Admin
+    from believer import Believer
+
+    believer = Believer(added_by=Admin[ADMIN_ID], remark=remark,
+                        created=datetime.datetime(2020, 1, 1) + datetime.timedelta(days=days))
+    believer.set_phone_nr(phone_nr)
+    believer.set_account_nr(account_nr)
+    believer.set_bank_name(bank_name)
+    flush()
+    return believer.id
+
+
+def assert_same_results(snapshot):
+    from database import read_session
+    import search_index
+
+    with read_session:
+        for text in QUERIES:
+            query = search_index.normalize_query(text)
+            expected = search_index.search_ids(query, limit=50)
+            assert snapshot.search_ids(query, limit=50) == expected, text
+            assert snapshot.search_ids(query, offset=1, limit=2) == expected[1:3], text
+
+            for cursor in expected:
+                assert snapshot.older_ids(query, cursor, 50) == \
+                    search_index.older_ids(query, cursor, 50), text
+                assert snapshot.newer_ids(query, cursor, 50) == \
+                    search_index.newer_ids(query, cursor, 50), text
+
+
+def test_snapshot_answers_like_the_database(database):
+    from believer import Believer
+    from database import write_session
+    from read_snapshot import ReportSnapshot
+
+    with write_session:
+        ids = [add_report('+49 171 2345678', bank_name='Qx Trader', days=3),
+               add_report('0171 23456', '@seller', 'Second Trader', 'Sold a fake PS5', days=1),
+               add_report('', '@seller2', 'ZZ Top', days=2),
+               add_report('+1 555 0100', '', 'Other', 'ps', days=2)]
+
+    snapshot = ReportSnapshot()
+    try:
+        snapshot.load()
+        assert_same_results(snapshot)
+
+        # Inserted, including one created before the others
+        with write_session:
+            ids.append(add_report('+49 171 2345678 9', '@seller', 'Qx', days=5))
+            ids.append(add_report('', '', 'Old Trader', 'fake ps5 again', days=-1))
+        snapshot.changed(ids[-2])
+        snapshot.changed(ids[-1])
+        assert_same_results(snapshot)
+
+        # Updated: new keys, name and creation time
+        with write_session:
+            believer = Believer[ids[0]]
+            believer.set_phone_nr('+33 600 000000')
+            believer.set_account_nr('@seller')
+            believer.set_bank_name('ZZ Trader')
+            believer.created = datetime.datetime(2019, 1, 1)
+        snapshot.changed(ids[0])
+        assert_same_results(snapshot)
+
+        # Deleted
+        with write_session:
+            Believer[ids[1]].delete()
+            Believer[ids[3]].delete()
+        snapshot.changed(ids[1])
+        snapshot.changed(ids[3])
+        assert_same_results(snapshot)
+
+    finally:
+        with write_session:
+            for believer_id in ids:
+                believer = Believer.get(id=believer_id)
+                if believer:
+                    believer.delete()
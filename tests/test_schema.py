@@ -0,0 +1,41 @@
+import sqlite3
+
+import schema
+
+
+def test_name_key_backfill_is_not_logged(tmp_path, monkeypatch):
+    path = str(tmp_path / 'old.sqlite')
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+        CREATE TABLE Admin (id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT,
+                            username TEXT, super_admin BOOLEAN, created TEXT);
+        CREATE TABLE Reporter (id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT,
+                               username TEXT, created TEXT);
+        CREATE TABLE Believer (id INTEGER PRIMARY KEY, phone_nr TEXT, account_nr TEXT,
+                               bank_name TEXT, remark TEXT, attached_file TEXT,
+                               added_by INTEGER, created TEXT);
+        CREATE TABLE Believer_Reporter (believer INTEGER, reporter INTEGER,
+                                        PRIMARY KEY (believer, reporter));
+        INSERT INTO Believer (bank_name, remark) VALUES ('Budi  Santoso', ''), ('Andi', '');
+    ''')
+    connection.commit()
+    connection.close()
+
+    # A database from before the name lookup key
+    monkeypatch.setattr(schema, 'MIGRATIONS', schema.MIGRATIONS[:4])
+    schema.migrate(path)
+    monkeypatch.undo()
+    assert schema.migrate(path) == len(schema.MIGRATIONS) - 4
+
+    connection = sqlite3.connect(path)
+    try:
+        assert connection.execute('SELECT name_key FROM Believer ORDER BY id').fetchall() == \
+            [('budi santoso',), ('andi',)]
+        assert connection.execute('SELECT COUNT(*) FROM ChangeLog').fetchone()[0] == 0
+
+        # Later updates are logged again
+        connection.execute("UPDATE Believer SET remark = 'scam' WHERE id = 1")
+        assert connection.execute('SELECT name, row_id, op FROM ChangeLog').fetchall() == \
+            [('Believer', 1, 'u')]
+    finally:
+        connection.close()
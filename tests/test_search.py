@@ -0,0 +1,26 @@
+from pony.orm import flush
+
+from conftest import ADMIN_ID
+
+
+def test_short_queries_ignore_case(database):
+    from admin import Admin
+    from believer import Believer
+    from database import read_session, write_session
+    import search_index
+
+    with write_session:
+        believer = Believer(added_by=Admin[ADMIN_ID], remark='Sold a Fake PS5')
+        believer.set_bank_name('Qx Trader')
+        flush()
+        believer_id = believer.id
+
+    try:
+        with read_session:
+            for query in ('qx', 'Qx', 'ps', 'ke p'):
+                assert search_index.search_ids(search_index.normalize_query(query),
+                                               limit=5) == [believer_id]
+
+    finally:
+        with write_session:
+            Believer[believer_id].delete()
@@ -0,0 +1,77 @@
+from pony.orm import flush
+from telegram import User
+
+from conftest import ADMIN_ID
+
+
+def test_card_lists_pending_voters(database):
+    from admin import Admin
+    from believer import Believer
+    from database import read_session, write_session
+    from reporter import Reporter
+    from votes import votes
+
+    with write_session:
+        believer = Believer(added_by=Admin[ADMIN_ID])
+        believer.set_bank_name('Voted Trader')
+        believer.add_voter(Reporter(id=101, first_name='Stored'))
+        flush()
+        believer_id = believer.id
+
+    try:
+        votes.toggle(believer_id, User(102, 'Pending', username='pending'), stored=lambda: False)
+        votes.toggle(believer_id, User(101, 'Stored'), stored=lambda: True)
+
+        with read_session:
+            card = str(Believer[believer_id])
+        assert "Voted by: Pending (@pending)\n" in card
+
+        votes.flush()
+        with read_session:
+            assert str(Believer[believer_id]) == card
+
+    finally:
+        with write_session:
+            Believer[believer_id].delete()
+
+
+def test_toggles_follow_the_buffer(database):
+    from admin import Admin
+    from believer import Believer
+    from database import read_session, write_session
+    from votes import votes
+
+    with write_session:
+        believer = Believer(added_by=Admin[ADMIN_ID])
+        flush()
+        believer_id = believer.id
+
+    def buffered():
+        raise AssertionError("the database is read although the vote is buffered")
+
+    user = User(103, 'Toggler')
+
+    try:
+        assert votes.toggle(believer_id, user, stored=lambda: False)
+        assert not votes.toggle(believer_id, user, stored=buffered)
+
+        # Cancelled out: nothing to write and nothing left to look through
+        votes.flush()
+        assert believer_id not in votes._delta
+        assert votes.pending_voters(believer_id) == ()
+
+        assert votes.toggle(believer_id, user, stored=lambda: False)
+        votes.flush()
+
+        with read_session:
+            stored = Believer[believer_id]
+            assert not votes.toggle(believer_id, user,
+                                    stored=lambda: stored.has_stored_voter(user.id))
+        votes.flush()
+
+        with read_session:
+            assert not Believer[believer_id].has_stored_voter(user.id)
+
+    finally:
+        with write_session:
+            Believer[believer_id].delete()
@@ -0,0 +1,52 @@
+import json
+import time
+from queue import Queue
+from urllib.request import Request, urlopen
+
+
+def post(server, update_id):
+    data = json.dumps({'update_id': update_id}).encode()
+    request = Request('http://127.0.0.1:%d/hook' % server.port, data=data,
+                      headers={'Content-Type': 'application/json'})
+    with urlopen(request, timeout=5) as response:
+        return response.status
+
+
+def test_acknowledged_updates_survive_shutdown():
+    from webhook import WebhookServer
+
+    update_queue = Queue()
+    # The dispatcher is behind, so the pump holds the updates back
+    update_queue.put('backlog')
+    server = WebhookServer(None, update_queue, '127.0.0.1', 0, 'hook', max_backlog=1)
+    server.start()
+
+    assert [post(server, update_id) for update_id in range(3)] == [200, 200, 200]
+    time.sleep(0.1)
+    assert update_queue.qsize() == 1
+
+    server.shutdown()
+    assert not server.accept({'update_id': 3})
+
+    assert update_queue.get_nowait() == 'backlog'
+    assert [update_queue.get_nowait().update_id for _ in range(3)] == [0, 1, 2]
+    assert update_queue.empty()
+
+
+def test_pump_follows_the_dispatcher():
+    from webhook import WebhookServer
+
+    update_queue = Queue()
+    server = WebhookServer(None, update_queue, '127.0.0.1', 0, 'hook', max_backlog=1)
+    server.start()
+
+    try:
+        for update_id in range(2):
+            server.accept({'update_id': update_id})
+
+        assert update_queue.get(timeout=1).update_id == 0
+        # Handed over as soon as the dispatcher took the previous update
+        assert update_queue.get(timeout=0.1).update_id == 1
+
+    finally:
+        server.shutdown()
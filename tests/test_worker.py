@@ -0,0 +1,43 @@
+from analytics import EventQueue
+from worker import PeriodicWorker
+
+
+class Counter(PeriodicWorker):
+    def __init__(self, interval):
+        super(Counter, self).__init__(interval, 'counter')
+        self.runs = 0
+
+    def run_once(self):
+        self.runs += 1
+        if self.runs == 1:
+            raise ValueError("first run fails")
+
+
+def test_runs_periodically_and_once_more_when_stopped():
+    worker = Counter(0.01)
+    worker.start()
+    while worker.runs < 3:
+        worker.stopping.wait(0.01)
+    worker.stop()
+
+    runs = worker.runs
+    worker.stopping.wait(0.05)
+    assert worker.runs == runs
+
+
+def test_event_queue_delivers_everything_on_stop():
+    delivered = []
+
+    def sink(events):
+        delivered.append(list(events))
+        return []
+
+    events = EventQueue(sink, batch_size=2, flush_interval=60)
+    events.start()
+    for i in range(5):
+        events.track(i, 'event')
+    events.stop()
+
+    assert delivered == [[(0, 'event'), (1, 'event')], [(2, 'event'), (3, 'event')],
+                         [(4, 'event')]]
+    assert events.stats()['sent'] == 5
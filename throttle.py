@@ -0,0 +1,74 @@
+import threading
+import time
+
+from lru import ExpiringLRU
+
+
+class TokenBucket(object):
+    """
+    Allows rate actions per second on average and bursts of up to burst
+    actions. Not thread safe; callers hold their own lock.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now):
+        """ Seconds until the next action is allowed, 0 if it is allowed now """
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds, now):
+        """ Allow nothing for seconds, e.g. when told so by a flood limit """
+        self.paused_until = now + seconds
+        self.tokens = 0.0
+        self.updated = self.paused_until
+
+
+class RateLimiter(object):
+    """
+    One token bucket per key, e.g. per chat or per user. Buckets of the
+    least recently seen keys are dropped beyond max_size, which only ever
+    resets them to a full burst.
+    """
+
+    def __init__(self, rate, burst, max_size=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self.limited = 0
+        self._buckets = ExpiringLRU(max_size)
+        self._lock = threading.Lock()
+
+    def bucket(self, key):
+        """ The bucket of key; use under the caller's lock or for a single thread only """
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets.put(key, bucket)
+
+        return bucket
+
+    def allow(self, key):
+        """ Take a token for key if one is available, return whether it was """
+        with self._lock:
+            bucket = self.bucket(key)
+            if bucket.delay(time.monotonic()):
+                self.limited += 1
+                return False
+            bucket.take()
+            return True
@@ -0,0 +1,176 @@
+import datetime
+import logging
+import threading
+from collections import defaultdict
+
+from config import VOTE_FLUSH_INTERVAL
+from database import db, write_session
+from identity import identities, profile_of
+from worker import PeriodicWorker
+
+logger = logging.getLogger(__name__)
+
+
+class VoteBuffer(PeriodicWorker):
+    """
+    Confirmations of reports, acknowledged at once and written to the
+    database in batches by a background thread.
+
+    Each (report, user) pair holds the vote state it had in the database and
+    the state the user toggled it to, so repeated taps cancel out instead of
+    writing anything. Lookups of a user's vote and of a report's voter count
+    include the votes not written yet. stop() writes everything pending.
+    """
+
+    failure = "Could not write votes"
+
+    def __init__(self, flush_interval=1.0):
+        super(VoteBuffer, self).__init__(flush_interval, 'vote-flusher')
+        # (believer_id, reporter_id): (stored vote, wanted vote)
+        self._pending = {}
+        # Change of each report's voter count by the pending votes
+        self._delta = defaultdict(int)
+        # Profiles of voters, whose Reporter row is created if missing
+        self._voters = {}
+        # Votes being written, still visible to lookups until committed
+        self._flushing = {}
+        self._flushing_delta = {}
+        self._flushing_voters = {}
+        self._lock = threading.RLock()
+
+    def toggle(self, believer_id, user, stored):
+        """
+        Flip user's vote for a report and return whether the user now
+        confirms it. stored() tells whether the database has the vote. It is
+        only called if no vote of the user is buffered, under the lock, so a
+        flush cannot commit between reading the vote and flipping it.
+        """
+        key = (believer_id, user.id)
+
+        with self._lock:
+            if key in self._pending:
+                stored, voted = self._pending[key]
+            else:
+                flushing = self._flushing.get(key)
+                stored = voted = flushing[1] if flushing else stored()
+
+            voted = not voted
+            self._delta[believer_id] += 1 if voted else -1
+            if voted == stored:
+                del self._pending[key]
+            else:
+                self._pending[key] = (stored, voted)
+                if voted:
+                    self._voters[user.id] = profile_of(user)
+
+        return voted
+
+    def vote(self, believer_id, reporter_id):
+        """ The pending vote of a reporter for a report, or None if it is as stored """
+        key = (believer_id, reporter_id)
+
+        with self._lock:
+            entry = self._pending.get(key) or self._flushing.get(key)
+            return entry[1] if entry else None
+
+    def delta(self, believer_id):
+        """ How much the pending votes change the stored voter count of a report """
+        with self._lock:
+            return self._delta.get(believer_id, 0) + self._flushing_delta.get(believer_id, 0)
+
+    def pending_voters(self, believer_id):
+        """
+        The votes for a report that are not written yet, as a sorted tuple of
+        (reporter id, vote, profile) with the voter's profile for new votes
+        """
+        with self._lock:
+            # Only reports toggled since the last flush have an entry
+            if believer_id not in self._delta and believer_id not in self._flushing_delta:
+                return ()
+
+            wanted = {reporter_id: voted
+                      for entries in (self._flushing, self._pending)
+                      for (voted_for, reporter_id), (_, voted) in entries.items()
+                      if voted_for == believer_id}
+            return tuple(sorted(
+                (reporter_id, voted,
+                 self._voters.get(reporter_id) or self._flushing_voters.get(reporter_id)
+                 if voted else None)
+                for reporter_id, voted in wanted.items()))
+
+    def flush(self):
+        """ Write all pending votes in a single transaction """
+        with self._lock:
+            if not self._pending:
+                # Toggles that cancelled out leave only zero deltas behind
+                self._delta.clear()
+                self._voters.clear()
+                return
+            self._flushing, self._pending = self._pending, {}
+            self._flushing_delta, self._delta = dict(self._delta), defaultdict(int)
+            voters, self._voters = self._voters, {}
+            self._flushing_voters = voters
+
+        votes = self._flushing
+        added = [(reporter_id, believer_id)
+                 for (believer_id, reporter_id), (_, voted) in votes.items() if voted]
+        removed = [(believer_id, reporter_id)
+                   for (believer_id, reporter_id), (_, voted) in votes.items() if not voted]
+        believer_ids = sorted(set(believer_id for believer_id, _ in votes))
+        now = str(datetime.datetime.now())
+
+        try:
+            with write_session:
+                cursor = db.get_connection().cursor()
+                cursor.executemany(
+                    'INSERT OR IGNORE INTO Reporter (id, first_name, last_name, username, created) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    [(reporter_id,) + profile + (now,) for reporter_id, profile in voters.items()])
+                # Reports deleted in the meantime get no votes
+                cursor.executemany('INSERT OR IGNORE INTO Believer_Reporter (believer, reporter) '
+                                   'SELECT id, ? FROM Believer WHERE id = ?', added)
+                cursor.executemany('DELETE FROM Believer_Reporter '
+                                   'WHERE believer = ? AND reporter = ?', removed)
+                cursor.execute('UPDATE Believer SET version = version + 1, voter_count = '
+                               '(SELECT COUNT(*) FROM Believer_Reporter WHERE believer = Believer.id) '
+                               'WHERE id IN (%s)' % ', '.join(map(str, believer_ids)))
+
+        except BaseException:
+            # Keep the votes, together with any toggled since, for the next attempt
+            with self._lock:
+                for key, (stored, voted) in votes.items():
+                    _, newer = self._pending.get(key, (None, voted))
+                    if newer == stored:
+                        self._pending.pop(key, None)
+                    else:
+                        self._pending[key] = (stored, newer)
+                for believer_id, delta in self._flushing_delta.items():
+                    self._delta[believer_id] += delta
+                for reporter_id, profile in voters.items():
+                    self._voters.setdefault(reporter_id, profile)
+                self._flushing, self._flushing_delta, self._flushing_voters = {}, {}, {}
+            raise
+
+        with self._lock:
+            self._flushing, self._flushing_delta, self._flushing_voters = {}, {}, {}
+
+        # Imported here, as the search modules depend on believer, which depends on this
+        from query_cache import cache as query_cache
+        from read_snapshot import snapshot
+        for believer_id in believer_ids:
+            snapshot.changed(believer_id)
+            query_cache.invalidate(believer_id)
+        for reporter_id in voters:
+            identities.forget(reporter_id)
+
+        logger.debug("Wrote %d votes for %d reports", len(votes), len(believer_ids))
+
+    def run_once(self):
+        self.flush()
+
+    def __len__(self):
+        return len(self._pending)
+
+
+# Buffer singleton
+votes = VoteBuffer(VOTE_FLUSH_INTERVAL)
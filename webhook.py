@@ -0,0 +1,167 @@
+import json
+import logging
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from queue import Queue, Full, Empty
+from socketserver import ThreadingMixIn
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Small responses on kept-alive connections would otherwise wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        webhook = self.server.webhook
+
+        if self.path.strip('/') != webhook.url_path:
+            self._respond(404)
+            return
+
+        try:
+            length = int(self.headers['Content-Length'])
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+        except (TypeError, ValueError):
+            self._respond(400)
+            return
+
+        if webhook.accept(data):
+            self._respond(200)
+        else:
+            # Telegram retries the delivery later, which is the backpressure
+            self._respond(503, retry_after=1)
+
+    def _respond(self, status, retry_after=None):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookServer(object):
+    """
+    HTTP server receiving updates pushed by Telegram.
+
+    Requests are accepted concurrently, each on its own thread, and parked in
+    a bounded queue. A single pump thread hands them to the dispatcher,
+    holding back while the dispatcher already has max_backlog updates
+    waiting. Once the bounded queue is full, deliveries are refused with 503
+    so Telegram slows down instead of the bot running out of memory.
+    """
+
+    def __init__(self, bot, update_queue, listen, port, url_path,
+                 max_pending=1000, max_backlog=100, put_timeout=1.0):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.url_path = url_path.strip('/')
+        self.max_backlog = max_backlog
+        self.put_timeout = put_timeout
+        self.accepted = 0
+        self.rejected = 0
+        self._pending = Queue(max_pending)
+        self._stop = threading.Event()
+        # Guards _in_flight, the number of accept() calls still queueing an update
+        self._accepting = threading.Condition()
+        self._in_flight = 0
+        self._httpd = _ThreadingHTTPServer((listen, port), _WebhookHandler)
+        self._httpd.webhook = self
+        self._threads = []
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def accept(self, data):
+        """ Queue one update as received from Telegram; False if there is no room or we stop """
+        with self._accepting:
+            if self._stop.is_set():
+                self.rejected += 1
+                return False
+            self._in_flight += 1
+
+        try:
+            self._pending.put(data, timeout=self.put_timeout)
+        except Full:
+            self.rejected += 1
+            return False
+        finally:
+            with self._accepting:
+                self._in_flight -= 1
+                self._accepting.notify_all()
+
+        self.accepted += 1
+        return True
+
+    def _dispatch(self, data):
+        try:
+            self.update_queue.put(Update.de_json(data, self.bot))
+        except Exception:
+            logger.exception("Could not parse update %r", data)
+
+    def _wait_for_backlog(self):
+        """ Block until the dispatcher has fewer than max_backlog updates waiting, or we stop """
+        # Queue.get() notifies not_full after every update it hands out,
+        # also on the dispatcher's unbounded queue
+        not_full = self.update_queue.not_full
+        with not_full:
+            while len(self.update_queue.queue) >= self.max_backlog and not self._stop.is_set():
+                not_full.wait(0.5)
+
+    def _pump(self):
+        while not self._stop.is_set():
+            try:
+                data = self._pending.get(timeout=0.5)
+            except Empty:
+                continue
+
+            self._wait_for_backlog()
+            self._dispatch(data)
+
+    def _drain(self):
+        """ Hand the queued updates to the dispatcher, which processes them before it stops """
+        while True:
+            try:
+                data = self._pending.get_nowait()
+            except Empty:
+                return
+            self._dispatch(data)
+
+    def start(self):
+        for target, name in ((self._httpd.serve_forever, 'webhook-http'),
+                             (self._pump, 'webhook-pump')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        logger.info("Listening for webhook updates on port %d", self.port)
+
+    def shutdown(self):
+        """
+        Stop accepting updates and pass on the ones already acknowledged, as
+        Telegram does not deliver those again; named like HTTPServer.shutdown
+        for Updater.stop(), which stops the dispatcher afterwards
+        """
+        with self._accepting:
+            self._stop.set()
+            # Deliveries arriving from now on get a 503 and are retried later
+            self._accepting.wait_for(lambda: not self._in_flight)
+
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+        for thread in self._threads:
+            thread.join()
+
+        self._drain()
@@ -0,0 +1,44 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicWorker(object):
+    """
+    Base for objects that do their work on a background thread: it calls
+    run_once() every interval seconds, logging errors with failure. stop()
+    ends the thread and then calls finish(), by default one more run_once(),
+    so nothing pending is lost.
+    """
+
+    failure = "Background work failed"
+
+    def __init__(self, interval, name):
+        self.interval = interval
+        self.name = name
+        self.stopping = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        raise NotImplementedError
+
+    def finish(self):
+        self.run_once()
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception(self.failure)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self._thread:
+            self._thread.join()
+        self.finish()